@@ -58,6 +58,11 @@ async def get_user_ai_logs(
                 "request_text": log.request_text or "",
                 "response_text": log.response_text or "",
                 "error": log.error,
+                "attempt": log.attempt,
+                "cancelled": bool(log.cancelled),
+                "cache_hit": bool(log.cache_hit),
+                "coalesced": bool(log.coalesced),
+                "affinity_hit": log.affinity_hit,
                 "created_at": log.created_at.isoformat() if log.created_at else None
             }
             logs.append(log_dict)
@@ -429,6 +434,41 @@ async def get_token_stats(
         print(f"Error getting token stats: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/api/admin/ai-logs/hedging-stats")
+async def get_hedging_stats(
+    current_user: User = Depends(check_admin_permission)
+):
+    """对冲请求状态（发起次数、对冲胜出次数、预算剩余、各渠道当前的对冲延迟）"""
+    return upstream_hedger.stats()
+
+@router.get("/api/admin/ai-logs/stream-stats")
+async def get_stream_stats(
+    current_user: User = Depends(check_admin_permission)
+):
+    """可续传流式生成的状态（缓存中的生成数、重连续传次数、断开后被取消的次数）"""
+    return stream_registry.stats()
+
+@router.get("/api/admin/ai-logs/response-cache-stats")
+async def get_response_cache_stats(
+    current_user: User = Depends(check_admin_permission)
+):
+    """回复缓存状态（条目数、占用字节、命中 / 未命中 / 淘汰次数）"""
+    return response_cache.stats()
+
+@router.get("/api/admin/ai-logs/single-flight-stats")
+async def get_single_flight_stats(
+    current_user: User = Depends(check_admin_permission)
+):
+    """相同请求合并状态（进行中的合并数、带头 / 合并的请求数、因读取太慢被移出的次数）"""
+    return single_flight.stats()
+
+@router.get("/api/admin/ai-logs/affinity-stats")
+async def get_affinity_stats(
+    current_user: User = Depends(check_admin_permission)
+):
+    """会话粘性路由状态（记录数；选择渠道时沿用 / 原渠道不可用 / 没有记录的次数）"""
+    return channel_router.affinity.stats()
+
 @router.get("/api/admin/ai-logs/stats")
 async def get_ai_logs_stats(
     start_date: Optional[datetime] = None,
@@ -463,7 +503,13 @@ async def get_ai_logs_stats(
                 "min_latency": 0,
                 "max_latency": 0
             },
-            "error_rate": 0
+            "error_rate": 0,
+            "cancellation_stats": {
+                "cancelled_requests": 0,
+                "generated_tokens": 0,
+                "estimated_saved_tokens": 0,
+                "by_model": []
+            }
         }
 
     # 2. Token统计
@@ -495,6 +541,36 @@ async def get_ai_logs_stats(
     error_count = base_query.filter(AIRequestLog.error.isnot(None)).count()
     print(f"Error count: {error_count}")
 
+    # 5. 客户端中途断开统计：节省的 tokens 按同一模型正常完成的流式请求的平均补全 tokens 估算
+    cancelled_rows = base_query.with_entities(
+        AIRequestLog.model_name,
+        func.count(AIRequestLog.id).label('count'),
+        func.sum(AIRequestLog.completion_tokens).label('generated_tokens')
+    ).filter(AIRequestLog.cancelled == True).group_by(AIRequestLog.model_name).all()
+
+    avg_completion = {}
+    if cancelled_rows:
+        avg_completion = dict(base_query.with_entities(
+            AIRequestLog.model_name,
+            func.avg(AIRequestLog.completion_tokens)
+        ).filter(
+            AIRequestLog.streaming == True,
+            AIRequestLog.cancelled.isnot(True),
+            AIRequestLog.error.is_(None),
+            AIRequestLog.model_name.in_([row.model_name for row in cancelled_rows])
+        ).group_by(AIRequestLog.model_name).all())
+
+    cancellation_by_model = []
+    for row in cancelled_rows:
+        generated = int(row.generated_tokens or 0)
+        expected = float(avg_completion.get(row.model_name) or 0) * row.count
+        cancellation_by_model.append({
+            "model_name": row.model_name,
+            "cancelled_requests": row.count,
+            "generated_tokens": generated,
+            "estimated_saved_tokens": int(max(0, expected - generated))
+        })
+
     # 处理结果并返回
     result = {
         "total_requests": total_requests,
@@ -510,7 +586,13 @@ async def get_ai_logs_stats(
             "min_latency": round(float(latency_stats.min_latency or 0), 2),
             "max_latency": round(float(latency_stats.max_latency or 0), 2)
         },
-        "error_rate": error_count / total_requests if total_requests > 0 else 0
+        "error_rate": error_count / total_requests if total_requests > 0 else 0,
+        "cancellation_stats": {
+            "cancelled_requests": sum(item["cancelled_requests"] for item in cancellation_by_model),
+            "generated_tokens": sum(item["generated_tokens"] for item in cancellation_by_model),
+            "estimated_saved_tokens": sum(item["estimated_saved_tokens"] for item in cancellation_by_model),
+            "by_model": cancellation_by_model
+        }
     }
     
     print(f"Returning stats: {result}")
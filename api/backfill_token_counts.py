@@ -0,0 +1,47 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from init import *
+from class_model import *
+from schema import add_missing_columns
+
+
+def backfill_message_token_counts(batch_size: int = 500) -> int:
+    """
+    给 token_count 为空的历史消息补上 tokens 数
+    按 id 分批处理，每批单独提交，中断后重新运行会从剩余的行继续
+    """
+    add_missing_columns(engine, Base.metadata)
+    db = SessionLocal()
+    updated = 0
+    last_id = 0
+    try:
+        while True:
+            rows = db.query(Message.id, Message.content, Message.model_name).filter(
+                Message.id > last_id,
+                Message.token_count.is_(None)
+            ).order_by(Message.id).limit(batch_size).all()
+            if not rows:
+                break
+
+            mappings = []
+            for row in rows:
+                token_count = count_message_content_tokens(row.content, row.model_name or "gpt-3.5-turbo")
+                if token_count is not None:
+                    mappings.append({"id": row.id, "token_count": token_count})
+            db.bulk_update_mappings(Message, mappings)
+            db.commit()
+            updated += len(mappings)
+            last_id = rows[-1].id
+            print(f"已回填 {updated} 条消息的 token_count (id <= {last_id})")
+    except Exception as e:
+        db.rollback()
+        print(f"Error backfilling token counts: {str(e)}")
+    finally:
+        db.close()
+    return updated
+
+
+if __name__ == "__main__":
+    backfill_message_token_counts()
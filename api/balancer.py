@@ -0,0 +1,185 @@
+#balancer.py
+# 自适应负载均衡（按模型开启）：每个渠道在内存中维护 TTFT 和错误率的指数移动平均（EWMA）以及进行中的请求数，
+# 选择渠道时随机取两个候选（power of two choices），按 配置权重 / 负载代价 较高的一个
+import random
+import time
+from typing import Dict, List, Optional, Sequence
+
+from init import *
+from class_model import *
+
+
+class ChannelLoad:
+    __slots__ = ("ttft", "error_rate", "error_updated_at", "inflight", "requests", "failures")
+
+    def __init__(self):
+        self.ttft: Optional[float] = None  # TTFT 的 EWMA（秒），没有样本时为空
+        self.error_rate = 0.0  # 错误率的 EWMA（0 ~ 1），随时间按半衰期衰减
+        self.error_updated_at = time.monotonic()
+        self.inflight = 0
+        self.requests = 0
+        self.failures = 0
+
+
+class ChannelLoadBalancer:
+    """
+    - 负载代价 = TTFT × (1 + 进行中的请求数) × (1 + error_penalty × 错误率)，有效权重 = 配置权重 / 代价
+    - 错误率没有新样本时按 error_half_life 衰减，出过错的渠道一段时间后会重新获得流量
+    - 没有 TTFT 样本的渠道按已知最快的 TTFT 计算（都没有样本时用 default_ttft），新渠道能分到流量并积累样本
+    - 只在事件循环中调用，不需要加锁
+    """
+
+    def __init__(
+        self,
+        alpha: float = BALANCER_EWMA_ALPHA,
+        default_ttft: float = BALANCER_DEFAULT_TTFT,
+        error_penalty: float = BALANCER_ERROR_PENALTY,
+        error_half_life: float = BALANCER_ERROR_HALF_LIFE
+    ):
+        self.alpha = alpha
+        self.default_ttft = default_ttft
+        self.error_penalty = error_penalty
+        self.error_half_life = error_half_life
+        self._channels: Dict[int, ChannelLoad] = {}
+        self.choices = 0
+        self.overrides = 0  # 两个候选中选中了配置权重较低的一个（说明负载改变了流量分配）
+
+    def _load(self, channel_id: int) -> ChannelLoad:
+        load = self._channels.get(channel_id)
+        if load is None:
+            load = self._channels[channel_id] = ChannelLoad()
+        return load
+
+    def _error_rate(self, load: ChannelLoad, now: Optional[float] = None) -> float:
+        elapsed = (now or time.monotonic()) - load.error_updated_at
+        return load.error_rate * 0.5 ** (elapsed / self.error_half_life)
+
+    def _record(self, load: ChannelLoad, failed: bool) -> None:
+        now = time.monotonic()
+        error_rate = self._error_rate(load, now)
+        load.error_rate = error_rate + self.alpha * ((1.0 if failed else 0.0) - error_rate)
+        load.error_updated_at = now
+        load.requests += 1
+        if failed:
+            load.failures += 1
+
+    # ---------- 样本 ----------
+
+    def begin(self, channel_id: Optional[int]) -> None:
+        if channel_id is not None:
+            self._load(channel_id).inflight += 1
+
+    def end(self, channel_id: Optional[int]) -> None:
+        if channel_id is not None:
+            load = self._load(channel_id)
+            load.inflight = max(0, load.inflight - 1)
+
+    def record_success(self, channel_id: Optional[int], ttft: float) -> None:
+        if channel_id is None:
+            return
+        load = self._load(channel_id)
+        load.ttft = ttft if load.ttft is None else load.ttft + self.alpha * (ttft - load.ttft)
+        self._record(load, False)
+
+    def record_failure(self, channel_id: Optional[int]) -> None:
+        if channel_id is not None:
+            self._record(self._load(channel_id), True)
+
+    def seed(self, db: Session, limit: int = BALANCER_SEED_LOGS) -> int:
+        """启动时用最近的 AI 请求日志预热 EWMA，避免重启后所有渠道从默认值开始"""
+        rows = db.query(
+            AIRequestLog.channel_id,
+            AIRequestLog.first_token_latency,
+            AIRequestLog.response_text,
+            AIRequestLog.error,
+            AIRequestLog.cache_hit,
+            AIRequestLog.coalesced
+        ).filter(
+            AIRequestLog.channel_id != None
+        ).order_by(AIRequestLog.id.desc()).limit(limit).all()
+        seeded = 0
+        for channel_id, first_token_latency, response_text, error, cache_hit, coalesced in reversed(rows):
+            if cache_hit or coalesced:
+                continue
+            if response_text in ("[Failover]", "[API Error Response]"):
+                self.record_failure(channel_id)
+            elif not error and first_token_latency:
+                self.record_success(channel_id, first_token_latency / 1000)
+            else:
+                continue
+            seeded += 1
+        return seeded
+
+    # ---------- 选择 ----------
+
+    def _unknown_ttft(self) -> float:
+        known = [load.ttft for load in self._channels.values() if load.ttft is not None]
+        return min(known) if known else self.default_ttft
+
+    def cost(self, channel_id: Optional[int]) -> float:
+        load = self._channels.get(channel_id)
+        if load is None:
+            return self._unknown_ttft()
+        ttft = load.ttft if load.ttft is not None else self._unknown_ttft()
+        return ttft * (1 + load.inflight) * (1 + self.error_penalty * self._error_rate(load))
+
+    def effective_weight(self, route) -> float:
+        return max(route.weight, 0.0) / max(self.cost(route.id), 1e-6)
+
+    def choose(self, routes: Sequence):
+        """随机取两个不同的候选，返回有效权重较高的一个"""
+        if len(routes) == 1:
+            return routes[0]
+        first, second = random.sample(range(len(routes)), 2)
+        a, b = routes[first], routes[second]
+        self.choices += 1
+        # 配置权重都为 0 时只比较代价
+        if a.weight <= 0 and b.weight <= 0:
+            chosen = a if self.cost(a.id) <= self.cost(b.id) else b
+        else:
+            chosen = a if self.effective_weight(a) >= self.effective_weight(b) else b
+        other = b if chosen is a else a
+        if chosen.weight < other.weight:
+            self.overrides += 1
+        return chosen
+
+    # ---------- 管理员视图 ----------
+
+    def explain(self, routes: Sequence) -> List[Dict]:
+        """一个模型的各渠道：配置权重、EWMA、进行中请求数、代价，以及配置 / 实际的流量占比"""
+        configured_total = sum(max(route.weight, 0.0) for route in routes) or 1.0
+        effective = [self.effective_weight(route) for route in routes]
+        effective_total = sum(effective) or 1.0
+        now = time.monotonic()
+        result = []
+        for route, weight in zip(routes, effective):
+            load = self._channels.get(route.id)
+            result.append({
+                "channel_id": route.id,
+                "channel_name": route.channel_name,
+                "weight": route.weight,
+                "ttft_ewma": round(load.ttft, 4) if load and load.ttft is not None else None,
+                "error_rate": round(self._error_rate(load, now), 4) if load else 0.0,
+                "inflight": load.inflight if load else 0,
+                "requests": load.requests if load else 0,
+                "failures": load.failures if load else 0,
+                "cost": round(self.cost(route.id), 4),
+                "effective_weight": round(weight, 4),
+                "configured_share": round(max(route.weight, 0.0) / configured_total, 4),
+                "effective_share": round(weight / effective_total, 4)
+            })
+        return result
+
+    def stats(self) -> Dict:
+        return {
+            "channels": len(self._channels),
+            "choices": self.choices,
+            "overrides": self.overrides,
+            "alpha": self.alpha,
+            "default_ttft": self.default_ttft,
+            "error_penalty": self.error_penalty,
+            "error_half_life": self.error_half_life
+        }
+
+
+channel_balancer = ChannelLoadBalancer()
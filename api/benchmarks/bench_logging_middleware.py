@@ -0,0 +1,128 @@
+"""
+API 日志中间件开销基准测试
+
+对比三种情况下单个请求的 p50 / p99 延迟:
+- none:   不挂日志中间件
+- legacy: 原 BaseHTTPMiddleware 实现（先读完请求体、把响应体全部收集到列表、再用 iterate_in_threadpool 回放）
+- asgi:   当前的纯 ASGI APILoggingMiddleware（只截取前 N 字节，SSE 不缓冲）
+
+三种情况都把日志行交给同一个空写入函数，只测中间件本身的开销。
+
+用法（在 api 目录下运行）:
+    python benchmarks/bench_logging_middleware.py --requests 2000 --export-kb 1024
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import httpx
+from starlette.applications import Starlette
+from starlette.concurrency import iterate_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from class_model import APILoggingMiddleware  # noqa: E402
+from log_writer import api_log_writer  # noqa: E402
+from settings_cache import settings_cache  # noqa: E402
+
+# 强制开启日志，写入替换为空操作
+settings_cache.get = lambda: SimpleNamespace(enableSystemLogs=True)
+submitted = []
+api_log_writer.submit = lambda row: submitted.append(len(row))
+
+
+class LegacyLoggingMiddleware(BaseHTTPMiddleware):
+    """原实现的缓冲逻辑（省略数据库写入）"""
+
+    async def dispatch(self, request: Request, call_next):
+        raw_body = await request.body()
+        request_data = api_log_writer.capture(raw_body)
+        response = await call_next(request)
+        if "text/event-stream" in response.headers.get("Content-Type", ""):
+            api_log_writer.submit({"request_data": request_data})
+            return response
+        response_body = [section async for section in response.body_iterator]
+        response.body_iterator = iterate_in_threadpool(iter(response_body))
+        response_data = api_log_writer.capture(response_body[0]) if response_body else None
+        api_log_writer.submit({"request_data": request_data, "response_data": response_data})
+        return response
+
+
+def build_app(middleware, export_bytes: int, sse_chunks: int) -> Starlette:
+    export_payload = b"x" * export_bytes
+
+    async def small_json(request: Request):
+        await request.body()
+        return JSONResponse({"ok": True, "items": list(range(20))})
+
+    async def export(request: Request):
+        return Response(export_payload, media_type="text/csv")
+
+    async def stream(request: Request):
+        async def events():
+            for i in range(sse_chunks):
+                yield f"data: {i}\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    routes = [
+        Route("/json", small_json, methods=["POST"]),
+        Route("/export", export),
+        Route("/stream", stream),
+    ]
+    return Starlette(routes=routes, middleware=[Middleware(middleware)] if middleware else [])
+
+
+async def _measure(app: Starlette, method: str, path: str, count: int) -> list:
+    transport = httpx.ASGITransport(app=app)
+    latencies = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for _ in range(20):  # 预热
+            await client.request(method, path, content=b'{"q": 1}')
+        for _ in range(count):
+            start = time.perf_counter()
+            response = await client.request(method, path, content=b'{"q": 1}')
+            await response.aread()
+            latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return latencies
+
+
+def _pct(values: list, pct: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="每个场景的请求数")
+    parser.add_argument("--export-kb", type=int, default=1024, help="大响应体大小（KB）")
+    parser.add_argument("--sse-chunks", type=int, default=200, help="SSE 响应的事件数")
+    args = parser.parse_args()
+
+    variants = [("none", None), ("legacy", LegacyLoggingMiddleware), ("asgi", APILoggingMiddleware)]
+    cases = [("POST", "/json"), ("GET", "/export"), ("GET", "/stream")]
+    for method, path in cases:
+        count = args.requests if path != "/export" else max(1, args.requests // 10)
+        baseline = None
+        print(f"\n{method} {path} x {count}")
+        for name, middleware in variants:
+            app = build_app(middleware, args.export_kb * 1024, args.sse_chunks)
+            latencies = asyncio.run(_measure(app, method, path, count))
+            p50, p99 = _pct(latencies, 0.50), _pct(latencies, 0.99)
+            if baseline is None:
+                baseline = (p50, p99)
+            print(
+                f"  {name:<7} p50={p50:7.3f}ms p99={p99:7.3f}ms "
+                f"overhead p50={p50 - baseline[0]:+7.3f}ms p99={p99 - baseline[1]:+7.3f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+流式转发基准测试：每个 token 的 CPU 耗时
+
+模拟上游返回 --tokens 个增量分片（每个分片一个 token，末尾带 usage 和 [DONE]），
+按随机大小切成网络分片（帧可能被拆开），对比两种处理方式:
+- legacy: 原实现，SDK 把每帧解析成 ChatCompletionChunk，再组装 dict、json.dumps 后转发，回复内容用字符串累加
+- relay:  SSEFrameParser 按帧边界原样转发字节，StreamDeltas 只提取增量内容存入列表
+
+结果使用 process_time（CPU 时间），重复 --rounds 次取最好的一轮。
+
+用法（在 api 目录下运行）:
+    python benchmarks/bench_sse_relay.py --tokens 4000 --rounds 5
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+from openai.types.chat import ChatCompletionChunk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sse import SSEFrameParser, StreamDeltas  # noqa: E402
+
+WORDS = ["token", " cache", " stream", " channel", "模型", "对话", "上下文", " hello", " world", "缓存"]
+
+
+def _upstream_bytes(rng: random.Random, tokens: int) -> bytes:
+    frames = []
+    for index in range(tokens):
+        frames.append({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "gpt-4o",
+            "choices": [{
+                "index": 0,
+                "delta": {"content": rng.choice(WORDS)},
+                "finish_reason": "stop" if index == tokens - 1 else None
+            }]
+        })
+    frames.append({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": "gpt-4o",
+        "choices": [],
+        "usage": {"prompt_tokens": 100, "completion_tokens": tokens, "total_tokens": tokens + 100}
+    })
+    text = "".join(f"data: {json.dumps(frame, ensure_ascii=False)}\n\n" for frame in frames)
+    return (text + "data: [DONE]\n\n").encode("utf-8")
+
+
+def _network_chunks(rng: random.Random, data: bytes, min_size: int, max_size: int):
+    chunks = []
+    position = 0
+    while position < len(data):
+        size = rng.randint(min_size, max_size)
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+
+def _legacy(chunks):
+    """SDK 的 SSE 解码按行切分后逐帧构造 ChatCompletionChunk，这里用同样的方式模拟"""
+    buffer = b""
+    accumulated = ""
+    sent = 0
+    for chunk in chunks:
+        buffer += chunk
+        while b"\n\n" in buffer:
+            frame, buffer = buffer.split(b"\n\n", 1)
+            data = frame[6:]
+            if data == b"[DONE]":
+                continue
+            parsed = ChatCompletionChunk.model_validate(json.loads(data))
+            chunk_dict = {
+                "id": parsed.id,
+                "object": parsed.object,
+                "created": parsed.created,
+                "model": parsed.model,
+                "choices": [{
+                    "index": choice.index,
+                    "delta": {
+                        "content": choice.delta.content,
+                        "role": choice.delta.role
+                    } if choice.delta else {},
+                    "finish_reason": choice.finish_reason
+                } for choice in parsed.choices],
+                "usage": parsed.usage.model_dump() if parsed.usage else None
+            }
+            if parsed.choices and parsed.choices[0].delta and parsed.choices[0].delta.content:
+                accumulated += parsed.choices[0].delta.content
+            sent += len(f"data: {json.dumps(chunk_dict)}\n\n")
+    return accumulated, sent
+
+
+def _relay(chunks):
+    parser = SSEFrameParser()
+    deltas = StreamDeltas()
+    sent = 0
+    for chunk in chunks:
+        data, payloads = parser.feed(chunk)
+        for payload in payloads:
+            content = deltas.delta(payload)
+            if content:
+                deltas.append(content)
+        sent += len(data)
+    data, payloads = parser.flush()
+    sent += len(data)
+    return deltas.text(), sent
+
+
+def _cpu(func, chunks, rounds: int):
+    best = None
+    result = None
+    for _ in range(rounds):
+        start = time.process_time()
+        result = func(chunks)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=4000, help="模拟回复的 token 数")
+    parser.add_argument("--rounds", type=int, default=5, help="重复次数，取最好的一轮")
+    parser.add_argument("--min-chunk", type=int, default=64, help="网络分片最小字节数")
+    parser.add_argument("--max-chunk", type=int, default=1024, help="网络分片最大字节数")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    data = _upstream_bytes(rng, args.tokens)
+    chunks = _network_chunks(rng, data, args.min_chunk, args.max_chunk)
+    print(f"\n上游 {len(data)} 字节, {args.tokens} tokens, {len(chunks)} 个网络分片")
+
+    expected = None
+    for name, func in [("legacy", _legacy), ("relay", _relay)]:
+        elapsed, (content, sent) = _cpu(func, chunks, args.rounds)
+        expected = expected or content
+        check = "ok" if content == expected else "内容不一致"
+        print(f"  {name:<7} {elapsed * 1e6 / args.tokens:8.2f} µs CPU/token  转发 {sent} 字节  {check}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+并发流式吞吐基准测试
+
+对比 create_streaming_message 的两种上游读取方式:
+- before: 同步 OpenAI 客户端，在 async 生成器里 `for chunk in response`（阻塞事件循环）
+- after:  AsyncOpenAI 客户端，`async for chunk in response`
+
+上游是一个运行在独立线程里的本地模拟 SSE 服务，每个 chunk 之间有固定延迟，
+因此理想情况下 N 个并发流的总耗时应接近单个流的耗时。
+
+用法:
+    python benchmarks/bench_stream_concurrency.py --streams 100 --chunks 50 --delay 0.01
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+from openai import AsyncOpenAI, OpenAI
+
+
+def _sse_chunk(index: int) -> bytes:
+    payload = {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "bench-model",
+        "choices": [{
+            "index": 0,
+            "delta": {"role": "assistant", "content": f"tok{index} "},
+            "finish_reason": None
+        }]
+    }
+    return f"data: {json.dumps(payload)}\n\n".encode()
+
+
+class MockUpstream:
+    """在后台线程中运行的最小 OpenAI 兼容 SSE 服务"""
+
+    def __init__(self, chunks: int, delay: float):
+        self.chunks = chunks
+        self.delay = delay
+        self.port = None
+        self._ready = threading.Event()
+        self._loop = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                # 读取请求头
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                if length:
+                    await reader.readexactly(length)
+
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/event-stream\r\n"
+                    b"Transfer-Encoding: chunked\r\n\r\n"
+                )
+                for i in range(self.chunks):
+                    await asyncio.sleep(self.delay)
+                    body = _sse_chunk(i)
+                    writer.write(b"%x\r\n%s\r\n" % (len(body), body))
+                    await writer.drain()
+                done = b"data: [DONE]\n\n"
+                writer.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(done), done))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, "127.0.0.1", 0, backlog=4096)
+        )
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        self._ready.wait()
+        return f"http://127.0.0.1:{self.port}"
+
+
+async def _sync_stream(base_url: str) -> int:
+    """旧实现：同步客户端在 async 生成器内迭代"""
+    client = OpenAI(base_url=f"{base_url}/v1", api_key="bench")
+    response = client.chat.completions.create(
+        model="bench-model",
+        messages=[{"role": "user", "content": "hi"}],
+        stream=True
+    )
+    count = 0
+    for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            count += 1
+    client.close()
+    return count
+
+
+async def _async_stream(base_url: str) -> int:
+    """新实现：AsyncOpenAI 原生异步迭代"""
+    client = AsyncOpenAI(base_url=f"{base_url}/v1", api_key="bench")
+    response = await client.chat.completions.create(
+        model="bench-model",
+        messages=[{"role": "user", "content": "hi"}],
+        stream=True
+    )
+    count = 0
+    async for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            count += 1
+    await client.close()
+    return count
+
+
+async def _run_case(name: str, fn, base_url: str, streams: int):
+    start = time.perf_counter()
+    results = await asyncio.gather(*(fn(base_url) for _ in range(streams)))
+    elapsed = time.perf_counter() - start
+    tokens = sum(results)
+    print(
+        f"{name:<8} streams={streams:<5} total={elapsed:8.2f}s "
+        f"throughput={tokens / elapsed:10.1f} chunks/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=100, help="并发流数量")
+    parser.add_argument("--chunks", type=int, default=50, help="每个流的 chunk 数")
+    parser.add_argument("--delay", type=float, default=0.01, help="上游 chunk 间隔（秒）")
+    parser.add_argument("--skip-before", action="store_true", help="跳过同步实现（耗时 = streams x 单流耗时）")
+    args = parser.parse_args()
+
+    base_url = MockUpstream(args.chunks, args.delay).start()
+    ideal = args.chunks * args.delay
+    print(f"mock upstream: {base_url}, 单流理想耗时 {ideal:.2f}s")
+
+    if not args.skip_before:
+        asyncio.run(_run_case("before", _sync_stream, base_url, args.streams))
+    asyncio.run(_run_case("after", _async_stream, base_url, args.streams))
+
+
+if __name__ == "__main__":
+    main()
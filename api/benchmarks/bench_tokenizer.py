@@ -0,0 +1,129 @@
+"""
+tokens 计算基准测试
+
+一、消息列表计数（每种方式重复 --rounds 次，输出每轮耗时）:
+- legacy:  原实现，每次调用 tiktoken.encoding_for_model 再逐条 encode
+- cached:  tokenizer 缓存的编码器，逐条 encode_ordinary
+- batch:   tokenizer.count_batch，一次 encode_ordinary_batch
+- estimate: estimate_tokens 近似估算（不编码），同时给出相对 batch 的误差
+
+二、事件循环阻塞：编码一段长回复的同时运行一个 1ms 的心跳任务，
+   对比直接在事件循环里编码（inline）和 tokenizer.count_async 放到线程池（offload）时心跳的最大延迟
+
+需要能加载 tiktoken 词表（联网或已设置 TIKTOKEN_CACHE_DIR）。
+
+用法（在 api 目录下运行）:
+    python benchmarks/bench_tokenizer.py --messages 200 --rounds 50 --completion-kb 256
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+import tiktoken
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tokenizer import estimate_tokens, tokenizer  # noqa: E402
+
+MODEL = "gpt-4o"
+WORDS = ["token", "cache", "stream", "channel", "模型", "对话", "上下文", "hello", "world", "缓存"]
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _legacy(texts):
+    total = 0
+    for text in texts:
+        encoding = tiktoken.encoding_for_model(MODEL)
+        total += len(encoding.encode(text))
+    return total
+
+
+def _cached(texts):
+    return sum(tokenizer.count(text, MODEL) for text in texts)
+
+
+def _batch(texts):
+    return sum(tokenizer.count_batch(texts, MODEL))
+
+
+def _estimate(texts):
+    return sum(estimate_tokens(text) for text in texts)
+
+
+def _time(func, texts, rounds: int):
+    func(texts)  # 预热
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = func(texts)
+    return (time.perf_counter() - start) * 1000 / rounds, result
+
+
+async def _loop_lag(count_coro_factory) -> float:
+    """心跳任务期望每 1ms 醒来一次，返回最大的实际间隔（毫秒）"""
+    max_gap = 0.0
+    running = True
+
+    async def heartbeat():
+        nonlocal max_gap
+        last = time.perf_counter()
+        while running:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            max_gap = max(max_gap, (now - last) * 1000)
+            last = now
+
+    task = asyncio.create_task(heartbeat())
+    await asyncio.sleep(0.01)
+    await count_coro_factory()
+    await asyncio.sleep(0.01)
+    running = False
+    await task
+    return max_gap
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200, help="消息条数")
+    parser.add_argument("--words", type=int, default=80, help="每条消息的词数")
+    parser.add_argument("--rounds", type=int, default=50, help="每种方式的重复次数")
+    parser.add_argument("--completion-kb", type=int, default=256, help="长回复大小（KB）")
+    args = parser.parse_args()
+
+    if tokenizer.encoding(MODEL) is None:
+        print("无法加载 tiktoken 词表，请联网或设置 TIKTOKEN_CACHE_DIR")
+        return
+
+    rng = random.Random(42)
+    texts = [_text(rng, args.words) for _ in range(args.messages)]
+    print(f"\n消息列表: {args.messages} 条 x {args.words} 词, 每种方式 {args.rounds} 轮")
+    exact = None
+    for name, func in [("legacy", _legacy), ("cached", _cached), ("batch", _batch), ("estimate", _estimate)]:
+        per_round, result = _time(func, texts, args.rounds)
+        if name == "batch":
+            exact = result
+        note = f" 误差 {(result - exact) / exact:+.1%}" if name == "estimate" and exact else ""
+        print(f"  {name:<9} {per_round:8.3f} ms/轮  tokens={result}{note}")
+
+    completion = _text(rng, args.completion_kb * 1024 // 6)
+
+    async def inline():
+        tokenizer.count(completion, MODEL)
+
+    async def offload():
+        await tokenizer.count_async(completion, MODEL)
+
+    print(f"\n长回复: {len(completion)} 字符")
+    for name, factory in [("inline", inline), ("offload", offload)]:
+        lag = asyncio.run(_loop_lag(factory))
+        print(f"  {name:<8} 心跳最大间隔 {lag:8.3f} ms")
+    tokenizer.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -205,7 +205,7 @@ async def export_cards(
 async def get_card_purchase_info(
     db: Session = Depends(get_db)
 ):
-    settings = db.query(SystemSettings).first()
+    settings = settings_cache.get()
     if not settings:
         return {
             "url": None,
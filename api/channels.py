@@ -74,71 +74,71 @@ async def test_channel(
         print(f"- 模型: {actual_model}")
 
         # 发送测试请求
-        async with httpx.AsyncClient() as client:
-            try:
-                print("\n等待上游API响应...")
-                response = await client.post(
-                    request_url,
-                    headers=request_headers,
-                    json=request_data,
-                    timeout=30.0
-                )
+        client = upstream_clients.get_client(channel.base_url)
+        try:
+            print("\n等待上游API响应...")
+            response = await client.post(
+                request_url,
+                headers=request_headers,
+                json=request_data,
+                timeout=30.0
+            )
                 
-                end_time = time.time()  # 记录结束时间
-                latency = round((end_time - start_time) * 1000)  # 计算延迟（毫秒）
+            end_time = time.time()  # 记录结束时间
+            latency = round((end_time - start_time) * 1000)  # 计算延迟（毫秒）
                 
-                response.raise_for_status()
-                print("\n请求成功:")
-                print(f"- 状态码: {response.status_code}")
-                print(f"- 响应延迟: {latency}ms")
-                print(f"- 响应内容: {response.text[:200]}...")
+            response.raise_for_status()
+            print("\n请求成功:")
+            print(f"- 状态码: {response.status_code}")
+            print(f"- 响应延迟: {latency}ms")
+            print(f"- 响应内容: {response.text[:200]}...")
                 
-                return {
-                    "status": "success",
-                    "message": "Channel test successful",
-                    "model_tested": actual_model,
-                    "latency": latency,  # 添加延迟信息
-                    "response": response.json()
-                }
+            return {
+                "status": "success",
+                "message": "Channel test successful",
+                "model_tested": actual_model,
+                "latency": latency,  # 添加延迟信息
+                "response": response.json()
+            }
                 
-            except httpx.HTTPStatusError as e:
-                end_time = time.time()
-                latency = round((end_time - start_time) * 1000)
+        except httpx.HTTPStatusError as e:
+            end_time = time.time()
+            latency = round((end_time - start_time) * 1000)
                 
-                print(f"\n上游API返回错误:")
-                print(f"- 状态码: {e.response.status_code}")
-                print(f"- 响应内容: {e.response.text}")
-                print(f"- 响应延迟: {latency}ms")
+            print(f"\n上游API返回错误:")
+            print(f"- 状态码: {e.response.status_code}")
+            print(f"- 响应内容: {e.response.text}")
+            print(f"- 响应延迟: {latency}ms")
                 
-                error_response = e.response
-                error_status = error_response.status_code
+            error_response = e.response
+            error_status = error_response.status_code
                 
-                try:
-                    error_json = error_response.json()
-                    if isinstance(error_json, dict) and 'error' in error_json and 'message' in error_json['error']:
-                        error_detail = error_json['error']['message']
-                    else:
-                        error_detail = error_json
-                except:
-                    error_detail = error_response.text
+            try:
+                error_json = error_response.json()
+                if isinstance(error_json, dict) and 'error' in error_json and 'message' in error_json['error']:
+                    error_detail = error_json['error']['message']
+                else:
+                    error_detail = error_json
+            except:
+                error_detail = error_response.text
                     
-                raise HTTPException(
-                    status_code=error_status,
-                    detail=error_detail
-                )
+            raise HTTPException(
+                status_code=error_status,
+                detail=error_detail
+            )
                 
-            except httpx.RequestError as e:
-                end_time = time.time()
-                latency = round((end_time - start_time) * 1000)
+        except httpx.RequestError as e:
+            end_time = time.time()
+            latency = round((end_time - start_time) * 1000)
                 
-                print(f"\n请求错误: {str(e)}")
-                print(f"错误类型: {type(e).__name__}")
-                print(f"响应延迟: {latency}ms")
+            print(f"\n请求错误: {str(e)}")
+            print(f"错误类型: {type(e).__name__}")
+            print(f"响应延迟: {latency}ms")
                 
-                raise HTTPException(
-                    status_code=status.HTTP_502_BAD_GATEWAY,
-                    detail=f"Request failed: {str(e)}"
-                )
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                detail=f"Request failed: {str(e)}"
+            )
                 
     except HTTPException:
         raise
@@ -174,8 +174,13 @@ async def delete_channel(
         raise HTTPException(status_code=404, detail="Channel not found")
 
     try:
+        base_url = db_channel.base_url
         db.delete(db_channel)
         db.commit()
+        # 释放该渠道的上游连接池，并重建路由表
+        upstream_clients.invalidate(base_url)
+        channel_router.invalidate()
+        circuit_breaker.reset(channel_id)
         return {"message": "Channel deleted successfully"}
     except Exception as e:
         db.rollback()
@@ -234,6 +239,9 @@ async def update_channel(
                 detail="模型映射必须是有效的 JSON 字符串"
             )
     
+    # 记录旧地址，用于重建上游连接池
+    old_base_url = db_channel.base_url
+
     # 更新渠道属性
     for key, value in update_data.items():
         setattr(db_channel, key, value)
@@ -244,6 +252,12 @@ async def update_channel(
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
+
+    # 渠道配置已变更，重建上游连接池和路由表
+    upstream_clients.invalidate(old_base_url, db_channel.base_url)
+    channel_router.invalidate()
+    # 管理员修改了渠道配置，清除熔断状态重新统计
+    circuit_breaker.reset(channel_id)
     
     # 在返回响应前处理模型列表
     response_data = db_channel.__dict__
@@ -295,7 +309,8 @@ async def create_channel(
         is_active=channel.is_active,
         organization=channel.organization,
         target_model_id=channel.target_model_id,
-        redirect_mapping=channel.redirect_mapping
+        redirect_mapping=channel.redirect_mapping,
+        max_context_tokens=channel.max_context_tokens
     )
     
     db.add(db_channel)
@@ -305,6 +320,8 @@ async def create_channel(
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
+
+    channel_router.invalidate()
     
     # 在返回响应前处理模型列表
     response_data = db_channel.__dict__
@@ -340,7 +357,8 @@ async def get_channels(
             "organization": channel.organization,
             "target_model_id": channel.target_model_id,
             "redirect_mapping": channel.redirect_mapping,
-            "models": json.loads(channel.models) if channel.models else []
+            "models": json.loads(channel.models) if channel.models else [],
+            "circuit_breaker": circuit_breaker.describe(channel.id)
         }
         response_channels.append(channel_dict)
     
@@ -384,6 +402,7 @@ async def bind_model_channels(
         
         db.add_all(bindings)
         db.commit()
+        channel_router.invalidate()
         
         return {
             "message": "渠道绑定更新成功",
@@ -451,6 +470,7 @@ async def add_model_channel(
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
+    channel_router.invalidate()
     return db_channel
 
 
@@ -472,6 +492,8 @@ async def toggle_channel(
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
+
+    channel_router.invalidate()
     
     return {"message": f"Channel is now {'active' if db_channel.is_active else 'inactive'}"}
 
@@ -579,6 +601,27 @@ async def get_channels_stats(
         )
 
 
+@router.get("/api/admin/channels/balancer")
+async def get_channel_balancer(
+    model_name: Optional[str] = None,
+    current_user: User = Depends(check_admin_permission)
+):
+    """
+    自适应负载均衡的有效权重：每个模型的各渠道 TTFT / 错误率 EWMA、进行中请求数、代价，
+    以及按配置权重和按有效权重折算的流量占比，用于解释流量为什么发生偏移
+    """
+    routes = channel_router.all_routes()
+    if model_name is not None:
+        routes = {model_name: routes.get(model_name, [])}
+    return {
+        "balancer": channel_balancer.stats(),
+        "models": {
+            name: channel_balancer.explain(model_routes)
+            for name, model_routes in routes.items()
+        }
+    }
+
+
 
 
 
@@ -57,20 +57,21 @@ async def create_message(
     
     try:
         # 调用外部 API
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{selected_channel.base_url}/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {selected_channel.api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": selected_channel.channel_model_name,
-                    "messages": messages
-                }
-            )
-            api_response = response.json()
-            assistant_message = api_response['choices'][0]['message']['content']
+        client = upstream_clients.get_client(selected_channel.base_url)
+        response = await client.post(
+            f"{selected_channel.base_url}/v1/chat/completions",
+            headers={
+                "Authorization": f"Bearer {selected_channel.api_key}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "model": selected_channel.channel_model_name,
+                "messages": messages
+            }
+        )
+        api_response = response.json()
+        assistant_message = api_response['choices'][0]['message']['content']
+        api_usage = api_response.get('usage') or {}
     except Exception as e:
         print(f"API 调用错误: {str(e)}")  # 添加错误日志
         raise HTTPException(status_code=500, detail=str(e))
@@ -80,7 +81,8 @@ async def create_message(
         chat_id=chat_id,
         role="user",
         content=message.content,
-        model_name=None
+        model_name=None,
+        token_count=count_message_content_tokens(message.content)
     )
     db.add(user_message)
 
@@ -89,13 +91,15 @@ async def create_message(
         chat_id=chat_id,
         role="assistant",
         content=assistant_message,
-        model_name=selected_channel.channel_model_name
+        model_name=selected_channel.channel_model_name,
+        token_count=api_usage.get('completion_tokens') or count_message_content_tokens(assistant_message)
     )
     db.add(assistant_msg)
     
     try:
         db.commit()
         db.refresh(assistant_msg)
+        chat_context_cache.invalidate(chat_id)
     except Exception as e:
         print(f"数据库操作错误: {str(e)}")  # 添加错误日志
         db.rollback()
@@ -171,6 +175,7 @@ async def delete_chat(
 
     db.delete(chat)
     db.commit()
+    chat_context_cache.invalidate(chat_id)
     
     return {"message": "Chat deleted"}
 
@@ -207,31 +212,32 @@ async def create_message(
     
     try:
         # 调用外部 API
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{selected_channel.base_url}/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {selected_channel.api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": selected_channel.channel_model_name,
-                    "messages": messages
-                },
-                timeout=60.0  # 设置合理的超时时间
-            )
+        client = upstream_clients.get_client(selected_channel.base_url)
+        response = await client.post(
+            f"{selected_channel.base_url}/v1/chat/completions",
+            headers={
+                "Authorization": f"Bearer {selected_channel.api_key}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "model": selected_channel.channel_model_name,
+                "messages": messages
+            },
+            timeout=60.0  # 设置合理的超时时间
+        )
             
-            # 检查响应状态码
-            if response.status_code != 200:
-                try:
-                    error_data = response.json()
-                    error_message = error_data.get('error', {}).get('message', 'Unknown error')
-                except:
-                    error_message = f"API request failed with status code: {response.status_code}"
-                raise HTTPException(status_code=response.status_code, detail=error_message)
+        # 检查响应状态码
+        if response.status_code != 200:
+            try:
+                error_data = response.json()
+                error_message = error_data.get('error', {}).get('message', 'Unknown error')
+            except:
+                error_message = f"API request failed with status code: {response.status_code}"
+            raise HTTPException(status_code=response.status_code, detail=error_message)
                 
-            api_response = response.json()
-            assistant_message = api_response['choices'][0]['message']['content']
+        api_response = response.json()
+        assistant_message = api_response['choices'][0]['message']['content']
+        api_usage = api_response.get('usage') or {}
     except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="Request timeout")
     except httpx.RequestError as e:
@@ -243,7 +249,8 @@ async def create_message(
     user_message = Message(
         chat_id=chat_id,
         role="user",
-        content=message.content
+        content=message.content,
+        token_count=count_message_content_tokens(message.content)
     )
     db.add(user_message)
 
@@ -252,13 +259,15 @@ async def create_message(
         chat_id=chat_id,
         role="assistant",
         content=assistant_message,
-        model_name=selected_channel.channel_model_name
+        model_name=selected_channel.channel_model_name,
+        token_count=api_usage.get('completion_tokens') or count_message_content_tokens(assistant_message)
     )
     db.add(assistant_msg)
     
     try:
         db.commit()
         db.refresh(assistant_msg)
+        chat_context_cache.invalidate(chat_id)
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail="Failed to save messages to database")
@@ -324,6 +333,17 @@ async def create_streaming_message(
         model_type = None
         model_id = None
         market_model = None
+        rate_limit_headers = {}
+        max_context_tokens = resolve_max_context_tokens()
+        upstream_routes = []
+        hedging_enabled = False
+        response_cache_enabled = False
+        # 会话粘性路由：只用于系统模型；pinned_channel_id 是选择渠道前该会话粘住的渠道
+        sticky_routing = False
+        pinned_channel_id = None
+        # 透传给上游的采样参数（目前客户端不传，使用上游默认值），同时参与回复缓存的 key
+        upstream_params: Dict[str, Any] = {}
+        attempt = 1
 
         # 获取请求数据
         request_data = await request.json()
@@ -508,14 +528,21 @@ async def create_streaming_message(
                         detail={"error": {"type": "access_denied", "message": "This model requires VIP access"}}
                     )
 
-                check_result, error_message = await check_user_limits(user_id, model.id, db)
+                check_result, error_message = await check_user_limits(
+                    user_id, model.id, db, headers=rate_limit_headers
+                )
                 if not check_result:
                     raise HTTPException(
                         status_code=429,
-                        detail={"error": {"type": "rate_limit", "message": error_message}}
+                        detail={"error": {"type": "rate_limit", "message": error_message}},
+                        headers=rate_limit_headers
                     )
 
-                channel = await select_channel(db, requested_model)
+                # 同一会话优先沿用上一轮的渠道，让上游的提示词前缀缓存生效
+                channel, pinned_channel_id = channel_router.select_for_chat(
+                    requested_model, chat_id, adaptive=bool(model.enable_adaptive_balancing)
+                )
+                sticky_routing = True
                 if not channel:
                     raise HTTPException(
                         status_code=400,
@@ -525,6 +552,21 @@ async def create_streaming_message(
                 channel_id = channel.id
                 api_base_url = channel.base_url
                 api_key = channel.api_key
+                # 路由表中已预先应用渠道的模型重定向
+                base_model_name = channel.upstream_model
+                # 首选渠道失败时按权重依次尝试同一模型的其他渠道
+                upstream_routes = channel_router.failover_routes(
+                    requested_model, channel, CHANNEL_FAILOVER_MAX_ATTEMPTS
+                )
+                # 故障转移 / 对冲的渠道发送同一份裁剪后的提示词，按其中最小的上限裁剪
+                max_context_tokens = min((
+                    limit for limit in (
+                        resolve_max_context_tokens(route.max_context_tokens, model.max_context_tokens)
+                        for route in upstream_routes
+                    ) if limit
+                ), default=None)
+                hedging_enabled = bool(model.enable_hedging)
+                response_cache_enabled = bool(model.enable_response_cache)
 
             # 检查聊天所属权
             chat = db.query(Chat).filter(
@@ -538,7 +580,7 @@ async def create_streaming_message(
                 )
 
             # 检查系统设置和违禁词
-            settings = db.query(SystemSettings).first()
+            settings = settings_cache.get()
             if not settings:
                 raise HTTPException(
                     status_code=500,
@@ -600,15 +642,13 @@ async def create_streaming_message(
                     Message.chat_id == chat_id,
                     Message.created_at >= regenerate_timestamp
                 ).delete(synchronize_session='fetch')
+                chat_compactor.invalidate(db, chat_id, regenerate_message.id)
 
                 content = original_message.content
-                try:
-                    parsed_content = json.loads(content)
-                    content_for_model = content
-                except json.JSONDecodeError:
-                    content_for_model = content
-                    
+                content_for_model = content
+
                 db.commit()
+                chat_context_cache.invalidate(chat_id)
 
             elif edit_message_id:
                 original_message = db.query(Message).filter(
@@ -628,50 +668,44 @@ async def create_streaming_message(
                     Message.created_at > original_message.created_at
                 ).delete(synchronize_session=False)
 
+                chat_compactor.invalidate(db, chat_id, original_message.id)
                 original_message.content = content_for_model
+                original_message.token_count = await count_message_content_tokens_async(content_for_model, requested_model)
                 original_message.created_at = datetime.now(TIMEZONE)
                 db.commit()
+                chat_context_cache.invalidate(chat_id)
 
             else:
                 original_message = Message(
                     chat_id=chat_id,
                     role="user",
                     content=content_for_model,
+                    token_count=await count_message_content_tokens_async(content_for_model, requested_model),
                     created_at=datetime.now(TIMEZONE)
                 )
                 db.add(original_message)
                 db.commit()
                 db.refresh(original_message)
+                chat_context_cache.append(chat_id, original_message)
 
-            # 获取聊天历史
-            chat_history = db.query(Message).filter(
-                Message.chat_id == chat_id,
-                Message.created_at <= original_message.created_at
-            ).order_by(Message.created_at.asc()).all()
+            # 获取聊天历史（命中缓存时不再查询和解析整个会话）
+            history = chat_context_cache.context(db, chat_id, original_message)
 
-            messages = []
-            for msg in chat_history:
-                try:
-                    parsed_content = json.loads(msg.content)
-                    if isinstance(parsed_content, list):
-                        messages.append({
-                            "role": msg.role,
-                            "content": parsed_content
-                        })
-                    else:
-                        messages.append({
-                            "role": msg.role,
-                            "content": msg.content
-                        })
-                except json.JSONDecodeError:
-                    messages.append({
-                        "role": msg.role,
-                        "content": msg.content
-                    })
+            # 已压缩的较早消息用摘要代替；未压缩部分过长时安排后台压缩
+            history = chat_compactor.apply(history, chat_compactor.load_summary(db, chat_id))
+            if chat_compactor.enabled and estimate_prompt_tokens(history.token_counts) > CHAT_COMPACTION_TRIGGER_TOKENS:
+                chat_compactor.schedule(chat_id)
+            messages, token_counts = history.messages, history.token_counts
+
+            # 按 tokens 预算裁剪历史（只对已存储的计数求和，不重新编码）
+            window = apply_context_window(messages, token_counts, max_context_tokens)
+            if window.dropped:
+                print(f"上下文窗口: 裁掉 {window.dropped} 条较早的消息, 预计提示词 tokens {window.prompt_tokens}/{max_context_tokens}")
+            messages, token_counts = window.messages, window.token_counts
 
             try:
                 print("计算历史消息的 tokens...")
-                chat_metrics.calculate_history_tokens(messages)
+                chat_metrics.calculate_history_tokens(messages, token_counts)
                 print(f"提示词 tokens 数量: {chat_metrics.prompt_tokens}")
             except Exception as e:
                 print(f"计算 tokens 时出错: {str(e)}")
@@ -689,73 +723,299 @@ async def create_streaming_message(
             db.commit()
             db.refresh(assistant_message)
 
-            # 创建 OpenAI 客户端
-            client = OpenAI(
-                base_url=f"{api_base_url}/v1",
-                api_key=api_key
-            )
+            # 市场模型 / 私有模型只有一个上游
+            if not upstream_routes:
+                upstream_routes = [ChannelRoute(
+                    id=None,
+                    channel_name="",
+                    base_url=api_base_url,
+                    api_key=api_key,
+                    weight=1.0,
+                    upstream_model=base_model_name or requested_model
+                )]
 
             print("\n发送请求到模型:")
             print(f"- Base URL: {api_base_url}")
             print(f"- Model: {base_model_name or requested_model}")
+
+            async def record_ai_output_violation(output: str, matched_words: List[str]):
+                """流式审核命中时立即记录违规对话"""
+                violation_db = SessionLocal()
+                try:
+                    await log_dangerous_chat_with_context(
+                        db=violation_db,
+                        user_id=user_id,
+                        content=output,
+                        matched_words=matched_words,
+                        chat_id=chat_id,
+                        ip_address=request.client.host,
+                        user_agent=request.headers.get("user-agent", ""),
+                        request_data={
+                            "chat_id": chat_id,
+                            "is_ai_response": True,
+                            "model": requested_model,
+                            "original_request": content,
+                            "stream_aborted": True
+                        }
+                    )
+                except Exception as violation_error:
+                    print(f"记录违规输出失败: {str(violation_error)}")
+                finally:
+                    violation_db.close()
+
             try:
-                response = client.chat.completions.create(
-                    model=base_model_name or requested_model,
-                    messages=messages,
-                    stream=True
-                )
-                async def iterate_openai_response():
-                    nonlocal accumulated_content
+                # 故障转移：还没有向客户端发送任何数据，上游出错或在 TTFB 期限内没有返回第一个 token 时换下一个渠道
+                # 模型开启对冲时，首选渠道超过其 TTFT 分位数仍未返回则同时请求下一个渠道，先返回的胜出
+                async def open_route(route: ChannelRoute):
+                    # 负载均衡：连接期间和流式输出期间都计入该渠道的进行中请求，连接关闭时释放
+                    channel_balancer.begin(route.id)
+                    # 熔断：半开状态的渠道只有一个探测请求，结果决定恢复还是继续熔断
+                    probe = circuit_breaker.begin(route.id)
+                    started = time.monotonic()
                     try:
-                        for chunk in response:
+                        stream, first_chunk = await asyncio.wait_for(
+                            open_upstream_stream(route.base_url, route.api_key, route.upstream_model, messages, upstream_params),
+                            timeout=CHANNEL_FAILOVER_TTFB_TIMEOUT
+                        )
+                    except asyncio.CancelledError:
+                        # 对冲中落后被取消，不算渠道的错误
+                        channel_balancer.end(route.id)
+                        circuit_breaker.release(route.id, probe)
+                        raise
+                    except Exception as open_error:
+                        channel_balancer.end(route.id)
+                        # 请求本身有问题（4xx）说明渠道可用
+                        failed = is_retryable_upstream_error(open_error)
+                        if failed:
+                            channel_balancer.record_failure(route.id)
+                        circuit_breaker.record(route.id, failed, probe, upstream_error_message(open_error)[:200])
+                        raise
+                    channel_balancer.record_success(route.id, time.monotonic() - started)
+                    circuit_breaker.record(route.id, False, probe)
+                    stream.on_close = lambda: channel_balancer.end(route.id)
+                    return stream, first_chunk
+
+                async def log_abandoned_attempt(route: ChannelRoute, number: int, response_text: str, error: Dict):
+                    await log_ai_request(
+                        db=db,
+                        user_id=user_id,
+                        model_name=requested_model,
+                        channel_id=route.id,
+                        streaming=True,
+                        first_token_latency=None,
+                        total_latency=(time.time() - upstream_started) * 1000,
+                        prompt_tokens=0,
+                        completion_tokens=0,
+                        request_text=content,
+                        response_text=response_text,
+                        error=json.dumps(error),
+                        attempt=number
+                    )
+
+                # 回复缓存：命中时不请求上游，直接回放缓存的 SSE 帧；重新生成时跳过查找（但仍写入新的回复）
+                cache_key = None
+                cached = None
+                if response_cache_enabled:
+                    cache_key = response_cache_key(upstream_routes[0].upstream_model, messages, upstream_params)
+                    if not regenerate_message_id:
+                        cached = response_cache.get(cache_key)
+                    if cached is not None:
+                        print(f"命中回复缓存: {cache_key[:16]}")
+
+                # 相同请求合并：相同的请求正在进行时共享它的上游流，不再单独请求上游
+                # 重新生成要的是新的回复，和跳过缓存查找一样不参与合并
+                attempt = 0
+                flight_subscriber = None
+                flight_leader = False
+                while cache_key is not None and cached is None and not regenerate_message_id:
+                    flight_subscriber, flight_leader = single_flight.join(cache_key)
+                    if flight_leader:
+                        break
+                    try:
+                        flight_route = await flight_subscriber.wait_ready()
+                    except FlightAbandoned:
+                        continue
+                    print(f"合并到进行中的相同请求: {cache_key[:16]}")
+                    channel_id = flight_route.id
+                    api_base_url = flight_route.base_url
+                    break
+                coalesced = flight_subscriber is not None and not flight_leader
+
+                route_index = 0
+                response = None
+                first_chunk = None
+                try:
+                    while response is None and cached is None and not coalesced:
+                        route = upstream_routes[route_index]
+                        backup = None
+                        if hedging_enabled and route_index + 1 < len(upstream_routes):
+                            backup = upstream_routes[route_index + 1]
+                        upstream_started = time.time()
+                        outcome = await upstream_hedger.race(route, backup, open_route)
+                        route_index += 2 if outcome.hedged else 1
+
+                        for failed_route, failed_error in outcome.failures:
+                            attempt += 1
+                            if sticky_routing and failed_route.id == pinned_channel_id:
+                                channel_router.affinity.forget(chat_id, requested_model)
+                            channel_id = failed_route.id
+                            api_base_url = failed_route.base_url
+                            is_last = failed_route is outcome.failures[-1][0]
+                            if outcome.route is None and is_last and (
+                                route_index >= len(upstream_routes) or not is_retryable_upstream_error(failed_error)
+                            ):
+                                raise failed_error
+                            print(f"渠道 {failed_route.channel_name} 第 {attempt} 次尝试失败: {upstream_error_message(failed_error)}")
+                            await log_abandoned_attempt(failed_route, attempt, "[Failover]", {
+                                "type": "failover",
+                                "message": upstream_error_message(failed_error),
+                                "status": upstream_error_status(failed_error)
+                            })
+
+                        if outcome.cancelled is not None:
+                            attempt += 1
+                            print(f"对冲请求: 渠道 {outcome.route.channel_name} 先返回，取消渠道 {outcome.cancelled.channel_name}")
+                            await log_abandoned_attempt(outcome.cancelled, attempt, "[Hedge Cancelled]", {
+                                "type": "hedge_cancelled",
+                                "winner_channel_id": outcome.route.id
+                            })
+
+                        if outcome.route is not None:
+                            attempt += 1
+                            channel_id = outcome.route.id
+                            api_base_url = outcome.route.base_url
+                            response = outcome.response
+                            first_chunk = outcome.first_chunk
+                except BaseException as upstream_error:
+                    # 带头的请求没能连上上游：等待合并的请求收到同样的错误（被取消时它们会重新加入或自己带头）
+                    if flight_leader:
+                        flight_subscriber.flight.fail(upstream_error)
+                    raise
+                # 命中缓存时没有请求上游，不刷新粘性记录
+                affinity_hit = None
+                if sticky_routing and cached is None and channel_id is not None:
+                    channel_router.affinity.remember(chat_id, requested_model, channel_id)
+                    if pinned_channel_id is not None:
+                        affinity_hit = channel_id == pinned_channel_id
+                if flight_leader:
+                    # 上游连接交给合并负责读取和关闭，本请求和其他请求一样从自己的缓冲区读取
+                    flight_subscriber.flight.start(outcome.route, response, first_chunk)
+
+                async def produce_openai_response(generation):
+                    """在后台任务中读取上游：帧编号后写入续传缓冲区，客户端断开不影响生成（超过宽限期才取消）"""
+                    nonlocal accumulated_content
+                    # 输出审核：逐帧扫描，命中后立即终止流并取消上游请求
+                    moderator = forbidden_matcher.stream_moderator() if settings.enableForbiddenWords else None
+                    moderation_hit = None
+                    # 上游的 SSE 帧原样转发（只加上事件编号），解析出的增量内容只用于审核、保存和统计
+                    parser = SSEFrameParser()
+                    deltas = StreamDeltas()
+                    client_disconnected = False
+                    stream_error_info = None  # 流式输出中途失败（上游出错、合并中被移出等），回复不完整
+
+                    # 回复完整结束时写入缓存的帧（超过单条上限后不再收集）
+                    cache_frames = [] if cache_key is not None and cached is None and not coalesced else None
+                    cache_size = 0
+
+                    async def relay_batches():
+                        if cached is not None:
+                            yield cached.data
+                            return
+                        source = flight_subscriber if flight_subscriber is not None else iterate_with_first(first_chunk, response)
+                        async for chunk in source:
                             if chunk:
-                                chunk_dict = {
-                                    "id": chunk.id,
-                                    "object": chunk.object,
-                                    "created": chunk.created,
-                                    "model": chunk.model,
-                                    "choices": [{
-                                        "index": choice.index,
-                                        "delta": {
-                                            "content": choice.delta.content,
-                                            "role": choice.delta.role
-                                        } if choice.delta else {},
-                                        "finish_reason": choice.finish_reason
-                                    } for choice in chunk.choices],
-                                    "usage": chunk.usage.model_dump() if chunk.usage else None
-                                }
-                                
-                                if chunk.choices[0].delta and chunk.choices[0].delta.content:
-                                    accumulated_content += chunk.choices[0].delta.content
-                                    if not chat_metrics.has_received_first_token:
-                                        chat_metrics.record_first_token()
+                                yield parser.complete(chunk)
+                        yield parser.flush_bytes()
 
-                                yield f"data: {json.dumps(chunk_dict)}\n\n"
-                                
-                        yield "data: [DONE]\n\n"
+                    try:
+                        async for data in relay_batches():
+                            if not data:
+                                continue
+                            frames = split_frames(data)
+                            for index, frame in enumerate(frames):
+                                payload = frame_payload(frame)
+                                delta_content = deltas.delta(payload) if payload is not None else None
+                                if not delta_content:
+                                    continue
+                                if moderator is not None:
+                                    matched_words = moderator.feed(delta_content)
+                                    if matched_words:
+                                        moderation_hit = matched_words
+                                        await record_ai_output_violation(
+                                            deltas.text() + delta_content, matched_words
+                                        )
+                                        generation.publish(frames[:index] + [
+                                            sse_event({'error': {'type': 'forbidden_words', 'message': 'Response contains forbidden words'}}),
+                                            SSE_DONE
+                                        ])
+                                        return
+                                deltas.append(delta_content)
+                                if not chat_metrics.has_received_first_token:
+                                    chat_metrics.record_first_token()
+
+                            if deltas.usage:
+                                chat_metrics.apply_usage(deltas.usage)
+                            generation.publish(frames)
+                            if cache_frames is not None:
+                                cache_frames.extend(frames)
+                                cache_size += len(data)
+                                if cache_size > response_cache.max_entry_bytes:
+                                    cache_frames = None
+
+                        if not deltas.done:
+                            generation.publish([SSE_DONE])
+                        elif cache_frames is not None and deltas.text() and deltas.error is None:
+                            # 故障转移 / 对冲时回复可能来自重定向到其他上游模型的渠道，按实际的上游模型写入
+                            served_model = outcome.route.upstream_model
+                            served_key = cache_key if served_model == upstream_routes[0].upstream_model \
+                                else response_cache_key(served_model, messages, upstream_params)
+                            response_cache.put(served_key, b"".join(cache_frames), served_model)
+
+                    except asyncio.CancelledError:
+                        # 客户端断开且宽限期内没有重连：不再读取上游，finally 中关闭连接并保存已生成的部分
+                        client_disconnected = True
+                        print(f"客户端已断开，取消上游生成（已生成 {deltas.chars} 字符）")
+                        raise
 
                     except Exception as stream_error:
                         print(f"流处理异常: {str(stream_error)}")
                         print(f"错误详情: {traceback.format_exc()}")
-                        yield "data: [DONE]\n\n"
+                        stream_error_info = {
+                            "type": "single_flight_overflow" if isinstance(stream_error, SingleFlightOverflow) else "stream_interrupted",
+                            "message": upstream_error_message(stream_error)
+                        }
+                        if not deltas.done:
+                            # 告诉客户端回复被截断，而不是当作正常结束
+                            generation.publish([sse_event({'error': stream_error_info}), SSE_DONE])
                     
                     finally:
+                        # 释放上游连接（归还连接池，不关闭共享客户端）；合并的上游流在所有请求都离开后由合并关闭
+                        if flight_subscriber is not None:
+                            flight_subscriber.close()
+                        elif response is not None:
+                            try:
+                                await response.close()
+                            except Exception as close_error:
+                                print(f"关闭上游连接失败: {str(close_error)}")
+
                         # 保存回复内容和更新统计
-                        if accumulated_content:
+                        accumulated_content = deltas.text()
+                        context_appended = False
+                        if accumulated_content or moderation_hit or client_disconnected or stream_error_info:
                             try:
                                 new_db = SessionLocal()
                                 try:
                                     # 计算完成后的tokens
-                                    chat_metrics.update_completion(accumulated_content)
+                                    await chat_metrics.update_completion_async(accumulated_content)
                                     
                                     # 重新查询消息和设置
-                                    current_settings = new_db.query(SystemSettings).first()
+                                    current_settings = settings_cache.get()
                                     assistant_msg = new_db.query(Message).filter(
                                         Message.id == assistant_message.id
                                     ).first()
 
-                                    # 检查是否需要检查AI输出的违禁词
-                                    if current_settings and current_settings.enableForbiddenWords:
+                                    # 检查是否需要检查AI输出的违禁词（流式审核已处理过的跳过）
+                                    if not moderation_hit and current_settings and current_settings.enableForbiddenWords:
                                         has_forbidden, matched_words = await check_ai_output_forbidden_words(accumulated_content, new_db)
                                         if has_forbidden:
                                             await log_dangerous_chat_with_context(
@@ -777,8 +1037,13 @@ async def create_streaming_message(
                                     # 更新助手消息内容
                                     if assistant_msg:
                                         assistant_msg.content = accumulated_content
+                                        assistant_msg.token_count = max(
+                                            0, chat_metrics.completion_tokens - chat_metrics.reasoning_tokens
+                                        )
                                         new_db.add(assistant_msg)
                                         new_db.commit()
+                                        chat_context_cache.append(chat_id, assistant_msg)
+                                        context_appended = True
 
                                     # 记录API使用日志
                                     metrics = chat_metrics.get_metrics()
@@ -788,13 +1053,24 @@ async def create_streaming_message(
                                         model_name=requested_model,
                                         channel_id=channel_id,
                                         streaming=True,
-                                        first_token_latency=metrics["first_token_latency"],
-                                        total_latency=metrics["total_latency"],
+                                        # 命中缓存时没有上游延迟；合并的请求记录自己等待的延迟
+                                        first_token_latency=0 if cached is not None else metrics["first_token_latency"],
+                                        total_latency=0 if cached is not None else metrics["total_latency"],
                                         prompt_tokens=chat_metrics.prompt_tokens,
                                         completion_tokens=chat_metrics.completion_tokens,
                                         request_text=content,
                                         response_text=accumulated_content,
-                                        error=None
+                                        error=json.dumps({
+                                            "type": "forbidden_words",
+                                            "matched_words": moderation_hit
+                                        }, ensure_ascii=False) if moderation_hit else (
+                                            json.dumps(stream_error_info, ensure_ascii=False) if stream_error_info else None
+                                        ),
+                                        attempt=attempt or None,
+                                        cancelled=client_disconnected,
+                                        cache_hit=cached is not None,
+                                        coalesced=coalesced,
+                                        affinity_hit=affinity_hit
                                     )
                                     
                                 except Exception as db_error:
@@ -808,15 +1084,21 @@ async def create_streaming_message(
                                 print(f"最终处理失败: {str(final_error)}")
                                 print(f"错误详情: {traceback.format_exc()}")
 
-                return StreamingResponse(
-                    iterate_openai_response(),
-                    media_type="text/event-stream"
+                        # 回复未能写入缓存时丢弃该会话的上下文缓存，下次从数据库重建
+                        if not context_appended:
+                            chat_context_cache.invalidate(chat_id)
+
+                generation = stream_registry.start(user_id, chat_id, produce_openai_response)
+                return SSEStreamingResponse(
+                    generation.subscribe(),
+                    media_type="text/event-stream",
+                    headers={**rate_limit_headers, "X-Generation-Id": generation.id}
                 )
 
             except Exception as api_error:
-                error_message = str(api_error)
+                error_message = upstream_error_message(api_error)
                 error_response = getattr(api_error, 'response', None)
-                error_status = getattr(error_response, 'status_code', 500) if error_response else 500
+                error_status = upstream_error_status(api_error)
                 error_detail = None
 
                 try:
@@ -844,7 +1126,9 @@ async def create_streaming_message(
                             "message": error_message,
                             "status": error_status,
                             "detail": error_detail
-                        })
+                        }),
+                        attempt=attempt,
+                        affinity_hit=(channel_id == pinned_channel_id) if pinned_channel_id is not None else None
                     )
                 except Exception as log_error:
                     print(f"记录API错误日志失败: {str(log_error)}")
@@ -859,6 +1143,7 @@ async def create_streaming_message(
                         assistant_message.content = f"```\n{error_formatted}\n```"
                         db.add(assistant_message)
                         db.commit()
+                        chat_context_cache.invalidate(chat_id)
                     except Exception as msg_error:
                         print(f"更新错误消息失败: {str(msg_error)}")
                         db.rollback()
@@ -892,6 +1177,7 @@ async def create_streaming_message(
                     assistant_message.content = f"```\n{error_formatted}\n```"
                     db.add(assistant_message)
                     db.commit()
+                    chat_context_cache.invalidate(chat_id)
                 except Exception as msg_error:
                     print(f"保存错误消息失败: {str(msg_error)}")
                     db.rollback()
@@ -903,6 +1189,46 @@ async def create_streaming_message(
         print(f"错误详情: {traceback.format_exc()}")
         raise
 
+@router.get("/api/chats/{chat_id}/messages/stream/{generation_id}")
+async def resume_streaming_message(
+    chat_id: int,
+    generation_id: str,
+    request: Request,
+    last_event_id: Optional[int] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    断线重连：补发 Last-Event-ID（请求头或 last_event_id 参数）之后的事件，再继续接收进行中的生成
+    不会再次请求上游；生成结束后缓冲区保留 STREAM_RESUME_RETENTION 秒
+    """
+    generation = stream_registry.get(generation_id)
+    if generation is None or generation.chat_id != chat_id or generation.user_id != current_user.id:
+        raise HTTPException(
+            status_code=404,
+            detail={"error": {"type": "generation_not_found", "message": "Generation not found or expired"}}
+        )
+
+    header_value = request.headers.get("last-event-id")
+    if header_value:
+        try:
+            last_event_id = int(header_value)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    last_event_id = max(0, last_event_id or 0)
+
+    # 需要补发的事件已被环形缓冲区覆盖，只能重新获取消息
+    if not generation.can_resume(last_event_id):
+        raise HTTPException(
+            status_code=409,
+            detail={"error": {"type": "resume_unavailable", "message": "Missed events are no longer buffered"}}
+        )
+
+    return SSEStreamingResponse(
+        stream_registry.resume(generation, last_event_id),
+        media_type="text/event-stream",
+        headers={"X-Generation-Id": generation.id}
+    )
+
 @router.post("/api/chats/with-prompt/{prompt_type}/{prompt_id}")
 async def create_chat_with_prompt(
     prompt_type: str,
@@ -1015,6 +1341,7 @@ async def delete_chat(
     # 删除聊天及其关联的消息
     db.delete(chat)
     db.commit()
+    chat_context_cache.invalidate(chat_id)
     
     return {"message": "Chat deleted"}
 
@@ -0,0 +1,111 @@
+#chat_context.py
+# 会话上下文缓存：按 chat_id 缓存已解析好的历史消息，新消息增量追加，编辑 / 重新生成 / 删除时失效
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from init import *
+from class_model import *
+
+
+class ChatContext:
+    __slots__ = ("messages", "token_counts", "message_ids")
+
+    def __init__(self, messages: List[Dict], token_counts: List[Optional[int]], message_ids: List[int]):
+        self.messages = messages
+        # 与 messages 一一对应的 Message.token_count 和 Message.id
+        self.token_counts = token_counts
+        self.message_ids = message_ids
+
+    @property
+    def last_message_id(self) -> Optional[int]:
+        return self.message_ids[-1] if self.message_ids else None
+
+    def copy(self) -> "ChatContext":
+        return ChatContext(list(self.messages), list(self.token_counts), list(self.message_ids))
+
+
+class ChatContextCache:
+    """
+    - 有界 LRU，按 chat_id 保存发给模型的 messages 列表
+    - append() 只在消息 id 严格递增时追加，否则丢弃该会话的缓存，下次从数据库重建
+    - 同时保存每条消息的 token_count，计算提示词 tokens 时直接求和
+    - 返回的列表是副本，其中的消息字典视为只读
+    """
+
+    def __init__(self, max_chats: int = CHAT_CONTEXT_CACHE_MAX_CHATS):
+        self.max_chats = max_chats
+        self._entries: "OrderedDict[int, ChatContext]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, chat_id: int) -> None:
+        with self._lock:
+            self._entries.pop(chat_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def append(self, chat_id: int, message: Message) -> None:
+        """把刚保存的消息追加到已缓存的上下文；未缓存时什么也不做"""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                return
+            if entry.last_message_id is not None and message.id <= entry.last_message_id:
+                # 顺序无法保证（并发写入同一会话），直接丢弃
+                del self._entries[chat_id]
+                return
+            entry.messages.append({"role": message.role, "content": parse_message_content(message.content)})
+            entry.token_counts.append(message.token_count)
+            entry.message_ids.append(message.id)
+
+    def context(self, db: Session, chat_id: int, upto: Message) -> ChatContext:
+        """
+        返回截至 upto（含）的对话上下文（副本）
+        缓存的最后一条正好是 upto 时直接命中
+        """
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None and entry.last_message_id == upto.id:
+                self._entries.move_to_end(chat_id)
+                self.hits += 1
+                return entry.copy()
+
+        self.misses += 1
+        chat_history = db.query(Message).filter(
+            Message.chat_id == chat_id,
+            Message.created_at <= upto.created_at
+        ).order_by(Message.created_at.asc()).all()
+        messages = [
+            {"role": msg.role, "content": parse_message_content(msg.content)}
+            for msg in chat_history
+        ]
+        # 尚未回填 token_count 的旧消息在这里算一次，之后随缓存复用
+        token_counts = [
+            msg.token_count if msg.token_count is not None else count_message_content_tokens(msg.content)
+            for msg in chat_history
+        ]
+        context = ChatContext(messages, token_counts, [msg.id for msg in chat_history])
+
+        with self._lock:
+            # 只有最后一条就是 upto 时才缓存，否则之后的追加无法保证顺序
+            if context.last_message_id == upto.id:
+                self._entries[chat_id] = context.copy()
+                self._entries.move_to_end(chat_id)
+                while len(self._entries) > self.max_chats:
+                    self._entries.popitem(last=False)
+        return context
+
+    def stats(self) -> Dict:
+        return {
+            "chats": len(self._entries),
+            "max_chats": self.max_chats,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+chat_context_cache = ChatContextCache()
@@ -0,0 +1,265 @@
+#circuit_breaker.py
+# 渠道熔断：连续失败或滑动窗口内失败率过高时把渠道移出路由，冷却后只放行一个探测请求，成功才恢复流量
+# 状态变化写入 ModelHealthCheck（status 为 circuit_open / circuit_half_open / circuit_closed）
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Sequence, Set, Tuple
+
+from init import *
+from class_model import *
+from log_writer import api_log_writer
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class ChannelCircuit:
+    __slots__ = (
+        "state", "consecutive_failures", "window", "window_failures",
+        "open_until", "probe_claimed_at", "probing", "reason", "trips", "changed_at"
+    )
+
+    def __init__(self):
+        self.state = CIRCUIT_CLOSED
+        self.consecutive_failures = 0
+        self.window: Deque[Tuple[float, bool]] = deque()  # (时间, 是否失败)
+        self.window_failures = 0
+        self.open_until = 0.0
+        self.probe_claimed_at = 0.0
+        self.probing = False
+        self.reason: Optional[str] = None
+        self.trips = 0
+        self.changed_at = time.time()
+
+
+class CircuitBreaker:
+    """
+    - 关闭：正常路由；连续失败 consecutive_failures 次，或最近 window 秒内请求数不少于 min_requests
+      且失败率不低于 failure_rate 时熔断（打开）
+    - 打开：不参与路由，冷却 cooldown 秒后下一次选择渠道时把它作为探测请求（半开）
+    - 半开：只有一个探测请求，成功后关闭并恢复流量，失败则重新打开；
+      选中后 probe_timeout 秒内没有真正发出（如命中缓存）时探测资格过期，之后的请求可以重新领取
+    - 一个模型的渠道全部熔断时仍按原来的方式选择，宁可继续尝试也不直接拒绝请求
+    - 只在事件循环中调用，不需要加锁
+    """
+
+    def __init__(
+        self,
+        consecutive_failures: int = CIRCUIT_BREAKER_CONSECUTIVE_FAILURES,
+        window: float = CIRCUIT_BREAKER_WINDOW,
+        min_requests: int = CIRCUIT_BREAKER_MIN_REQUESTS,
+        failure_rate: float = CIRCUIT_BREAKER_FAILURE_RATE,
+        cooldown: float = CIRCUIT_BREAKER_COOLDOWN,
+        probe_timeout: float = CIRCUIT_BREAKER_PROBE_TIMEOUT
+    ):
+        self.consecutive_failures = consecutive_failures
+        self.window = window
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self._circuits: Dict[int, ChannelCircuit] = {}
+        self._ejected: Set[int] = set()  # 不是关闭状态的渠道
+        self.version = 0  # _ejected 每次变化时递增，路由表据此重建去掉熔断渠道的抽样器
+        self._next_probe_at = float("inf")  # 最早可以领取探测资格的时间，之前 claim_probe 直接返回
+
+    def _circuit(self, channel_id: int) -> ChannelCircuit:
+        circuit = self._circuits.get(channel_id)
+        if circuit is None:
+            circuit = self._circuits[channel_id] = ChannelCircuit()
+        return circuit
+
+    # ---------- 路由 ----------
+
+    def routable(self, channel_id: Optional[int]) -> bool:
+        return channel_id not in self._ejected
+
+    def healthy_routes(self, routes: Sequence) -> Optional[List]:
+        """去掉熔断中的渠道；没有渠道被去掉或全部被去掉时返回 None（按原列表选择）"""
+        if not self._ejected:
+            return None
+        healthy = [route for route in routes if route.id not in self._ejected]
+        if not healthy or len(healthy) == len(routes):
+            return None
+        return healthy
+
+    def claim_probe(self, routes: Sequence):
+        """冷却结束的渠道领取探测资格，返回该渠道；没有需要探测的渠道时返回 None"""
+        if not self._ejected:
+            return None
+        now = time.monotonic()
+        if now < self._next_probe_at:
+            return None
+        for route in routes:
+            if route.id not in self._ejected:
+                continue
+            circuit = self._circuits[route.id]
+            if circuit.state == CIRCUIT_OPEN and now >= circuit.open_until:
+                circuit.probe_claimed_at = now
+                self._transition(route.id, circuit, CIRCUIT_HALF_OPEN, f"冷却 {self.cooldown:g} 秒结束，发送探测请求")
+                return route
+            if (
+                circuit.state == CIRCUIT_HALF_OPEN
+                and not circuit.probing
+                and now - circuit.probe_claimed_at >= self.probe_timeout
+            ):
+                circuit.probe_claimed_at = now
+                self._schedule()
+                return route
+        return None
+
+    def _schedule(self) -> None:
+        """重新计算最早可以领取探测资格的时间（只遍历熔断中的渠道）"""
+        next_probe_at = float("inf")
+        for channel_id in self._ejected:
+            circuit = self._circuits[channel_id]
+            if circuit.state == CIRCUIT_OPEN:
+                next_probe_at = min(next_probe_at, circuit.open_until)
+            elif not circuit.probing:
+                next_probe_at = min(next_probe_at, circuit.probe_claimed_at + self.probe_timeout)
+        self._next_probe_at = next_probe_at
+
+    # ---------- 结果 ----------
+
+    def begin(self, channel_id: Optional[int]) -> bool:
+        """向渠道发出请求前调用，返回这次请求是否是半开状态的探测请求"""
+        circuit = self._circuits.get(channel_id)
+        if circuit is None or circuit.state != CIRCUIT_HALF_OPEN or circuit.probing:
+            return False
+        circuit.probing = True
+        self._schedule()
+        return True
+
+    def release(self, channel_id: Optional[int], probe: bool) -> None:
+        """请求被取消（如对冲落后），不计入结果；探测请求被取消时立即允许重新探测"""
+        circuit = self._circuits.get(channel_id)
+        if probe and circuit is not None and circuit.probing:
+            circuit.probing = False
+            circuit.probe_claimed_at = 0.0
+            self._schedule()
+
+    def record(self, channel_id: Optional[int], failed: bool, probe: bool = False, error: Optional[str] = None) -> None:
+        if channel_id is None:
+            return
+        circuit = self._circuit(channel_id)
+        if probe:
+            circuit.probing = False
+            if failed:
+                self._open(channel_id, circuit, f"探测请求失败: {error}" if error else "探测请求失败")
+            else:
+                self._transition(channel_id, circuit, CIRCUIT_CLOSED, "探测请求成功，恢复流量")
+            return
+        if circuit.state != CIRCUIT_CLOSED:
+            # 熔断前已经发出的请求，结果不影响状态
+            return
+
+        now = time.monotonic()
+        circuit.window.append((now, failed))
+        if failed:
+            circuit.window_failures += 1
+        while circuit.window and circuit.window[0][0] < now - self.window:
+            _, old_failed = circuit.window.popleft()
+            if old_failed:
+                circuit.window_failures -= 1
+
+        if not failed:
+            circuit.consecutive_failures = 0
+            return
+        circuit.consecutive_failures += 1
+        if circuit.consecutive_failures >= self.consecutive_failures:
+            self._open(channel_id, circuit, f"连续失败 {circuit.consecutive_failures} 次: {error}" if error
+                       else f"连续失败 {circuit.consecutive_failures} 次")
+            return
+        requests = len(circuit.window)
+        if requests >= self.min_requests and circuit.window_failures / requests >= self.failure_rate:
+            self._open(channel_id, circuit, f"最近 {self.window:g} 秒失败率 {circuit.window_failures / requests:.0%}"
+                       f"（{circuit.window_failures}/{requests}）")
+
+    def reset(self, channel_id: int) -> None:
+        """渠道配置变更或删除后清除状态"""
+        self._circuits.pop(channel_id, None)
+        if channel_id in self._ejected:
+            self._ejected.discard(channel_id)
+            self.version += 1
+            self._schedule()
+
+    # ---------- 状态变化 ----------
+
+    def _open(self, channel_id: int, circuit: ChannelCircuit, reason: str) -> None:
+        circuit.open_until = time.monotonic() + self.cooldown
+        circuit.trips += 1
+        self._transition(channel_id, circuit, CIRCUIT_OPEN, reason)
+
+    def _transition(self, channel_id: int, circuit: ChannelCircuit, state: str, reason: str) -> None:
+        circuit.state = state
+        circuit.reason = reason
+        circuit.changed_at = time.time()
+        if state == CIRCUIT_CLOSED:
+            circuit.consecutive_failures = 0
+            circuit.window.clear()
+            circuit.window_failures = 0
+            self._ejected.discard(channel_id)
+            self.version += 1
+        elif channel_id not in self._ejected:
+            self._ejected.add(channel_id)
+            self.version += 1
+        self._schedule()
+        print(f"渠道 {channel_id} 熔断状态 -> {state}: {reason}")
+        self._save_transition(channel_id, state, reason)
+
+    def _save_transition(self, channel_id: int, state: str, reason: str) -> None:
+        """为绑定该渠道的每个模型写一条 ModelHealthCheck（没有绑定时 model_id 为空），经异步日志队列批量写入"""
+        # routing 依赖本模块，这里延迟导入避免循环引用
+        from routing import channel_router
+
+        try:
+            model_ids = channel_router.model_ids_for_channel(channel_id) or [None]
+        except Exception as e:
+            print(f"查询渠道绑定的模型失败: {str(e)}")
+            model_ids = [None]
+        check_time = datetime.now(TIMEZONE)
+        for model_id in model_ids:
+            api_log_writer.submit({
+                "model_id": model_id,
+                "channel_id": channel_id,
+                "status": f"circuit_{state}",
+                "latency": None,
+                "error_message": reason,
+                "check_time": check_time
+            }, table=ModelHealthCheck)
+
+    # ---------- 管理员视图 ----------
+
+    def describe(self, channel_id: int) -> Dict[str, Any]:
+        circuit = self._circuits.get(channel_id)
+        if circuit is None:
+            return {"state": CIRCUIT_CLOSED, "reason": None, "trips": 0}
+        requests = len(circuit.window)
+        result = {
+            "state": circuit.state,
+            "reason": circuit.reason,
+            "trips": circuit.trips,
+            "changed_at": datetime.fromtimestamp(circuit.changed_at, TIMEZONE).isoformat(),
+            "consecutive_failures": circuit.consecutive_failures,
+            "window_requests": requests,
+            "window_failure_rate": round(circuit.window_failures / requests, 4) if requests else 0.0
+        }
+        if circuit.state == CIRCUIT_OPEN:
+            result["retry_in"] = round(max(0.0, circuit.open_until - time.monotonic()), 1)
+        return result
+
+    def stats(self) -> Dict:
+        return {
+            "channels": len(self._circuits),
+            "ejected": sorted(self._ejected),
+            "trips": sum(circuit.trips for circuit in self._circuits.values()),
+            "consecutive_failures": self.consecutive_failures,
+            "window": self.window,
+            "min_requests": self.min_requests,
+            "failure_rate": self.failure_rate,
+            "cooldown": self.cooldown
+        }
+
+
+circuit_breaker = CircuitBreaker()
@@ -83,7 +83,7 @@ from typing import (
     AsyncGenerator,
     Any
 )
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 ################################################
 # 枚举类型处理
 ################################################
@@ -126,6 +126,11 @@ import base64
 from database import Base, engine, SessionLocal
 
 from init import *
+from settings_cache import settings_cache
+from principal import resolve_principal
+from log_writer import api_log_writer
+from forbidden_matcher import forbidden_matcher
+from tokenizer import tokenizer, estimate_tokens
 
 # 2. 添加 GitHub 用户信息模型
 class GitHubUserInfo(BaseModel):
@@ -263,9 +268,23 @@ class Message(Base):
     content = Column(String)
     model_name = Column(String, nullable=True)
     edit_message_id = Column(Integer, nullable=True)
+    token_count = Column(Integer, nullable=True)  # 内容的 tokens 数，写入时计算，助手消息优先使用上游 usage
     created_at = Column(DateTime, default=lambda: datetime.now(TIMEZONE))
 
 
+class ChatSummary(Base):
+    """会话压缩后的滚动摘要：覆盖 upto_message_id（含）之前、系统提示词之后的全部消息"""
+    __tablename__ = "chat_summaries"
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(Integer, ForeignKey("chats.id"), unique=True, index=True)
+    content = Column(String)
+    upto_message_id = Column(Integer)
+    token_count = Column(Integer, nullable=True)
+    model_name = Column(String, nullable=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(TIMEZONE))
+    updated_at = Column(DateTime, default=lambda: datetime.now(TIMEZONE), onupdate=lambda: datetime.now(TIMEZONE))
+
+
 
 # 定义所有关系
 User.folders = relationship("Folder", back_populates="user")
@@ -276,6 +295,7 @@ Chat.user = relationship("User", back_populates="chats")
 Chat.folder = relationship("Folder", back_populates="chats")
 Chat.messages = relationship("Message", back_populates="chat", cascade="all, delete-orphan")
 Message.chat = relationship("Chat", back_populates="messages")
+Chat.summary = relationship("ChatSummary", uselist=False, cascade="all, delete-orphan")
 
 
 # 2. 创建一个不包含 created_at 的登录响应模型
@@ -327,6 +347,10 @@ class AIModel(Base):
     is_active = Column(Boolean, default=True)
     is_deleted = Column(Boolean, default=False)
     sort_order = Column(Integer, default=0)  # Add sort_order field
+    max_context_tokens = Column(Integer, nullable=True)  # 发给上游的提示词 tokens 上限，为空时使用全局默认
+    enable_hedging = Column(Boolean, nullable=True, default=False)  # 首选渠道慢时向第二个渠道发送对冲请求
+    enable_response_cache = Column(Boolean, nullable=True, default=False)  # 相同请求直接回放缓存的回复
+    enable_adaptive_balancing = Column(Boolean, nullable=True, default=False)  # 按渠道实时延迟 / 错误率 / 负载调整权重
     
     channels = relationship("Channel", back_populates="model")
     price = relationship("ModelPrice", back_populates="model", uselist=False)
@@ -401,6 +425,7 @@ class Channel(Base):
     created_at = Column(DateTime, default=lambda: datetime.now(TIMEZONE))
     organization = Column(String, nullable=True)
     redirect_mapping = Column(String, nullable=True)
+    max_context_tokens = Column(Integer, nullable=True)  # 渠道的提示词 tokens 上限，优先于模型配置
     
     model = relationship("AIModel", back_populates="channels")
 
@@ -442,6 +467,11 @@ class AIRequestLog(Base):
     response_text = Column(String)  # 补全响应
     
     error = Column(String, nullable=True)
+    attempt = Column(Integer, nullable=True)  # 故障转移中的第几次尝试（从 1 开始）
+    cancelled = Column(Boolean, nullable=True, default=False)  # 客户端中途断开，已取消上游生成
+    cache_hit = Column(Boolean, nullable=True, default=False)  # 命中回复缓存，没有请求上游
+    coalesced = Column(Boolean, nullable=True, default=False)  # 与进行中的相同请求共享上游流，没有单独请求上游
+    affinity_hit = Column(Boolean, nullable=True)  # 会话粘性路由：True 沿用了上一轮的渠道，False 原渠道不可用已换渠道，空表示没有粘性记录
     created_at = Column(DateTime, default=lambda: datetime.now(TIMEZONE))
     
     # 关系
@@ -1346,136 +1376,139 @@ class AIRequestLogResponse(BaseModel):
     request_text: str = ""
     response_text: str = ""
     error: Optional[str] = None
+    attempt: Optional[int] = None
+    cancelled: Optional[bool] = False
+    cache_hit: Optional[bool] = False
+    coalesced: Optional[bool] = False
+    affinity_hit: Optional[bool] = None
     created_at: datetime
 
     class Config:
         from_attributes = True
 
-class APILoggingMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        start_time = time.time()
-        response_status = 500  # 默认状态码
-        response_data = None
-        
+class APILoggingMiddleware:
+    """
+    纯 ASGI 日志中间件
+    - 请求体 / 响应体在流经时只截取前 API_LOG_MAX_BODY_BYTES 字节，不缓冲完整内容
+    - SSE 响应在响应头发出时记录，之后的数据块原样透传
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
         # 检查是否启用日志记录
-        db = SessionLocal()
         try:
-            settings = db.query(SystemSettings).first()
+            settings = settings_cache.get()
             enable_logging = settings.enableSystemLogs if settings else True
         except Exception as e:
             print(f"Error checking logging settings: {str(e)}")
             enable_logging = True  # 如果出错，默认启用日志
-        finally:
-            db.close()
 
-        # 如果未启用日志记录，直接调用下一个中间件
-        if not enable_logging:
-            return await call_next(request)
-            
-        # 获取请求信息
-        try:
-            raw_body = await request.body()
-            request_data = raw_body.decode() if raw_body else None
-            headers = dict(request.headers)
-            headers.pop('authorization', None)  # 移除敏感信息
-            request_headers = json.dumps(headers)
-        except:
-            request_data = None
-            request_headers = None
+        # 如果未启用日志记录或未被采样，直接调用下一个中间件
+        if not enable_logging or not api_log_writer.should_log(scope["path"]):
+            await self.app(scope, receive, send)
+            return
 
-        # 获取用户ID
-        user_id = None
-        try:
-            token = request.headers.get('authorization', '').split('Bearer ')[-1]
-            if token and token != 'Bearer':
-                payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-                username = payload.get("sub")
-                if username:
-                    db = SessionLocal()
-                    user = db.query(User).filter(User.username == username).first()
-                    if user:
-                        user_id = user.id
-                    db.close()
-        except:
-            pass
+        start_time = time.time()
+        max_bytes = api_log_writer.max_body_bytes
+        request_body = bytearray()
+        response_body = bytearray()
+        state = {"status": 500, "started": False, "streaming": False}
+
+        request = Request(scope)
+        log_row = {
+            "user_id": self._get_user_id(request),
+            "endpoint": scope["path"],
+            "method": scope["method"],
+            "request_headers": self._get_request_headers(request),
+            "ip_address": scope["client"][0] if scope.get("client") else None,
+            "user_agent": request.headers.get('user-agent'),
+        }
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request" and len(request_body) < max_bytes:
+                request_body.extend(message.get("body", b"")[:max_bytes - len(request_body)])
+            return message
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["started"] = True
+                state["status"] = message["status"]
+                for key, value in message.get("headers", ()):
+                    if key.lower() == b"content-type" and b"text/event-stream" in value:
+                        # 流式响应：立即记录，不再观察后续数据块
+                        state["streaming"] = True
+                        api_log_writer.submit({
+                            **log_row,
+                            "request_data": api_log_writer.capture(bytes(request_body)),
+                            "response_status": state["status"],
+                            "timestamp": datetime.now(TIMEZONE)
+                        })
+                        break
+            elif (
+                message["type"] == "http.response.body"
+                and not state["streaming"]
+                and len(response_body) < max_bytes
+            ):
+                response_body.extend(message.get("body", b"")[:max_bytes - len(response_body)])
+            await send(message)
 
         error = None
-        response = None
         try:
-            response = await call_next(request)
-            response_status = response.status_code
-            
-            # 检测是否为流式响应
-            content_type = response.headers.get('Content-Type', '')
-            if 'text/event-stream' in content_type:
-                if not request.url.path.startswith('/api/admin/logs'):
-                    try:
-                        db = SessionLocal()
-                        log_entry = APILog(
-                            user_id=user_id,
-                            endpoint=request.url.path,
-                            method=request.method,
-                            request_data=request_data,
-                            request_headers=request_headers,
-                            response_status=response_status,
-                            ip_address=request.client.host,
-                            user_agent=request.headers.get('user-agent'),
-                            timestamp=datetime.now(TIMEZONE)
-                        )
-                        db.add(log_entry)
-                        db.commit()
-                    except Exception as e:
-                        print(f"Error logging streaming request: {str(e)}")
-                    finally:
-                        db.close()
-                return response
-            
-            # 处理普通响应
-            response_body = [section async for section in response.body_iterator]
-            response.body_iterator = iterate_in_threadpool(iter(response_body))
-            
-            try:
-                response_data = response_body[0].decode() if response_body else None
-            except:
-                response_data = None
-                
+            await self.app(scope, receive_wrapper, send_wrapper)
         except Exception as e:
             error = str(e)
-            response_data = str(e)
-            
+            if state["started"]:
+                raise
+            await JSONResponse(
+                status_code=500,
+                content={"detail": "Internal server error"}
+            )(scope, receive, send)
         finally:
-            end_time = time.time()
-            response_time = (end_time - start_time) * 1000  # 转换为毫秒
-            
-            if not request.url.path.startswith('/api/admin/logs'):
-                try:
-                    db = SessionLocal()
-                    log_entry = APILog(
-                        user_id=user_id,
-                        endpoint=request.url.path,
-                        method=request.method,
-                        request_data=request_data,
-                        request_headers=request_headers,
-                        response_status=response_status,
-                        response_data=response_data,
-                        response_time=response_time,
-                        ip_address=request.client.host,
-                        user_agent=request.headers.get('user-agent'),
-                        error=error,
-                        timestamp=datetime.now(TIMEZONE)
-                    )
-                    db.add(log_entry)
-                    db.commit()
-                except Exception as e:
-                    print(f"Error logging request: {str(e)}")
-                    db.rollback()
-                finally:
-                    db.close()
-
-        return response if response else JSONResponse(
-            status_code=response_status,
-            content={"detail": "Internal server error"}
-        )
+            if not state["streaming"]:
+                api_log_writer.submit({
+                    **log_row,
+                    "request_data": api_log_writer.capture(bytes(request_body)),
+                    "response_status": state["status"],
+                    "response_data": error if error else api_log_writer.capture(bytes(response_body)),
+                    "response_time": (time.time() - start_time) * 1000,  # 转换为毫秒
+                    "error": error,
+                    "timestamp": datetime.now(TIMEZONE)
+                })
+
+    @staticmethod
+    def _get_request_headers(request: Request) -> Optional[str]:
+        try:
+            headers = dict(request.headers)
+            headers.pop('authorization', None)  # 移除敏感信息
+            return json.dumps(headers)
+        except Exception:
+            return None
+
+    @staticmethod
+    def _get_user_id(request: Request) -> Optional[int]:
+        """获取用户ID（解析结果存入 request.state，后续依赖直接复用）"""
+        try:
+            principal = resolve_principal(request)
+            if not principal:
+                return None
+            if principal.user_id is not None:
+                return principal.user_id
+            # 旧令牌没有 uid 声明
+            db = SessionLocal()
+            try:
+                user = db.query(User).filter(User.username == principal.username).first()
+                return user.id if user else None
+            finally:
+                db.close()
+        except Exception:
+            return None
 
 
 # 更新 UserCreate 模型
@@ -1598,6 +1631,10 @@ class ModelResponse(ModelBase):
     icon: Optional[str] = None
     price: Optional[ModelPriceResponse] = None
     sort_order: int = 0
+    max_context_tokens: Optional[int] = None
+    enable_hedging: Optional[bool] = False
+    enable_response_cache: Optional[bool] = False
+    enable_adaptive_balancing: Optional[bool] = False
     channel_bindings: List[ModelChannelBindingResponse] = []
 
     class Config:
@@ -1627,6 +1664,7 @@ class ChannelCreate(BaseModel):
     weight: float = 1.0
     is_active: bool = True
     organization: Optional[str] = None
+    max_context_tokens: Optional[int] = None
 
 class ChannelUpdate(BaseModel):
     channel_name: Optional[str] = None
@@ -1639,6 +1677,7 @@ class ChannelUpdate(BaseModel):
     organization: Optional[str] = None
     target_model_id: Optional[int] = None
     redirect_mapping: Optional[str] = None  # 改名
+    max_context_tokens: Optional[int] = None
 
 class ChannelResponse(BaseModel):
     id: int
@@ -1652,6 +1691,8 @@ class ChannelResponse(BaseModel):
     created_at: datetime
     organization: Optional[str] = None
     redirect_mapping: Optional[str] = None
+    max_context_tokens: Optional[int] = None
+    circuit_breaker: Optional[Dict[str, Any]] = None  # 熔断状态（只在渠道列表中返回）
 
     class Config:
         from_attributes = True
@@ -1781,6 +1822,68 @@ class StreamingMetrics:
         }
     
 
+def parse_message_content(content: Optional[str]) -> Any:
+    """
+    多模态消息以 JSON 数组存储，其余按纯文本处理
+    只有以 '[' 开头的内容才尝试解析，纯文本不再走异常分支
+    """
+    if content and content[0] == "[":
+        try:
+            parsed = json.loads(content)
+        except json.JSONDecodeError:
+            return content
+        if isinstance(parsed, list):
+            return parsed
+    return content
+
+
+def _content_texts(content: Any) -> Tuple[List[str], int]:
+    """拆出消息内容中需要编码的文本，以及按固定规则计算的 tokens（图片）"""
+    if not content:
+        return [], 0
+    if not isinstance(content, list):
+        return [str(content)], 0
+    texts = []
+    fixed = 0
+    for part in content:
+        if isinstance(part, dict):
+            if part.get('type') == 'text':
+                texts.append(str(part.get('text', '')))
+            elif part.get('type') == 'image_url':
+                fixed += 65  # OpenAI的图片token计算规则
+        else:
+            texts.append(str(part))
+    return texts, fixed
+
+
+def count_content_tokens(content: Any, model: str = "gpt-3.5-turbo") -> int:
+    """计算单条消息内容（纯文本或已解析的多模态列表）的 tokens"""
+    texts, fixed = _content_texts(content)
+    return fixed + sum(tokenizer.count_batch(texts, model))
+
+
+def count_message_content_tokens(content: Optional[str], model: str = "gpt-3.5-turbo") -> Optional[int]:
+    """
+    按数据库中的存储格式计算消息内容的 tokens，用于写入 Message.token_count
+    计算失败时返回 None，不影响消息保存，之后由回填任务补上
+    """
+    try:
+        return count_content_tokens(parse_message_content(content), model)
+    except Exception as e:
+        print(f"计算消息 tokens 失败: {str(e)}")
+        return None
+
+
+async def count_message_content_tokens_async(content: Optional[str], model: str = "gpt-3.5-turbo") -> Optional[int]:
+    """同上，长内容在线程池中编码"""
+    try:
+        texts, fixed = _content_texts(parse_message_content(content))
+        return fixed + sum(await tokenizer.count_batch_async(texts, model))
+    except Exception as e:
+        print(f"计算消息 tokens 失败: {str(e)}")
+        return None
+
+
 class ChatMetrics:
     def __init__(self, model: str = "gpt-3.5-turbo"):
         self.model = model
@@ -1790,60 +1893,54 @@ class ChatMetrics:
         self.prompt_tokens = 0
         self.completion_tokens = 0
         self.has_received_first_token = False
+        self.usage_reported = False
+        self.reasoning_tokens = 0
         self.accumulated_response = ""
         print(f"[DEBUG] ChatMetrics initialized for model: {model}")
 
-    def calculate_history_tokens(self, messages: List[Dict[str, str]]) -> None:
+    def calculate_history_tokens(
+        self,
+        messages: List[Dict[str, Any]],
+        token_counts: Optional[List[Optional[int]]] = None
+    ) -> None:
+        """
+        token_counts 与 messages 一一对应（Message.token_count），已存储的计数直接求和，
+        只有缺失的消息才重新编码
+        """
         try:
             print(f"[DEBUG] Calculating history tokens for {len(messages)} messages")
             
-            # 对于自定义模型名称，使用默认的 cl100k_base 编码器
-            if self.model in ["admin"]:
-                encoding = tiktoken.get_encoding("cl100k_base")
-            else:
-                try:
-                    encoding = tiktoken.encoding_for_model(self.model)
-                except KeyError:
-                    encoding = tiktoken.get_encoding("cl100k_base")
-            
-            print(f"[DEBUG] Using encoder: {encoding.name}")
-            
             total_tokens = 0
             total_tokens += 3  # 每个请求的基础token数
             
-            for message in messages:
+            # 缺少计数的消息收集起来一次批量编码
+            pending_texts = []
+            role_tokens: Dict[str, int] = {}
+            for index, message in enumerate(messages):
                 total_tokens += 4  # 每条消息的基础token数
                 
-                content = message.get('content')
-                
-                # 处理多模态消息
-                if isinstance(content, list):
-                    # 如果内容是列表（多模态格式），处理每个部分
-                    for part in content:
-                        if isinstance(part, dict):
-                            if part.get('type') == 'text':
-                                # 处理文本部分
-                                text_content = part.get('text', '')
-                                total_tokens += len(encoding.encode(str(text_content)))
-                            elif part.get('type') == 'image_url':
-                                # 图片URL部分计算固定token
-                                total_tokens += 65  # OpenAI的图片token计算规则
-                        else:
-                            # 如果部分不是字典，尝试转换为字符串
-                            total_tokens += len(encoding.encode(str(part)))
-                else:
-                    # 普通文本内容
-                    total_tokens += len(encoding.encode(str(content))) if content else 0
+                stored = token_counts[index] if token_counts is not None and index < len(token_counts) else None
+                if stored is None:
+                    texts, fixed = _content_texts(message.get('content'))
+                    pending_texts.extend(texts)
+                    stored = fixed
+                total_tokens += stored
                 
                 # 处理角色token
                 if 'role' in message:
-                    total_tokens += len(encoding.encode(str(message['role'])))
+                    role = str(message['role'])
+                    if role not in role_tokens:
+                        role_tokens[role] = tokenizer.count(role, self.model)
+                    total_tokens += role_tokens[role]
+            
+            total_tokens += sum(tokenizer.count_batch(pending_texts, self.model))
             
             self.prompt_tokens = total_tokens
             self.total_tokens = total_tokens
             
             print(f"[DEBUG] Token calculation:")
             print(f"[DEBUG] - Prompt tokens: {self.prompt_tokens}")
+            print(f"[DEBUG] - Re-encoded text parts: {len(pending_texts)}")
             print(f"[DEBUG] - Total tokens: {self.total_tokens}")
             
         except Exception as e:
@@ -1851,6 +1948,20 @@ class ChatMetrics:
             print(f"[DEBUG] Error traceback: {traceback.format_exc()}")
             raise
 
+    def apply_usage(self, usage: Optional[Dict[str, Any]]) -> None:
+        """使用上游返回的 usage（流式需要 include_usage），之后不再本地计算 completion tokens"""
+        if not usage:
+            return
+        if usage.get("prompt_tokens") is not None:
+            self.prompt_tokens = usage["prompt_tokens"]
+        if usage.get("completion_tokens") is not None:
+            self.completion_tokens = usage["completion_tokens"]
+            self.usage_reported = True
+        # 推理模型的 completion_tokens 包含不会进入历史的推理部分
+        details = usage.get("completion_tokens_details") or {}
+        self.reasoning_tokens = details.get("reasoning_tokens") or 0
+        self.total_tokens = self.prompt_tokens + self.completion_tokens
+
     def record_first_token(self) -> None:
         if not self.has_received_first_token:
             self.first_token_time = time.time()
@@ -1861,8 +1972,8 @@ class ChatMetrics:
         try:
             print(f"[DEBUG] Updating completion with response text length: {len(response_text)}")
             self.accumulated_response = response_text
-            encoding = tiktoken.get_encoding("cl100k_base")
-            self.completion_tokens = len(encoding.encode(response_text))
+            if not self.usage_reported:
+                self.completion_tokens = tokenizer.count(response_text, self.model)
             self.total_tokens = self.prompt_tokens + self.completion_tokens
             
             print(f"[DEBUG] Updated completion:")
@@ -1874,6 +1985,16 @@ class ChatMetrics:
             print(f"[DEBUG] Error traceback: {traceback.format_exc()}")
             raise
 
+    async def update_completion_async(self, response_text: str) -> None:
+        """流式结束时使用：长回复在线程池中编码，不阻塞事件循环"""
+        if self.usage_reported:
+            self.update_completion(response_text)
+            return
+        self.accumulated_response = response_text
+        self.completion_tokens = await tokenizer.count_async(response_text, self.model)
+        self.total_tokens = self.prompt_tokens + self.completion_tokens
+        print(f"[DEBUG] Updated completion: {self.completion_tokens} completion tokens")
+
     def get_metrics(self) -> Dict:
         current_time = time.time()
         metrics = {
@@ -2016,6 +2137,11 @@ class ForbiddenWordCreate(BaseModel):
     level: str
     description: Optional[str] = None
 
+class ForbiddenWordBulkImport(BaseModel):
+    words: List[str]
+    level: str = "medium"
+    description: Optional[str] = None
+
 class ForbiddenWordResponse(BaseModel):
     id: int
     word: str
@@ -2043,13 +2169,7 @@ class DangerousChatResponse(BaseModel):
 
 # 4. 添加违禁词检测函数
 def check_forbidden_words(content: str, db: Session) -> Tuple[bool, List[str]]:
-    forbidden_words = db.query(ForbiddenWord).all()
-    matched_words = []
-    
-    for word in forbidden_words:
-        if word.word in content:
-            matched_words.append(word.word)
-    
+    matched_words = forbidden_matcher.find_all(content)
     return len(matched_words) > 0, matched_words
 
 
@@ -0,0 +1,282 @@
+#compaction.py
+# 会话压缩：后台把长会话中较早的消息总结成一条滚动摘要，之后的请求只发送 系统提示词 + 摘要 + 最近的消息
+import asyncio
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+from starlette.concurrency import run_in_threadpool
+
+from init import *
+from class_model import *
+from chat_context import ChatContext
+from routing import channel_router
+from upstream import upstream_clients
+
+
+@dataclass
+class CompactionPlan:
+    transcript: str
+    upto_message_id: int
+    previous_upto_message_id: Optional[int]
+    messages: int
+
+
+def _transcript_text(content: Any) -> str:
+    """多模态内容只保留文本部分，图片和文件用占位符代替"""
+    if not isinstance(content, list):
+        return str(content or "")
+    parts = []
+    for part in content:
+        if isinstance(part, dict):
+            if part.get("type") == "text":
+                parts.append(str(part.get("text", "")))
+            elif part.get("type") == "image_url":
+                parts.append("[图片]")
+            elif part.get("type") == "file":
+                parts.append("[文件]")
+        else:
+            parts.append(str(part))
+    return "\n".join(parts)
+
+
+class ChatCompactor:
+    """
+    - schedule() 只把 chat_id 放进有界队列，请求路径不等待；同一会话排队中时不重复入队，队列满时丢弃并计数
+    - 固定数量的后台任务依次处理，生成摘要使用 CHAT_COMPACTION_MODEL，按正常的渠道路由选择上游
+    - 编辑 / 重新生成时 invalidate()：删除覆盖到被修改消息的摘要，并让正在生成的摘要作废
+    """
+
+    def __init__(
+        self,
+        enabled: bool = CHAT_COMPACTION_ENABLED,
+        model: str = CHAT_COMPACTION_MODEL,
+        max_queue: int = CHAT_COMPACTION_QUEUE_SIZE,
+        workers: int = CHAT_COMPACTION_WORKERS
+    ):
+        self.enabled = enabled
+        self.model = model
+        self.max_queue = max_queue
+        self.workers = workers
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._pending: Set[int] = set()
+        # 正在压缩的会话 -> 期间是否被编辑 / 重新生成过
+        self._in_flight: Dict[int, bool] = {}
+        self.scheduled = 0
+        self.dropped = 0
+        self.completed = 0
+        self.discarded = 0
+        self.failed = 0
+
+    # ---------- 请求路径 ----------
+
+    def schedule(self, chat_id: int) -> bool:
+        if not self.enabled or self._queue is None or chat_id in self._pending:
+            return False
+        try:
+            self._queue.put_nowait(chat_id)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self._pending.add(chat_id)
+        self.scheduled += 1
+        return True
+
+    def invalidate(self, db: Session, chat_id: int, from_message_id: Optional[int] = None) -> None:
+        """
+        from_message_id 及之后的消息被修改 / 删除；覆盖到这些消息的摘要随调用方的事务一起删除
+        from_message_id 为空时删除该会话的摘要
+        """
+        if chat_id in self._in_flight:
+            self._in_flight[chat_id] = True
+        query = db.query(ChatSummary).filter(ChatSummary.chat_id == chat_id)
+        if from_message_id is not None:
+            query = query.filter(ChatSummary.upto_message_id >= from_message_id)
+        query.delete(synchronize_session=False)
+
+    def load_summary(self, db: Session, chat_id: int) -> Optional[ChatSummary]:
+        if not self.enabled:
+            return None
+        return db.query(ChatSummary).filter(ChatSummary.chat_id == chat_id).first()
+
+    @staticmethod
+    def apply(context: ChatContext, summary: Optional[ChatSummary]) -> ChatContext:
+        """用摘要替换它覆盖的消息；摘要覆盖的消息已不在上下文中时原样返回"""
+        if summary is None or summary.upto_message_id not in context.message_ids:
+            return context
+        cut = context.message_ids.index(summary.upto_message_id) + 1
+        preamble_end = 0
+        while preamble_end < cut and context.messages[preamble_end].get("role") == "system":
+            preamble_end += 1
+        summary_message = {"role": "system", "content": CHAT_COMPACTION_SUMMARY_PREFIX + summary.content}
+        return ChatContext(
+            context.messages[:preamble_end] + [summary_message] + context.messages[cut:],
+            context.token_counts[:preamble_end] + [summary.token_count] + context.token_counts[cut:],
+            context.message_ids[:preamble_end] + [summary.upto_message_id] + context.message_ids[cut:]
+        )
+
+    # ---------- 后台任务 ----------
+
+    async def start(self) -> None:
+        if not self.enabled or self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """应用关闭时放弃排队中的压缩，下次对话会重新安排"""
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self._queue = None
+        self._pending.clear()
+
+    async def _run(self) -> None:
+        while True:
+            chat_id = await self._queue.get()
+            self._pending.discard(chat_id)
+            try:
+                await asyncio.wait_for(self.compact(chat_id), timeout=CHAT_COMPACTION_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                print(f"会话 {chat_id} 压缩失败: {str(e)}")
+
+    async def compact(self, chat_id: int) -> bool:
+        self._in_flight[chat_id] = False
+        try:
+            return await self._compact(chat_id)
+        finally:
+            self._in_flight.pop(chat_id, None)
+
+    async def _compact(self, chat_id: int) -> bool:
+        plan = await run_in_threadpool(self._plan, chat_id)
+        if plan is None:
+            return False
+
+        route = channel_router.select(self.model)
+        if route is None:
+            print(f"会话压缩: 模型 {self.model} 没有可用渠道")
+            return False
+        client = upstream_clients.get_openai_client(route.base_url, route.api_key)
+        response = await client.chat.completions.create(
+            model=route.upstream_model,
+            messages=[
+                {"role": "system", "content": CHAT_COMPACTION_PROMPT},
+                {"role": "user", "content": plan.transcript}
+            ],
+            max_tokens=CHAT_COMPACTION_MAX_SUMMARY_TOKENS
+        )
+        summary = (response.choices[0].message.content or "").strip() if response.choices else ""
+        if not summary:
+            return False
+
+        # 生成期间会话被编辑 / 重新生成，丢弃结果
+        if self._in_flight.get(chat_id):
+            self.discarded += 1
+            return False
+
+        usage = getattr(response, "usage", None)
+        token_count = usage.completion_tokens if usage and usage.completion_tokens else tokenizer.count(summary, self.model)
+        stored = await run_in_threadpool(self._store, chat_id, plan, summary, token_count, route.upstream_model)
+        if stored:
+            self.completed += 1
+            print(f"会话 {chat_id} 已压缩 {plan.messages} 条消息 (至消息 {plan.upto_message_id})")
+        else:
+            self.discarded += 1
+        return stored
+
+    def _plan(self, chat_id: int) -> Optional[CompactionPlan]:
+        db = SessionLocal()
+        try:
+            summary = db.query(ChatSummary).filter(ChatSummary.chat_id == chat_id).first()
+            query = db.query(Message).filter(Message.chat_id == chat_id)
+            if summary is not None:
+                query = query.filter(Message.id > summary.upto_message_id)
+            rows = query.order_by(Message.created_at.asc()).all()
+
+            # 开头的系统提示词始终原样发送，不进入摘要
+            if summary is None:
+                while rows and rows[0].role == "system":
+                    rows = rows[1:]
+
+            candidates = rows[:max(0, len(rows) - CHAT_COMPACTION_KEEP_RECENT)]
+            selected = []
+            budget = CHAT_COMPACTION_MAX_INPUT_TOKENS
+            for row in candidates:
+                tokens = row.token_count if row.token_count is not None else estimate_tokens(row.content)
+                if selected and tokens > budget:
+                    break
+                selected.append(row)
+                budget -= tokens
+            # 在一轮对话结束处切分，保留下来的部分从用户消息开始
+            while selected and selected[-1].role != "assistant":
+                selected.pop()
+            if len(selected) < CHAT_COMPACTION_MIN_MESSAGES:
+                return None
+
+            role_names = {"user": "用户", "assistant": "助手", "system": "系统"}
+            lines = []
+            if summary is not None:
+                lines.append(f"之前的摘要：\n{summary.content}\n")
+            for row in selected:
+                text = _transcript_text(parse_message_content(row.content))
+                lines.append(f"{role_names.get(row.role, row.role)}: {text}")
+            return CompactionPlan(
+                transcript="\n".join(lines),
+                upto_message_id=selected[-1].id,
+                previous_upto_message_id=summary.upto_message_id if summary else None,
+                messages=len(selected)
+            )
+        finally:
+            db.close()
+
+    def _store(self, chat_id: int, plan: CompactionPlan, content: str, token_count: int, model_name: str) -> bool:
+        db = SessionLocal()
+        try:
+            # 被摘要覆盖的最后一条消息必须仍然存在
+            if not db.query(Message.id).filter(Message.id == plan.upto_message_id, Message.chat_id == chat_id).first():
+                return False
+            summary = db.query(ChatSummary).filter(ChatSummary.chat_id == chat_id).first()
+            # 其他进程已经更新过摘要
+            current_upto = summary.upto_message_id if summary else None
+            if current_upto != plan.previous_upto_message_id:
+                return False
+            if summary is None:
+                summary = ChatSummary(chat_id=chat_id)
+                db.add(summary)
+            summary.content = content
+            summary.upto_message_id = plan.upto_message_id
+            summary.token_count = token_count
+            summary.model_name = model_name
+            db.commit()
+            return True
+        except Exception as e:
+            db.rollback()
+            print(f"保存会话摘要失败: {str(e)}")
+            return False
+        finally:
+            db.close()
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "model": self.model,
+            "workers": len(self._tasks),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue": self.max_queue,
+            "scheduled": self.scheduled,
+            "dropped": self.dropped,
+            "completed": self.completed,
+            "discarded": self.discarded,
+            "failed": self.failed
+        }
+
+
+chat_compactor = ChatCompactor()
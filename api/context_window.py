@@ -0,0 +1,87 @@
+#context_window.py
+# 按 tokens 预算裁剪发给上游的对话历史：保留开头的系统提示词和最近的若干轮，较早的消息丢弃或用一条说明代替
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from init import *
+
+# 与 ChatMetrics 的计算方式一致：每条消息 4 个基础 token + 角色 1 个 token
+MESSAGE_TOKEN_OVERHEAD = 5
+REQUEST_TOKEN_OVERHEAD = 3
+
+
+@dataclass
+class ContextWindow:
+    messages: List[Dict[str, Any]]
+    token_counts: List[Optional[int]]
+    dropped: int = 0  # 被裁掉的历史消息条数
+    prompt_tokens: int = 0  # 按已存储计数估算的提示词 tokens
+
+
+def estimate_prompt_tokens(token_counts: List[Optional[int]]) -> int:
+    """按已存储的计数估算整段历史的提示词 tokens（缺失的计数按 0 计）"""
+    return REQUEST_TOKEN_OVERHEAD + sum(MESSAGE_TOKEN_OVERHEAD + (count or 0) for count in token_counts)
+
+
+def resolve_max_context_tokens(*limits: Optional[int]) -> Optional[int]:
+    """按优先级取第一个有效的上限（渠道 > 模型 > 全局默认），都没有时不裁剪"""
+    for limit in limits + (CONTEXT_WINDOW_DEFAULT_MAX_TOKENS,):
+        if limit:
+            return limit
+    return None
+
+
+def apply_context_window(
+    messages: List[Dict[str, Any]],
+    token_counts: List[Optional[int]],
+    max_prompt_tokens: Optional[int],
+    elision_notice: Optional[str] = CONTEXT_WINDOW_ELISION_NOTICE
+) -> ContextWindow:
+    """
+    - 开头连续的 system 消息（提示词市场 / 私有提示词）始终保留
+    - 最后一条消息（本轮用户输入）始终保留，即使单独就超出预算
+    - 从后往前累加已存储的 token_count，只访问最终保留的消息和越界的那一条
+    - 裁剪后第一条保留的历史如果是助手回复，一并丢弃，避免以半轮对话开头
+    """
+    if not max_prompt_tokens or not messages:
+        return ContextWindow(messages, token_counts)
+
+    def cost(index: int) -> int:
+        return MESSAGE_TOKEN_OVERHEAD + (token_counts[index] or 0)
+
+    preamble_end = 0
+    while preamble_end < len(messages) - 1 and messages[preamble_end].get("role") == "system":
+        preamble_end += 1
+
+    used = REQUEST_TOKEN_OVERHEAD
+    for index in range(preamble_end):
+        used += cost(index)
+
+    last = len(messages) - 1
+    used += cost(last)
+    start = last
+    while start > preamble_end:
+        next_cost = cost(start - 1)
+        if used + next_cost > max_prompt_tokens:
+            break
+        used += next_cost
+        start -= 1
+
+    if start == preamble_end:
+        return ContextWindow(messages, token_counts, prompt_tokens=used)
+
+    while start < last and messages[start].get("role") == "assistant":
+        used -= cost(start)
+        start += 1
+
+    dropped = start - preamble_end
+    kept_messages = messages[:preamble_end]
+    kept_counts = token_counts[:preamble_end]
+    if elision_notice:
+        notice = elision_notice.format(count=dropped)
+        kept_messages.append({"role": "system", "content": notice})
+        kept_counts.append(None)
+        used += MESSAGE_TOKEN_OVERHEAD
+    kept_messages.extend(messages[start:])
+    kept_counts.extend(token_counts[start:])
+    return ContextWindow(kept_messages, kept_counts, dropped=dropped, prompt_tokens=used)
@@ -195,9 +195,51 @@ async def create_forbidden_word(
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=f"创建失败：{str(e)}")
-    
+
+    forbidden_matcher.invalidate()
     return db_word
 
+@router.post("/api/admin/forbidden-words/import")
+async def import_forbidden_words(
+    data: ForbiddenWordBulkImport,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(check_admin_permission)
+):
+    """
+    批量导入违禁词，已存在的词自动跳过
+    """
+    words = list(dict.fromkeys(w.strip() for w in data.words if w and w.strip()))
+    if not words:
+        raise HTTPException(status_code=400, detail="没有可导入的违禁词")
+
+    existing = {row.word for row in db.query(ForbiddenWord.word)}
+    now = datetime.now(TIMEZONE)
+    rows = [
+        {
+            "word": word,
+            "level": data.level,
+            "description": data.description,
+            "created_at": now,
+            "created_by": current_user.id
+        }
+        for word in words if word not in existing
+    ]
+
+    try:
+        if rows:
+            db.bulk_insert_mappings(ForbiddenWord, rows)
+            db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=f"导入失败：{str(e)}")
+
+    forbidden_matcher.invalidate()
+    return {
+        "message": "导入成功",
+        "imported": len(rows),
+        "skipped": len(words) - len(rows)
+    }
+
 @router.delete("/api/admin/forbidden-words/{word_id}")
 async def delete_forbidden_word(
     word_id: int,
@@ -214,4 +256,6 @@ async def delete_forbidden_word(
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=str(e))
+
+    forbidden_matcher.invalidate()
     return {"message": "删除成功"}
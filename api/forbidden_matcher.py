@@ -0,0 +1,155 @@
+#forbidden_matcher.py
+# 违禁词匹配：Aho-Corasick 自动机，构建一次，一次线性扫描返回全部命中的违禁词
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from init import *
+
+
+class AhoCorasick:
+    """
+    多模式子串匹配自动机（区分大小写，与原来的 `word in content` 语义一致）
+    节点 0 为根；goto[i] 为子节点表，fail[i] 为失配指针，output[i] 为在该节点结束的词序号
+    """
+
+    def __init__(self, words: Iterable[str]):
+        self.words: List[str] = []
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[Tuple[int, ...]] = [()]
+
+        seen = set()
+        for word in words:
+            if not word or word in seen:
+                continue
+            seen.add(word)
+            self._insert(word, len(self.words))
+            self.words.append(word)
+        self._build()
+
+    def _insert(self, word: str, index: int) -> None:
+        node = 0
+        for char in word:
+            child = self.goto[node].get(char)
+            if child is None:
+                child = len(self.goto)
+                self.goto[node][char] = child
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+            node = child
+        self.output[node] = self.output[node] + (index,)
+
+    def _build(self) -> None:
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                fallback = self.goto[state].get(char, 0)
+                self.fail[child] = fallback if fallback != child else 0
+                # 合并失配链上的输出，匹配时不需要再沿失配指针回溯
+                if self.output[self.fail[child]]:
+                    self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def scan(self, text: str, state: int = 0, matched: Optional[Set[int]] = None) -> Tuple[int, Set[int]]:
+        """
+        从给定状态继续扫描，返回 (新状态, 命中的词序号集合)
+        流式场景下把上一次返回的状态传回来，跨分片的违禁词也能命中
+        """
+        if matched is None:
+            matched = set()
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                matched.update(output[state])
+        return state, matched
+
+    def find_all(self, text: str) -> List[str]:
+        """返回文本中出现的全部违禁词（按词表顺序）"""
+        if not text or not self.words:
+            return []
+        _, matched = self.scan(text)
+        return [self.words[i] for i in sorted(matched)]
+
+
+class StreamModerator:
+    """
+    流式输出的增量审核：在分片之间保留自动机状态，跨分片的违禁词也能命中
+    """
+
+    def __init__(self, automaton: AhoCorasick):
+        self.automaton = automaton
+        self.state = 0
+        self.matched: Set[int] = set()
+
+    def feed(self, text: str) -> List[str]:
+        """扫描新的分片；出现新的命中时返回目前为止命中的全部违禁词，否则返回空列表"""
+        if not text or not self.automaton.words:
+            return []
+        before = len(self.matched)
+        self.state, _ = self.automaton.scan(text, self.state, self.matched)
+        if len(self.matched) == before:
+            return []
+        return [self.automaton.words[i] for i in sorted(self.matched)]
+
+
+class ForbiddenWordMatcher:
+    """
+    违禁词自动机持有者
+    - 违禁词增删 / 批量导入后调用 invalidate()，下一次匹配时重建并整体替换
+    - 匹配过程不访问数据库
+    """
+
+    def __init__(self):
+        self._automaton: Optional[AhoCorasick] = None
+        self._automaton_version = -1
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._version += 1
+
+    def automaton(self) -> AhoCorasick:
+        automaton = self._automaton
+        if automaton is not None and self._automaton_version == self._version:
+            return automaton
+        with self._lock:
+            version = self._version
+            if self._automaton is not None and self._automaton_version == version:
+                return self._automaton
+            automaton = AhoCorasick(self._load_words())
+            self._automaton = automaton
+            self._automaton_version = version
+            print(f"违禁词自动机已重建: {len(automaton.words)} 个词, {len(automaton.goto)} 个状态")
+            return automaton
+
+    @staticmethod
+    def _load_words() -> List[str]:
+        # class_model 中的 check_forbidden_words 依赖本模块，这里延迟导入避免循环引用
+        from class_model import ForbiddenWord
+
+        db = SessionLocal()
+        try:
+            return [row.word for row in db.query(ForbiddenWord.word).order_by(ForbiddenWord.id)]
+        finally:
+            db.close()
+
+    def find_all(self, text: str) -> List[str]:
+        return self.automaton().find_all(text)
+
+    def stream_moderator(self) -> StreamModerator:
+        return StreamModerator(self.automaton())
+
+
+forbidden_matcher = ForbiddenWordMatcher()
@@ -1,6 +1,22 @@
 #func.py
 from init import *
 from class_model import *
+from upstream import upstream_clients
+from routing import channel_router, ChannelRoute
+from balancer import channel_balancer
+from circuit_breaker import circuit_breaker
+from rate_limit import rate_limiter
+from principal import resolve_principal
+from user_cache import user_cache
+from chat_context import chat_context_cache
+from schema import add_missing_columns
+from context_window import apply_context_window, estimate_prompt_tokens, resolve_max_context_tokens
+from compaction import chat_compactor
+from hedging import upstream_hedger
+from sse import SSEFrameParser, SSEStreamingResponse, StreamDeltas, SSE_DONE, frame_payload, split_frames, sse_event
+from stream_buffer import stream_registry
+from response_cache import response_cache, response_cache_key
+from single_flight import FlightAbandoned, SingleFlightOverflow, single_flight
 # 清理过期验证码的函数
 def cleanup_expired_codes():
     now = datetime.now(timezone.utc)
@@ -22,13 +38,7 @@ async def check_ai_output_forbidden_words(content: str, db: Session) -> Tuple[bo
     """
     检查AI输出内容中的违禁词
     """
-    forbidden_words = db.query(ForbiddenWord).all()
-    matched_words = []
-    
-    for word in forbidden_words:
-        if word.word in content:
-            matched_words.append(word.word)
-    
+    matched_words = forbidden_matcher.find_all(content)
     return len(matched_words) > 0, matched_words
 
 async def log_dangerous_chat_with_context(
@@ -78,6 +88,7 @@ async def log_dangerous_chat_with_context(
         print(f"Error saving dangerous chat: {str(e)}")
 
 async def get_current_user(
+    request: Request,
     db: Session = Depends(get_db),
     token: str = Depends(oauth2_scheme)
 ) -> User:
@@ -86,16 +97,12 @@ async def get_current_user(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
+    # 中间件已解析过令牌时直接复用
+    principal = resolve_principal(request, token)
+    if principal is None:
         raise credentials_exception
 
-    user = db.query(User).filter(User.username == token_data.username).first()
+    user = user_cache.get(db, principal)
     if user is None:
         raise credentials_exception
     return user
@@ -125,100 +132,57 @@ async def cleanup_old_requests(db: Session):
         db.rollback()
 
 
-async def check_user_limits(user_id: int, model_id: int, db: Session) -> tuple[bool, str]:
-    """使用东八区时间的请求限制检查，倒计时从达到限制开始"""
+async def check_user_limits(
+    user_id: int,
+    model_id: int,
+    db: Session,
+    headers: Optional[Dict[str, str]] = None
+) -> tuple[bool, str]:
+    """
+    使用内存限流器检查 RPM / RTM / 每日请求限制
+    :param headers: 传入字典时写入剩余额度响应头
+    """
     try:
-        print("\n========== 开始检查用户限制 ==========")
-        now = datetime.now(TIMEZONE)
-        print(f"当前时间（东八区）: {now}")
-        
         # 获取用户信息
         user = db.query(User).filter(User.id == user_id).first()
         if not user:
             return False, "用户不存在"
-            
-        # 检查VIP状态
-        if user.vip_until:
-            if user.vip_until.tzinfo is None:
-                user_vip_until = user.vip_until.replace(tzinfo=TIMEZONE)
-            else:
-                user_vip_until = user.vip_until.astimezone(TIMEZONE)
-            is_vip = user_vip_until > now or user.role == UserRole.ADMIN
-        else:
-            is_vip = user.role == UserRole.ADMIN
-            
-        print(f"用户状态 - VIP: {is_vip}")
-        
+
+        is_vip = is_vip_user(user)
+
         # 获取限制值
-        settings = db.query(SystemSettings).first()
+        settings = settings_cache.get()
         if not settings:
             return False, "系统设置不存在"
-            
-        rpm_limit = settings.vipRpmLimit if is_vip else settings.rpmLimit
-        rtm_limit = settings.vipRtmLimit if is_vip else settings.rtmLimit
-        daily_limit = settings.vipDailyLimit if is_vip else settings.dailyLimit
-        
-        print(f"限制值 - RPM: {rpm_limit}, RTM: {rtm_limit}, Daily: {daily_limit}")
-
-        # 计算时间窗口（东八区）
-        one_minute_ago = now - timedelta(minutes=1)
-        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-
-        # 获取最近60秒内的所有请求，按时间排序
-        recent_requests = db.query(AIRequestLog).filter(
-            AIRequestLog.user_id == user_id,
-            AIRequestLog.created_at > one_minute_ago,
-            AIRequestLog.created_at <= now
-        ).order_by(AIRequestLog.created_at.asc()).all()
-        
-        request_count = len(recent_requests)
-        print(f"最近60秒内的请求数: {request_count}")
-
-        if request_count >= rpm_limit:
-            user_type = "VIP" if is_vip else "普通用户"
-            
-            if recent_requests:
-                # 找到第rpm_limit个请求（从0开始计数，所以是rpm_limit - 1）
-                limit_reached_request = recent_requests[rpm_limit - 1]
-                limit_reached_time = limit_reached_request.created_at.astimezone(TIMEZONE)
-                print(f"达到限制的时间: {limit_reached_time}")
-                
-                # 计算从达到限制时开始的60秒倒计时还剩多少秒
-                time_since_limit = (now - limit_reached_time).total_seconds()
-                wait_seconds = max(0, 60 - int(time_since_limit))
-                
-                print(f"达到限制后经过的时间: {time_since_limit}秒")
-                print(f"需要等待的时间: {wait_seconds}秒")
-                
-                if wait_seconds > 0:
-                    return False, f"{user_type}每分钟请求次数已达到上限 ({rpm_limit})，请等待 {wait_seconds} 秒后重试"
-            
-            return False, f"{user_type}每分钟请求次数已达到上限 ({rpm_limit})"
 
-        # 获取今日请求数
-        daily_requests = db.query(AIRequestLog).filter(
-            AIRequestLog.user_id == user_id,
-            AIRequestLog.created_at >= today_start,
-            AIRequestLog.created_at <= now
-        ).count()
-        
-        print(f"今日总请求数: {daily_requests}")
-        
-        if daily_requests >= daily_limit:
-            user_type = "VIP" if is_vip else "普通用户"
-            return False, f"{user_type}今日请求次数已达到上限 ({daily_limit})"
+        result = rate_limiter.acquire(
+            user_id,
+            rpm_limit=settings.vipRpmLimit if is_vip else settings.rpmLimit,
+            rtm_limit=settings.vipRtmLimit if is_vip else settings.rtmLimit,
+            daily_limit=settings.vipDailyLimit if is_vip else settings.dailyLimit,
+            user_type="VIP" if is_vip else "普通用户"
+        )
+        if headers is not None:
+            headers.update(result.headers)
+        return result.allowed, result.message
 
-        print("\n----- 检查通过 -----")
-        return True, None
-        
     except Exception as e:
-        print(f"\n!!!!! 发生错误 !!!!!")
-        print(f"错误类型: {type(e)}")
-        print(f"错误信息: {str(e)}")
+        print(f"检查使用限制时出错: {str(e)}")
         traceback.print_exc()
         return False, f"检查使用限制时出错: {str(e)}"
-    finally:
-        print("\n========== 限制检查结束 ==========\n")
+
+def is_vip_user(user: User) -> bool:
+    """VIP 未过期或管理员"""
+    if user.role == UserRole.ADMIN:
+        return True
+    if not user.vip_until:
+        return False
+    if user.vip_until.tzinfo is None:
+        user_vip_until = user.vip_until.replace(tzinfo=TIMEZONE)
+    else:
+        user_vip_until = user.vip_until.astimezone(TIMEZONE)
+    return user_vip_until > datetime.now(TIMEZONE)
+
 # 添加辅助函数来检查生成限制
 async def check_generation_limit(
     user: User,
@@ -232,42 +196,51 @@ async def check_generation_limit(
     :param db: 数据库会话
     :return: (是否允许生成, 错误消息)
     """
-    # 确保 vip_until 有时区信息
-    now = datetime.now(TIMEZONE)
-    is_vip = False
-    
-    if user.vip_until:
-        if user.vip_until.tzinfo is None:
-            user_vip_until = user.vip_until.replace(tzinfo=TIMEZONE)
-        else:
-            user_vip_until = user.vip_until.astimezone(TIMEZONE)
-        is_vip = user_vip_until > now or user.role == UserRole.ADMIN
+    is_vip = is_vip_user(user)
 
     # 获取适用的限制
     rate_limit = RATE_LIMITS["vip" if is_vip else "normal"][media_type]
     minutes = rate_limit["minutes"]
     limit = rate_limit["limit"]
 
-    # 计算时间窗口
-    time_window = now - timedelta(minutes=minutes)
-
-    # 查询在时间窗口内的生成次数
-    if media_type == "image":
-        count = db.query(ImageGenerationLog).filter(
-            ImageGenerationLog.user_id == user.id,
-            ImageGenerationLog.created_at >= time_window
-        ).count()
-    else:  # video
-        count = db.query(VideoGenerationLog).filter(
-            VideoGenerationLog.user_id == user.id,
-            VideoGenerationLog.created_at >= time_window
-        ).count()
-
-    if count >= limit:
+    # 只检查不计数：生成成功并写入日志后由 record_generation 计入，被拒绝或失败的请求不占额度
+    allowed, _ = rate_limiter.hit(
+        media_type,
+        user.id,
+        limit,
+        minutes * 60,
+        warm_loader=_generation_counter(user.id, media_type, minutes, db),
+        record=False
+    )
+    if not allowed:
         user_type = "VIP" if is_vip else "普通用户"
         return False, f"{user_type}每{minutes}分钟只能生成{limit}个{media_type}"
     
     return True, None
+
+def _generation_counter(user_id: int, media_type: str, minutes: int, db: Session):
+    """限流器预热：读取时间窗口内已有的成功生成记录"""
+    log_model = ImageGenerationLog if media_type == "image" else VideoGenerationLog
+
+    def count_recent_generations() -> int:
+        time_window = datetime.now(TIMEZONE) - timedelta(minutes=minutes)
+        return db.query(log_model).filter(
+            log_model.user_id == user_id,
+            log_model.created_at >= time_window,
+            log_model.error == None
+        ).count()
+
+    return count_recent_generations
+
+def record_generation(user: User, media_type: str, db: Session) -> None:
+    """生成成功并写入日志后计入生成限制"""
+    minutes = RATE_LIMITS["vip" if is_vip_user(user) else "normal"][media_type]["minutes"]
+    rate_limiter.record_hit(
+        media_type,
+        user.id,
+        minutes * 60,
+        warm_loader=_generation_counter(user.id, media_type, minutes, db)
+    )
 # 添加随机选择 API key 的函数
 def get_random_api_key(key_type: str) -> str:
     """
@@ -298,6 +271,8 @@ async def log_user_usage(
         print(f"Error logging user usage: {str(e)}")
 # Create database tables
 Base.metadata.create_all(bind=engine)
+# 已有的表补齐新增的列
+add_missing_columns(engine, Base.metadata)
 async def ensure_user_limits(user_id: int, db: Session):
     """确保用户有基本的限制配置"""
     # 获取用户信息
@@ -372,44 +347,6 @@ async def ensure_user_limits(user_id: int, db: Session):
         print(f"Error updating user limits: {str(e)}")
         db.rollback()
 
-def count_message_tokens(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo") -> Tuple[int, int]:
-    """
-    计算消息历史的 tokens
-    返回: (总 tokens, 提示 tokens)
-    """
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    except Exception as e:
-        print(f"Error getting encoding: {e}")
-        return 0, 0
-
-    # 每条消息的基础token（根据OpenAI的计算方式）
-    tokens_per_message = 3
-    # 整个请求的基础token
-    tokens_per_request = 3
-
-    total_tokens = tokens_per_request
-    for message in messages:
-        total_tokens += tokens_per_message
-        for key, value in message.items():
-            try:
-                total_tokens += len(encoding.encode(value))
-            except Exception as e:
-                print(f"Error encoding {key}: {e}")
-                # 如果编码失败，使用字符长度作为粗略估计
-                total_tokens += len(value)
-
-    # 对于assistant的消息，我们只计算它们作为提示的部分
-    prompt_tokens = total_tokens - sum(
-        len(encoding.encode(msg["content"]))
-        for msg in messages
-        if msg["role"] == "assistant"
-    )
-
-    return total_tokens, prompt_tokens
-
 def check_email_whitelist(email: str, db: Session) -> bool:
     print(f"\n========== 开始白名单检查 ==========")
     print(f"检查邮箱: {email}")
@@ -447,11 +384,7 @@ def count_completion_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
     计算单个回复的 tokens
     """
     try:
-        encoding = tiktoken.encoding_for_model(model)
-        return len(encoding.encode(text))
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-        return len(encoding.encode(text))
+        return tokenizer.count(text, model)
     except Exception as e:
         print(f"Error in completion token counting: {e}")
         return len(text)
@@ -473,6 +406,7 @@ async def log_chat_request(
         print(f"记录时间（东八区）: {now}")
         
         metrics = chat_metrics.get_metrics()
+
         log_entry = AIRequestLog(
             user_id=user_id,
             model_name=model_name,
@@ -540,38 +474,27 @@ async def send_reset_email(email: str, token: str):
 async def stream_response(response: httpx.Response) -> AsyncGenerator[bytes, None]:
     """
     处理流式响应的生成器函数
+    按 SSE 帧解析（一个网络分片可能包含多帧，也可能只有半帧），转换为与客户端约定的数据格式
     """
-    async for chunk in response.aiter_bytes():
-        if chunk:
-            try:
-                # 解析返回的数据块
-                text = chunk.decode('utf-8')
-                if text.startswith('data: '):
-                    text = text[6:]  # 去掉 'data: ' 前缀
-                if text.strip() == '[DONE]':
-                    continue
-                
-                # 解析 JSON 数据
-                data = json.loads(text)
-                if not data.get('choices'):
-                    continue
-                    
-                content = data['choices'][0].get('delta', {}).get('content', '')
-                if content:
-                    # 构建与客户端约定的数据格式
-                    response_data = {
-                        "role": "assistant",
-                        "content": content,
-                        "finish_reason": None
-                    }
-                    # 转换为字符串并添加前缀
-                    yield f"data: {json.dumps(response_data)}\n\n".encode('utf-8')
-                    
-            except json.JSONDecodeError:
-                continue
-            except Exception as e:
-                print(f"Error processing chunk: {str(e)}")
-                continue
+    parser = SSEFrameParser()
+    deltas = StreamDeltas()
+
+    async def payload_batches():
+        async for chunk in response.aiter_bytes():
+            if chunk:
+                yield parser.feed(chunk)[1]
+        yield parser.flush()[1]
+
+    async for payloads in payload_batches():
+        for payload in payloads:
+            content = deltas.delta(payload)
+            if content:
+                yield sse_event({
+                    "role": "assistant",
+                    "content": content,
+                    "finish_reason": None
+                })
+
 # 检查用户是否有VIP访问权限的辅助函数
 def check_vip_access(user: User, model: AIModel) -> bool:
     """检查用户是否有访问权限的辅助函数"""
@@ -632,7 +555,12 @@ async def log_ai_request(
     completion_tokens: int,
     request_text: Union[str, List, Dict],  # 修改类型标注
     response_text: str,
-    error: Optional[str] = None
+    error: Optional[str] = None,
+    attempt: Optional[int] = None,
+    cancelled: bool = False,
+    cache_hit: bool = False,
+    coalesced: bool = False,
+    affinity_hit: Optional[bool] = None
 ):
     """记录聊天请求的详细信息"""
     try:
@@ -653,6 +581,11 @@ async def log_ai_request(
             request_text=request_text,  # 现在是 JSON 字符串
             response_text=response_text,
             error=error,
+            attempt=attempt,
+            cancelled=cancelled,
+            cache_hit=cache_hit,
+            coalesced=coalesced,
+            affinity_hit=affinity_hit,
             created_at=datetime.now(TIMEZONE)
         )
         
@@ -660,6 +593,9 @@ async def log_ai_request(
         try:
             db.commit()
             db.refresh(log_entry)
+            # 计入用户每分钟 token 用量（RTM 限制），命中回复缓存和出错的请求不计
+            if not error and not cache_hit:
+                rate_limiter.record_tokens(user_id, (prompt_tokens or 0) + (completion_tokens or 0))
             return log_entry
         except Exception as e:
             db.rollback()
@@ -688,12 +624,13 @@ async def get_user_rate_limits(user: User, db: Session) -> dict:
     根据用户的VIP状态返回对应的频率限制
     """
     # 获取系统设置
-    settings = db.query(SystemSettings).first()
+    settings = settings_cache.get()
     if not settings:
         settings = SystemSettings()
         db.add(settings)
         db.commit()
         db.refresh(settings)
+        settings_cache.invalidate()
 
     # 检查用户是否是VIP
     is_vip = user.vip_until and user.vip_until > datetime.now(timezone.utc)
@@ -924,70 +861,89 @@ async def record_model_usage(
         print(f"错误详情: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
 
-async def select_channel(db: Session, model_name: str) -> Optional[Channel]:
-    # 先尝试查找特定绑定的渠道
-    channels = db.query(Channel)\
-        .join(ModelChannelBinding)\
-        .join(AIModel)\
-        .filter(
-            Channel.is_active == True,
-            AIModel.name == model_name
-        ).all()
-    
-    if not channels:
-        # 如果没有特定绑定,查找所有支持该模型的渠道
-        channels = db.query(Channel)\
-            .filter(
-                Channel.is_active == True,
-                Channel.models.like(f'%{model_name}%')
-            ).all()
-    
-    if not channels:
-        return None
-        
-    # 根据权重随机选择渠道
-    total_weight = sum(c.weight for c in channels)
-    random_value = random.uniform(0, total_weight)
-    current_weight = 0
-    
-    for channel in channels:
-        current_weight += channel.weight
-        if current_weight >= random_value:
-            return channel
-            
-    return channels[0] if channels else None
+async def open_upstream_stream(
+    base_url: str,
+    api_key: str,
+    model: str,
+    messages: List[Dict[str, Any]],
+    params: Optional[Dict[str, Any]] = None
+):
+    """
+    发起流式请求并预读到第一个 token（TTFT），返回 (stream, first_chunk)
+    first_chunk 为预读的全部字节：keep-alive 注释、只有 role 的增量等不算 token，继续读取，
+    直到某一帧带有增量内容，或上游结束 / 返回错误
+    params 为透传给上游的采样参数；被取消（超时）或出错时关闭上游连接后再抛出
+    """
+    stream = await upstream_clients.open_chat_stream(base_url, api_key, {
+        **(params or {}),
+        "model": model,
+        "messages": messages,
+        "stream": True,
+        # 最后一个分片带上 usage，用于记录准确的 tokens
+        "stream_options": {"include_usage": True}
+    })
+    parser = SSEFrameParser()
+    deltas = StreamDeltas()
+    chunks = []
+    try:
+        while not (deltas.started or deltas.done or deltas.finish_reason or deltas.error):
+            try:
+                chunk = await stream.__anext__()
+            except StopAsyncIteration:
+                break
+            if not chunk:
+                continue
+            chunks.append(chunk)
+            _, payloads = parser.feed(chunk)
+            for payload in payloads:
+                deltas.delta(payload)
+    except BaseException:
+        await stream.close()
+        raise
+    if not chunks:
+        return stream, None
+    return stream, chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+async def iterate_with_first(first, iterator):
+    """先产出已预读的字节，再继续迭代上游流"""
+    if first is not None:
+        yield first
+    async for item in iterator:
+        yield item
+
+def upstream_error_status(error: Exception) -> int:
+    if isinstance(error, asyncio.TimeoutError):
+        return 504
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', 500) if response is not None else 500
+
+def upstream_error_message(error: Exception) -> str:
+    if isinstance(error, asyncio.TimeoutError):
+        return f"Upstream did not stream a token within {CHANNEL_FAILOVER_TTFB_TIMEOUT:g}s"
+    if isinstance(error, httpx.HTTPStatusError):
+        return f"Error code: {error.response.status_code} - {error.response.text}"
+    return str(error)
+
+def is_retryable_upstream_error(error: Exception) -> bool:
+    """请求本身有问题（如参数错误、超出上下文）时换渠道也不会成功"""
+    return upstream_error_status(error) not in CHANNEL_FAILOVER_NON_RETRYABLE_STATUS
+
+async def select_channel(db: Session, model_name: str) -> Optional[ChannelRoute]:
+    """
+    按权重为模型选择渠道
+    优先使用绑定了该模型的渠道，没有绑定时回退到支持列表中包含该模型的渠道
+    直接查内存路由表，不访问数据库
+    """
+    return channel_router.select(model_name)
 
 async def select_channel_for_model(
     db: Session,
     model_id: int,
     model_name: str
-) -> Optional[Channel]:
+) -> Optional[ChannelRoute]:
     """基于绑定关系为模型选择合适的渠道"""
     try:
-        # 优先检查绑定渠道
-        bound_channels = db.query(Channel)\
-            .join(ModelChannelBinding)\
-            .filter(
-                ModelChannelBinding.model_id == model_id,
-                Channel.is_active == True
-            ).all()
-            
-        if bound_channels:
-            # 基于权重选择绑定渠道
-            total_weight = sum(c.weight for c in bound_channels)
-            random_value = random.uniform(0, total_weight)
-            current_weight = 0
-            
-            for channel in bound_channels:
-                current_weight += channel.weight
-                if current_weight >= random_value:
-                    return channel
-
-            return bound_channels[0]
-            
-        # 如无绑定渠道,回退到支持该模型名称的渠道
-        return await select_channel(db, model_name)
-        
+        return channel_router.select_for_model(model_id, model_name)
     except Exception as e:
         print(f"选择渠道时出错: {str(e)}")
         return None
@@ -1199,50 +1155,50 @@ async def check_single_model(model: AIModel, channel: Channel, db: Session) -> D
         
         print(f"检测 {model.name} via {channel.channel_name}...")
         # 异步发送测试请求
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                request_url,
-                headers=headers,
-                json=test_data,
-                timeout=30.0
-            )
+        client = upstream_clients.get_client(channel.base_url)
+        response = await client.post(
+            request_url,
+            headers=headers,
+            json=test_data,
+            timeout=30.0
+        )
             
-            latency = (time.time() - start_time) * 1000
+        latency = (time.time() - start_time) * 1000
             
-            # 使用同步方式记录健康检查
-            health_check = ModelHealthCheck(
-                model_id=model.id,
-                channel_id=channel.id,
-                status='success',
-                latency=latency,
-                error_message=None
-            )
+        # 使用同步方式记录健康检查
+        health_check = ModelHealthCheck(
+            model_id=model.id,
+            channel_id=channel.id,
+            status='success',
+            latency=latency,
+            error_message=None
+        )
             
-            # 删除旧记录（只保留最近24条）
-            oldest = db.query(ModelHealthCheck)\
-                .filter(ModelHealthCheck.model_id == model.id)\
-                .order_by(ModelHealthCheck.check_time.desc())\
-                .offset(23)\
-                .first()
+        # 删除旧记录（只保留最近24条）
+        oldest = db.query(ModelHealthCheck)\
+            .filter(ModelHealthCheck.model_id == model.id)\
+            .order_by(ModelHealthCheck.check_time.desc())\
+            .offset(23)\
+            .first()
                 
-            if oldest:
-                db.query(ModelHealthCheck)\
-                    .filter(
-                        ModelHealthCheck.model_id == model.id,
-                        ModelHealthCheck.check_time < oldest.check_time
-                    )\
-                    .delete(synchronize_session=False)
+        if oldest:
+            db.query(ModelHealthCheck)\
+                .filter(
+                    ModelHealthCheck.model_id == model.id,
+                    ModelHealthCheck.check_time < oldest.check_time
+                )\
+                .delete(synchronize_session=False)
             
-            db.add(health_check)
-            db.commit()
+        db.add(health_check)
+        db.commit()
             
-            print(f"{model.name} 检测成功: {round(latency)}ms")
-            return {
-                "model": model.name,
-                "channel": channel.channel_name,
-                "status": "success",
-                "latency": latency
-            }
+        print(f"{model.name} 检测成功: {round(latency)}ms")
+        return {
+            "model": model.name,
+            "channel": channel.channel_name,
+            "status": "success",
+            "latency": latency
+        }
             
     except Exception as e:
         latency = (time.time() - start_time) * 1000
@@ -1286,6 +1242,7 @@ def init_app():
     
     # 创建数据库表
     Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine, Base.metadata)
     
     # 初始化管理员账户
     init_admin_account()
@@ -79,6 +79,7 @@ async def generate_image(
                 status_code=500,
                 detail=f"数据库操作失败: {str(db_error)}"
             )
+        record_generation(current_user, "image", db)
             
         # 构建响应
         return {
@@ -284,6 +285,7 @@ async def generate_video(
         try:
             db.commit()
             print(f"[{request_id}] ✓ 数据库提交成功")
+            record_generation(current_user, "video", db)
         except Exception as db_error:
             db.rollback()
             print(f"[{request_id}] ❌ 数据库操作失败: {str(db_error)}")
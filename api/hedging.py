@@ -0,0 +1,171 @@
+#hedging.py
+# 对冲请求：首选渠道迟迟不出第一个 token 时向另一个渠道再发一次，先返回的胜出，另一个取消
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from init import *
+from routing import ChannelRoute
+
+
+@dataclass
+class RaceOutcome:
+    route: Optional[ChannelRoute] = None  # 胜出的渠道，全部失败时为空
+    response: Any = None
+    first_chunk: Any = None
+    failures: List[Tuple[ChannelRoute, Exception]] = field(default_factory=list)  # 按失败先后排列
+    cancelled: Optional[ChannelRoute] = None  # 被取消的落后请求
+    hedged: bool = False
+
+
+class UpstreamHedger:
+    """
+    - 每个渠道保留最近的 TTFT（发出请求到收到第一个 token）样本，对冲延迟取其分位数，样本不足时用默认值
+    - 预算为令牌桶：每个开启对冲的请求存入 budget_percent / 100，发起一次对冲消耗 1，
+      对冲请求数因此不会超过这类请求的 budget_percent%
+    - 只在事件循环中调用，不需要加锁
+    """
+
+    def __init__(
+        self,
+        percentile: float = HEDGE_TTFT_PERCENTILE,
+        samples: int = HEDGE_TTFT_SAMPLES,
+        min_samples: int = HEDGE_MIN_SAMPLES,
+        default_delay: float = HEDGE_DEFAULT_DELAY,
+        min_delay: float = HEDGE_MIN_DELAY,
+        budget_percent: float = HEDGE_BUDGET_PERCENT,
+        burst: float = HEDGE_BUDGET_BURST
+    ):
+        self.percentile = percentile
+        self.samples = samples
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.budget_percent = budget_percent
+        self.burst = burst
+        self._ttft: Dict[Optional[int], Deque[float]] = {}
+        self._tokens = 0.0
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+
+    # ---------- TTFT 统计 ----------
+
+    def record_ttft(self, channel_id: Optional[int], seconds: float) -> None:
+        if channel_id is None:
+            return
+        samples = self._ttft.get(channel_id)
+        if samples is None:
+            samples = self._ttft[channel_id] = deque(maxlen=self.samples)
+        samples.append(seconds)
+
+    def delay(self, channel_id: Optional[int]) -> float:
+        samples = self._ttft.get(channel_id)
+        if not samples or len(samples) < self.min_samples:
+            value = self.default_delay
+        else:
+            ordered = sorted(samples)
+            value = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+        return min(max(value, self.min_delay), CHANNEL_FAILOVER_TTFB_TIMEOUT)
+
+    # ---------- 预算 ----------
+
+    def _deposit(self) -> None:
+        self.requests += 1
+        self._tokens = min(self.burst, self._tokens + self.budget_percent / 100.0)
+
+    def _acquire(self) -> bool:
+        if self._tokens < 1.0:
+            self.budget_denied += 1
+            return False
+        self._tokens -= 1.0
+        return True
+
+    # ---------- 竞速 ----------
+
+    async def race(
+        self,
+        primary: ChannelRoute,
+        backup: Optional[ChannelRoute],
+        open_stream: Callable[[ChannelRoute], Awaitable[Tuple[Any, Any]]]
+    ) -> RaceOutcome:
+        """
+        open_stream(route) 返回 (response, first_chunk)，被取消时负责关闭自己的上游连接
+        backup 为空时就是一次普通请求；不会抛出上游错误，失败记录在 outcome.failures
+        """
+        if backup is not None:
+            self._deposit()
+
+        # TTFT 从各自发出请求时算起，对冲请求不包含等待对冲延迟的时间
+        started: Dict[asyncio.Task, float] = {}
+        tasks: Dict[asyncio.Task, ChannelRoute] = {}
+
+        def launch(route: ChannelRoute) -> None:
+            task = asyncio.create_task(open_stream(route))
+            tasks[task] = route
+            started[task] = time.monotonic()
+
+        launch(primary)
+        outcome = RaceOutcome()
+        winner = None
+        try:
+            if backup is not None:
+                done, _ = await asyncio.wait(set(tasks), timeout=self.delay(primary.id))
+                if not done and self._acquire():
+                    self.hedged += 1
+                    outcome.hedged = True
+                    launch(backup)
+
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    route = tasks[task]
+                    error = task.exception()
+                    if error is not None:
+                        if isinstance(error, asyncio.TimeoutError):
+                            self.record_ttft(route.id, CHANNEL_FAILOVER_TTFB_TIMEOUT)
+                        outcome.failures.append((route, error))
+                    elif winner is None:
+                        winner = task
+                        outcome.route = route
+                        outcome.response, outcome.first_chunk = task.result()
+                        self.record_ttft(route.id, time.monotonic() - started[task])
+                        if route is backup:
+                            self.hedge_wins += 1
+            return outcome
+        finally:
+            # 取消落后的请求；已经返回但没有胜出的连接直接关闭
+            for task, route in tasks.items():
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                    outcome.cancelled = route
+                elif not task.cancelled() and task.exception() is None:
+                    outcome.cancelled = route
+                    response, _ = task.result()
+                    await response.close()
+            losers = [task for task in tasks if task is not winner and not task.done()]
+            if losers:
+                await asyncio.gather(*losers, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "budget_denied": self.budget_denied,
+            "budget_tokens": round(self._tokens, 3),
+            "budget_percent": self.budget_percent,
+            "delays": {
+                channel_id: round(self.delay(channel_id), 3)
+                for channel_id in self._ttft
+            }
+        }
+
+
+upstream_hedger = UpstreamHedger()
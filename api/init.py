@@ -80,6 +80,129 @@ RATE_LIMITS = {
     }
 }
 
+# 限流计数器首次使用时是否从请求 / 生成日志预热（重启后计数不清零）
+RATE_LIMIT_WARM_START = True
+
+
+# API 日志批量写入配置
+API_LOG_QUEUE_SIZE = 10000  # 队列上限，超出后丢弃并计数
+API_LOG_BATCH_SIZE = 200  # 每批最多写入条数
+API_LOG_FLUSH_INTERVAL_MS = 500  # 最长刷新间隔（毫秒）
+API_LOG_MAX_BODY_BYTES = 4096  # 请求 / 响应体最多保留字节数
+# 按路由前缀采样（0~1），未配置的路由全部记录
+API_LOG_SAMPLE_RATES = {
+    "/api/admin/logs": 0.0,  # 日志查询本身不记录
+}
+
+# 已认证用户缓存（按用户 id，修改用户后立即失效，TTL 兜底多进程）
+USER_CACHE_MAX_ENTRIES = 10000
+USER_CACHE_TTL = 30.0
+
+# 会话上下文缓存最多保留的会话数（LRU）
+CHAT_CONTEXT_CACHE_MAX_CHATS = 2000
+
+# 上下文窗口：发给上游的提示词 tokens 上限（渠道 / 模型未配置时使用，None 表示不裁剪）
+CONTEXT_WINDOW_DEFAULT_MAX_TOKENS = None
+# 裁掉较早消息时插入的说明（None 表示直接丢弃），{count} 为被裁掉的条数
+CONTEXT_WINDOW_ELISION_NOTICE = None
+
+# 会话压缩（滚动摘要），默认关闭
+CHAT_COMPACTION_ENABLED = False
+CHAT_COMPACTION_MODEL = "gpt-4o-mini"  # 生成摘要使用的模型，走正常的渠道路由
+CHAT_COMPACTION_TRIGGER_TOKENS = 8000  # 未压缩部分的提示词 tokens 超过该值时安排压缩
+CHAT_COMPACTION_KEEP_RECENT = 10  # 最近的若干条消息始终原样发送，不进入摘要
+CHAT_COMPACTION_MIN_MESSAGES = 10  # 可压缩的消息少于该条数时不压缩
+CHAT_COMPACTION_MAX_INPUT_TOKENS = 16000  # 单次压缩最多输入的 tokens，超出的留到下一次
+CHAT_COMPACTION_MAX_SUMMARY_TOKENS = 1024
+CHAT_COMPACTION_QUEUE_SIZE = 100  # 等待压缩的会话数上限，队列满时丢弃
+CHAT_COMPACTION_WORKERS = 1
+CHAT_COMPACTION_TIMEOUT = 120.0
+CHAT_COMPACTION_PROMPT = (
+    "请把下面的对话压缩成一段简洁的摘要，供之后的对话作为上下文使用。"
+    "保留关键事实、用户的要求和偏好、已经得出的结论以及尚未解决的问题，不要编造内容，直接输出摘要。"
+)
+CHAT_COMPACTION_SUMMARY_PREFIX = "以下是之前对话的摘要：\n"
+
+# 渠道故障转移：在向客户端发送任何数据之前，上游出错或超时则换下一个渠道重试
+CHANNEL_FAILOVER_MAX_ATTEMPTS = 3  # 每个请求最多尝试的渠道数（含第一次）
+CHANNEL_FAILOVER_TTFB_TIMEOUT = 30.0  # 每次尝试等待上游第一个 token 的秒数
+CHANNEL_FAILOVER_NON_RETRYABLE_STATUS = {400, 413, 422}  # 请求本身有问题，换渠道也不会成功
+
+# 对冲请求（按模型开启）：首选渠道在该渠道的 TTFT 分位数内没有返回第一个 token 时，向另一个渠道再发一次，先返回的胜出
+HEDGE_TTFT_PERCENTILE = 0.9  # 触发对冲的延迟取该渠道最近 TTFT 的分位数
+HEDGE_TTFT_SAMPLES = 200  # 每个渠道保留的最近 TTFT 样本数
+HEDGE_MIN_SAMPLES = 20  # 样本不足时使用默认延迟
+HEDGE_DEFAULT_DELAY = 2.0
+HEDGE_MIN_DELAY = 0.3  # 延迟下限（秒），避免对冲过早触发
+HEDGE_BUDGET_PERCENT = 5.0  # 对冲请求最多占开启对冲的请求数的百分比
+HEDGE_BUDGET_BURST = 10.0  # 预算最多累积的对冲次数
+
+# 可续传的流式响应：事件编号后缓存在内存中，断线重连带 Last-Event-ID 补发
+STREAM_RESUME_BUFFER_EVENTS = 4096  # 每次生成最多缓存的 SSE 帧数（环形缓冲区）
+STREAM_RESUME_DISCONNECT_GRACE = 15.0  # 所有客户端断开后继续生成、等待重连的秒数，超时后取消上游
+STREAM_RESUME_RETENTION = 60.0  # 生成结束后缓冲区保留的秒数
+STREAM_RESUME_MAX_GENERATIONS = 1000
+
+# 回复缓存（按模型开启）：相同的上游模型 + 消息 + 采样参数直接回放缓存的回复
+RESPONSE_CACHE_MAX_ENTRIES = 5000
+RESPONSE_CACHE_MAX_BYTES = 256 * 1024 * 1024  # 所有缓存回复的总字节数上限
+RESPONSE_CACHE_MAX_ENTRY_BYTES = 1024 * 1024  # 单个回复超过该大小时不缓存
+RESPONSE_CACHE_TTL = 3600.0
+
+# 相同请求合并：开启回复缓存的模型上，相同的并发请求共享一个上游流
+SINGLE_FLIGHT_SUBSCRIBER_BUFFER = 1024  # 每个订阅者最多积压的上游分片数，超过时移出合并
+SINGLE_FLIGHT_MAX_REPLAY_BYTES = 1024 * 1024  # 为迟到的请求保留的已分发字节数上限，超过后不再接受加入
+
+# 会话粘性路由：同一会话的后续轮次优先使用上一轮的渠道，命中上游的提示词前缀缓存
+CHANNEL_AFFINITY_TTL = 1800.0  # 会话超过该秒数没有新请求时不再粘在原渠道
+CHANNEL_AFFINITY_MAX_ENTRIES = 100000
+
+# 自适应负载均衡（按模型开启）：按各渠道的 TTFT / 错误率 EWMA 和进行中请求数调整配置权重
+BALANCER_EWMA_ALPHA = 0.2  # 新样本的权重
+BALANCER_DEFAULT_TTFT = 1.0  # 没有样本的渠道按该 TTFT（秒）计算
+BALANCER_ERROR_PENALTY = 10.0  # 错误率 100% 时代价放大 1 + 该值 倍
+BALANCER_ERROR_HALF_LIFE = 60.0  # 错误率在没有新样本时的半衰期（秒）
+BALANCER_SEED_LOGS = 2000  # 启动时用于预热的最近 AI 请求日志条数
+
+# 渠道熔断：连续失败或窗口内失败率过高时移出路由，冷却后发一个探测请求，成功才恢复
+CIRCUIT_BREAKER_CONSECUTIVE_FAILURES = 5
+CIRCUIT_BREAKER_WINDOW = 60.0  # 失败率统计的滑动窗口（秒）
+CIRCUIT_BREAKER_MIN_REQUESTS = 10  # 窗口内请求数不少于该值时才按失败率熔断
+CIRCUIT_BREAKER_FAILURE_RATE = 0.5
+CIRCUIT_BREAKER_COOLDOWN = 30.0  # 熔断后多少秒发送探测请求
+CIRCUIT_BREAKER_PROBE_TIMEOUT = CHANNEL_FAILOVER_TTFB_TIMEOUT + 5.0  # 领取的探测资格没有使用时多久后过期
+
+# tokens 计算配置
+TOKENIZER_DEFAULT_ENCODING = "cl100k_base"  # 无法识别的模型名使用的编码
+# tiktoken 不认识的模型名按前缀（小写）回退到对应编码，最长前缀优先
+TOKENIZER_ENCODING_FALLBACKS = {
+    "gpt-4o": "o200k_base",
+    "gpt-4.1": "o200k_base",
+    "gpt-5": "o200k_base",
+    "o1": "o200k_base",
+    "o3": "o200k_base",
+    "o4": "o200k_base",
+    "gpt-4": "cl100k_base",
+    "gpt-3.5": "cl100k_base",
+}
+TOKENIZER_OFFLOAD_CHARS = 20000  # 超过该字符数的文本放到线程池编码
+TOKENIZER_WORKERS = 4  # 编码线程数
+TOKENIZER_RETRY_INTERVAL = 300.0  # 编码器加载失败后改用估算的秒数
+
+# 系统设置缓存最长保留秒数（多进程部署时其他进程的修改在此时间内生效）
+SETTINGS_CACHE_MAX_AGE = 60.0
+
+
+# 上游连接池配置（按 base_url 复用连接）
+UPSTREAM_MAX_CONNECTIONS = 200  # 每个上游的最大连接数
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = 50  # 每个上游保持的空闲长连接数
+UPSTREAM_KEEPALIVE_EXPIRY = 60.0  # 空闲连接保留秒数
+UPSTREAM_CONNECT_TIMEOUT = 10.0
+UPSTREAM_READ_TIMEOUT = 600.0
+UPSTREAM_HTTP2 = True  # 安装 h2 后生效
+UPSTREAM_MAX_POOLS = 256  # 最多保留的上游连接池数量（LRU）
+UPSTREAM_RETIRE_GRACE = 300.0  # 渠道变更后旧连接池的关闭宽限期（秒）
+
 
 engine = create_engine(
     DATABASE_URL,
@@ -0,0 +1,148 @@
+#log_writer.py
+# 日志异步批量写入：请求路径只负责入队，后台任务按批次 / 时间间隔批量 INSERT
+# 默认写入 APILog，其他日志表（如熔断记录 ModelHealthCheck）入队时指定表
+import asyncio
+import random
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+from starlette.concurrency import run_in_threadpool
+
+from init import *
+
+
+class APILogWriter:
+    """
+    - 有界队列，队列满时丢弃并计数，绝不阻塞请求
+    - 每 flush_interval 秒或累计 batch_size 条时批量写入一次
+    - 按路由前缀采样（最长前缀匹配），未配置的路由全部记录
+    - 请求 / 响应体只保留前 max_body_bytes 字节
+    """
+
+    def __init__(
+        self,
+        max_queue: int = API_LOG_QUEUE_SIZE,
+        batch_size: int = API_LOG_BATCH_SIZE,
+        flush_interval_ms: int = API_LOG_FLUSH_INTERVAL_MS,
+        sample_rates: Optional[Dict[str, float]] = None,
+        max_body_bytes: int = API_LOG_MAX_BODY_BYTES
+    ):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_body_bytes = max_body_bytes
+        rates = API_LOG_SAMPLE_RATES if sample_rates is None else sample_rates
+        self._sample_rates = sorted(rates.items(), key=lambda item: len(item[0]), reverse=True)
+        self._queue: Deque[Tuple[Any, Dict]] = deque()  # (表，为空时是 APILog, 行)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running = False
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.failed = 0
+        self.batches = 0
+
+    def sample_rate(self, path: str) -> float:
+        for prefix, rate in self._sample_rates:
+            if path.startswith(prefix):
+                return rate
+        return 1.0
+
+    def should_log(self, path: str) -> bool:
+        rate = self.sample_rate(path)
+        if rate >= 1.0 or (rate > 0 and random.random() < rate):
+            return True
+        self.sampled_out += 1
+        return False
+
+    def capture(self, raw: Optional[bytes]) -> Optional[str]:
+        """截取前 max_body_bytes 字节并解码"""
+        if not raw:
+            return None
+        return raw[:self.max_body_bytes].decode("utf-8", errors="ignore")
+
+    def submit(self, row: Dict, table: Any = None) -> None:
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self._queue.append((table, row))
+        self.submitted += 1
+        if self._wakeup is not None and len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._running = True
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """应用关闭时写完队列中剩余的日志"""
+        self._running = False
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while self._running:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"写入API日志失败: {str(e)}")
+
+    async def flush(self) -> None:
+        while self._queue:
+            batch: List[Tuple[Any, Dict]] = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popleft())
+            await run_in_threadpool(self._write_batch, batch)
+
+    def _write_batch(self, batch: List[Tuple[Any, Dict]]) -> None:
+        # class_model 中的中间件依赖本模块，这里延迟导入避免循环引用
+        from class_model import APILog
+
+        by_table: Dict[Any, List[Dict]] = {}
+        for table, row in batch:
+            by_table.setdefault(table or APILog, []).append(row)
+        db = SessionLocal()
+        try:
+            for table, table_rows in by_table.items():
+                db.execute(insert(table), table_rows)
+            db.commit()
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            db.rollback()
+            self.failed += len(batch)
+            print(f"批量写入API日志失败: {str(e)}")
+        finally:
+            db.close()
+
+    def stats(self) -> Dict:
+        return {
+            "running": self._running,
+            "queued": len(self._queue),
+            "max_queue": self.max_queue,
+            "submitted": self.submitted,
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "failed": self.failed,
+            "batches": self.batches,
+            "batch_size": self.batch_size,
+            "flush_interval_ms": int(self.flush_interval * 1000)
+        }
+
+
+api_log_writer = APILogWriter()
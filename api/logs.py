@@ -321,6 +321,13 @@ async def get_log_stats(
         "error_rate": error_count / total_requests if total_requests > 0 else 0
     }
 
+@router.get("/api/admin/logs/writer-stats")
+async def get_log_writer_stats(
+    current_user: User = Depends(check_admin_permission)
+):
+    """API 日志批量写入队列状态（排队、已写入、丢弃、采样跳过等计数）"""
+    return api_log_writer.stats()
+
 @router.delete("/api/admin/logs/cleanup")
 async def cleanup_old_logs(
     start_date: Optional[datetime] = None,
@@ -88,6 +88,7 @@ from openai import OpenAI
 # 枚举类型处理
 ################################################
 from enum import Enum
+from contextlib import asynccontextmanager
 
 ################################################
 # 文件和路径处理
@@ -174,8 +175,29 @@ pwd_context = CryptContext(
 
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await api_log_writer.start()
+    # 用最近的请求日志预热负载均衡的 EWMA
+    seed_db = SessionLocal()
+    try:
+        print(f"负载均衡已预热: {channel_balancer.seed(seed_db)} 条请求日志")
+    except Exception as e:
+        print(f"负载均衡预热失败: {str(e)}")
+    finally:
+        seed_db.close()
+    await chat_compactor.start()
+    yield
+    # 取消进行中的流式生成（保存已生成的部分），停止会话压缩，写完剩余的 API 日志，释放上游连接池和编码线程池
+    await stream_registry.shutdown()
+    await chat_compactor.stop()
+    await api_log_writer.stop()
+    await upstream_clients.close_all()
+    tokenizer.shutdown()
+
+
 # 创建FastAPI应用
-app = FastAPI(title="ChatYT API")
+app = FastAPI(title="ChatYT API", lifespan=lifespan)
 
 # 配置CORS
 app.add_middleware(
@@ -1117,84 +1117,84 @@ async def test_market_model(
        print(f"- 内容: {content}")
 
        # 发送测试请求
-       async with httpx.AsyncClient() as client:
-           try:
-               print("\n等待AI响应...")
-               response = await client.post(
-                   request_url,
-                   headers=request_headers,
-                   json=request_data,
-                   timeout=30.0
-               )
+       client = upstream_clients.get_client(model.api_base_url)
+       try:
+           print("\n等待AI响应...")
+           response = await client.post(
+               request_url,
+               headers=request_headers,
+               json=request_data,
+               timeout=30.0
+           )
                
-               end_time = time.time()
-               latency = round((end_time - start_time) * 1000)  # 计算延迟（毫秒）
+           end_time = time.time()
+           latency = round((end_time - start_time) * 1000)  # 计算延迟（毫秒）
                
-               response.raise_for_status()  # 检查响应状态
-               response_data = response.json()
+           response.raise_for_status()  # 检查响应状态
+           response_data = response.json()
                
-               assistant_message = ""
-               if response_data.get("choices"):
-                   assistant_message = response_data["choices"][0].get("message", {}).get("content", "")
+           assistant_message = ""
+           if response_data.get("choices"):
+               assistant_message = response_data["choices"][0].get("message", {}).get("content", "")
                
-               print("\n请求成功:")
-               print(f"- 状态码: {response.status_code}")
-               print(f"- 响应延迟: {latency}ms")
-               print(f"- 响应内容: {assistant_message[:200]}...")
+           print("\n请求成功:")
+           print(f"- 状态码: {response.status_code}")
+           print(f"- 响应延迟: {latency}ms")
+           print(f"- 响应内容: {assistant_message[:200]}...")
                
-               return {
-                   "status": "success",
-                   "model": model.name,
-                   "latency": latency,
-                   "request": content,
-                   "response": assistant_message,
-                   "raw_response": response_data,
-               }
+           return {
+               "status": "success",
+               "model": model.name,
+               "latency": latency,
+               "request": content,
+               "response": assistant_message,
+               "raw_response": response_data,
+           }
                
-           except httpx.HTTPStatusError as e:
-               end_time = time.time()
-               latency = round((end_time - start_time) * 1000)
+       except httpx.HTTPStatusError as e:
+           end_time = time.time()
+           latency = round((end_time - start_time) * 1000)
                
-               print(f"\nAPI返回错误:")
-               print(f"- 状态码: {e.response.status_code}")
-               print(f"- 响应内容: {e.response.text}")
-               print(f"- 响应延迟: {latency}ms")
+           print(f"\nAPI返回错误:")
+           print(f"- 状态码: {e.response.status_code}")
+           print(f"- 响应内容: {e.response.text}")
+           print(f"- 响应延迟: {latency}ms")
                
-               error_response = e.response
-               error_status = error_response.status_code
+           error_response = e.response
+           error_status = error_response.status_code
                
-               try:
-                   error_json = error_response.json()
-                   if isinstance(error_json, dict) and 'error' in error_json and 'message' in error_json['error']:
-                       error_detail = error_json['error']['message']
-                   else:
-                       error_detail = error_json
-               except:
-                   error_detail = error_response.text
+           try:
+               error_json = error_response.json()
+               if isinstance(error_json, dict) and 'error' in error_json and 'message' in error_json['error']:
+                   error_detail = error_json['error']['message']
+               else:
+                   error_detail = error_json
+           except:
+               error_detail = error_response.text
                    
-               raise HTTPException(
-                   status_code=error_status,
-                   detail={
-                       "message": str(error_detail),
-                       "latency": latency
-                   }
-               )
+           raise HTTPException(
+               status_code=error_status,
+               detail={
+                   "message": str(error_detail),
+                   "latency": latency
+               }
+           )
                
-           except httpx.RequestError as e:
-               end_time = time.time()
-               latency = round((end_time - start_time) * 1000)
+       except httpx.RequestError as e:
+           end_time = time.time()
+           latency = round((end_time - start_time) * 1000)
                
-               print(f"\n请求错误: {str(e)}")
-               print(f"错误类型: {type(e).__name__}")
-               print(f"响应延迟: {latency}ms")
+           print(f"\n请求错误: {str(e)}")
+           print(f"错误类型: {type(e).__name__}")
+           print(f"响应延迟: {latency}ms")
                
-               raise HTTPException(
-                   status_code=status.HTTP_502_BAD_GATEWAY,
-                   detail={
-                       "message": f"请求失败: {str(e)}",
-                       "latency": latency
-                   }
-               )
+           raise HTTPException(
+               status_code=status.HTTP_502_BAD_GATEWAY,
+               detail={
+                   "message": f"请求失败: {str(e)}",
+                   "latency": latency
+               }
+           )
                
    except HTTPException:
        raise
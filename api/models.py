@@ -16,7 +16,7 @@ async def get_models_health_trend(
         print("\n=== 获取健康检查趋势数据 ===")
         
         # 1. 检查是否启用健康检测
-        settings = db.query(SystemSettings).first()
+        settings = settings_cache.get()
         if not settings or not settings.enable_health_check:
             print("健康检测功能未启用")
             return {
@@ -27,7 +27,9 @@ async def get_models_health_trend(
         now = datetime.now(TIMEZONE)
 
         # 2. 检查是否需要进行新的检测
+        # 熔断状态变化也记录在该表中（status 以 circuit_ 开头），不算定时检测
         last_check = db.query(ModelHealthCheck)\
+            .filter(~ModelHealthCheck.status.like("circuit_%"))\
             .order_by(ModelHealthCheck.check_time.desc())\
             .first()
 
@@ -56,7 +58,10 @@ async def get_models_health_trend(
         results = []
         for model in available_models:
             health_records = db.query(ModelHealthCheck)\
-                .filter(ModelHealthCheck.model_id == model.id)\
+                .filter(
+                    ModelHealthCheck.model_id == model.id,
+                    ~ModelHealthCheck.status.like("circuit_%")
+                )\
                 .order_by(ModelHealthCheck.check_time.desc())\
                 .limit(24)\
                 .all()
@@ -477,6 +482,10 @@ async def create_model(
    group: str = Form(...),
    is_active: bool = Form(True),
    channel_ids: Optional[str] = Form(None),
+   max_context_tokens: Optional[int] = Form(None),
+   enable_hedging: bool = Form(False),
+   enable_response_cache: bool = Form(False),
+   enable_adaptive_balancing: bool = Form(False),
    icon: UploadFile = File(None),
    db: Session = Depends(get_db),
    current_user: User = Depends(check_admin_permission)
@@ -522,6 +531,10 @@ async def create_model(
        icon=icon_path,
        is_active=is_active,
        is_deleted=False,
+       max_context_tokens=max_context_tokens or None,
+       enable_hedging=enable_hedging,
+       enable_response_cache=enable_response_cache,
+       enable_adaptive_balancing=enable_adaptive_balancing,
    )
    
    db.add(db_model)
@@ -544,6 +557,7 @@ async def create_model(
            db.rollback()
            raise HTTPException(status_code=400, detail=f"Error binding channels: {str(e)}")
 
+   channel_router.invalidate()
    return db_model
 
 
@@ -585,6 +599,10 @@ async def update_model(
    sort_order: int = Form(0),
    channel_ids: Optional[str] = Form(None),
    coinPrice: Optional[int] = Form(None),
+   max_context_tokens: Optional[int] = Form(None),
+   enable_hedging: Optional[bool] = Form(None),
+   enable_response_cache: Optional[bool] = Form(None),
+   enable_adaptive_balancing: Optional[bool] = Form(None),
    icon: Optional[UploadFile] = File(None),
    db: Session = Depends(get_db),
    current_user: User = Depends(check_admin_permission)
@@ -630,6 +648,15 @@ async def update_model(
    db_model.group = model_group
    db_model.is_active = is_active
    db_model.sort_order = sort_order
+   # 未提交该字段时保持原值，提交 0 表示取消上限
+   if max_context_tokens is not None:
+       db_model.max_context_tokens = max_context_tokens or None
+   if enable_hedging is not None:
+       db_model.enable_hedging = enable_hedging
+   if enable_response_cache is not None:
+       db_model.enable_response_cache = enable_response_cache
+   if enable_adaptive_balancing is not None:
+       db_model.enable_adaptive_balancing = enable_adaptive_balancing
 
    # 更新价格
    if model_group == ModelGroup.COIN:
@@ -667,6 +694,8 @@ async def update_model(
    try:
        db.commit()
        db.refresh(db_model)
+       # 模型名称或绑定可能已变更，重建路由表
+       channel_router.invalidate()
        return db_model
    except Exception as e:
        db.rollback()
@@ -0,0 +1,53 @@
+#principal.py
+# 请求主体解析：每个请求只解码一次 JWT，结果挂在 request.state 上供中间件和依赖共享
+from dataclasses import dataclass
+from typing import Optional
+
+from fastapi import Request
+from jose import JWTError, jwt
+
+from init import *
+
+
+@dataclass(frozen=True)
+class Principal:
+    username: str
+    user_id: Optional[int]  # 旧令牌没有 uid 声明时为 None
+
+
+_UNRESOLVED = object()
+
+
+def decode_principal(token: Optional[str]) -> Optional[Principal]:
+    """解码访问令牌，无效或缺少 sub 时返回 None"""
+    if not token:
+        return None
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    username = payload.get("sub")
+    if username is None:
+        return None
+    user_id = payload.get("uid")
+    return Principal(
+        username=username,
+        user_id=user_id if isinstance(user_id, int) else None
+    )
+
+
+def bearer_token(request: Request) -> Optional[str]:
+    authorization = request.headers.get("authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    return token.strip()
+
+
+def resolve_principal(request: Request, token: Optional[str] = None) -> Optional[Principal]:
+    """同一请求内只解码一次，之后直接从 request.state 读取"""
+    principal = getattr(request.state, "principal", _UNRESOLVED)
+    if principal is _UNRESOLVED:
+        principal = decode_principal(token or bearer_token(request))
+        request.state.principal = principal
+    return principal
@@ -0,0 +1,296 @@
+#rate_limit.py
+# 进程内限流器：滑动窗口计数（当前窗口 + 上一窗口加权），RPM / RTM / 每日额度 / 生成限制均为 O(1)
+import math
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from init import *
+from class_model import *
+
+
+class SlidingWindowCounter:
+    """
+    近似滑动窗口计数器
+    估算值 = 上一窗口计数 * 上一窗口仍落在滑动窗口内的比例 + 当前窗口计数
+    """
+    __slots__ = ("window", "start", "current", "previous")
+
+    def __init__(self, window: float, now: float):
+        self.window = window
+        self.start = now - (now % window)
+        self.current = 0.0
+        self.previous = 0.0
+
+    def _roll(self, now: float) -> None:
+        elapsed_windows = int((now - self.start) // self.window)
+        if elapsed_windows <= 0:
+            return
+        self.previous = self.current if elapsed_windows == 1 else 0.0
+        self.current = 0.0
+        self.start += elapsed_windows * self.window
+
+    def estimate(self, now: float) -> float:
+        self._roll(now)
+        weight = 1.0 - (now - self.start) / self.window
+        return self.previous * weight + self.current
+
+    def add(self, now: float, amount: float = 1.0) -> None:
+        self._roll(now)
+        self.current += amount
+
+    def retry_after(self, now: float, limit: float) -> int:
+        """估算距离计数回落到 limit 以下还需要的秒数"""
+        self._roll(now)
+        elapsed = now - self.start
+        if self.current < limit:
+            # 只需等待上一窗口的权重衰减
+            if self.previous <= 0:
+                return 0
+            need = self.window * (1.0 - (limit - self.current) / self.previous)
+            return max(0, math.ceil(need - elapsed))
+        # 当前窗口已满：等到下一窗口，并让本窗口计数衰减到 limit 以下
+        need = self.window - elapsed + self.window * (1.0 - limit / self.current)
+        return max(1, math.ceil(need))
+
+    def idle(self, now: float) -> bool:
+        return now - self.start >= 2 * self.window
+
+
+class DailyCounter:
+    """按东八区自然日计数，跨日自动清零"""
+    __slots__ = ("day", "count")
+
+    def __init__(self, day: str):
+        self.day = day
+        self.count = 0
+
+    def value(self, day: str) -> int:
+        if day != self.day:
+            self.day = day
+            self.count = 0
+        return self.count
+
+
+class RateLimitResult:
+    def __init__(self, allowed: bool, message: Optional[str] = None, headers: Optional[Dict[str, str]] = None):
+        self.allowed = allowed
+        self.message = message
+        self.headers = headers or {}
+
+
+class RateLimiter:
+    """
+    用户级限流器
+    - RPM：请求放行时计数
+    - RTM：请求完成后按实际消耗的 token 数计数，超过后拒绝新的请求
+    - 每日额度：按自然日计数
+    - 每个用户首次访问时可从请求日志预热，重启后不会清零
+    """
+
+    def __init__(self, warm_start: bool = RATE_LIMIT_WARM_START, prune_every: int = 10000):
+        self.warm_start = warm_start
+        self.prune_every = prune_every
+        self._requests: Dict[int, SlidingWindowCounter] = {}
+        self._tokens: Dict[int, SlidingWindowCounter] = {}
+        self._daily: Dict[int, DailyCounter] = {}
+        self._windows: Dict[Tuple[str, int], SlidingWindowCounter] = {}
+        self._ops = 0
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.now(TIMEZONE).strftime("%Y-%m-%d")
+
+    def _tick(self, now: float) -> None:
+        self._ops += 1
+        if self._ops % self.prune_every:
+            return
+        # 定期清理长时间不活跃的计数器，控制内存
+        today = self._today()
+        for user_id in list(self._daily):
+            if (
+                self._daily[user_id].day != today
+                or (self._requests[user_id].idle(now) and self._tokens[user_id].idle(now))
+            ):
+                del self._requests[user_id]
+                del self._tokens[user_id]
+                del self._daily[user_id]
+        for key in [k for k, c in self._windows.items() if c.idle(now)]:
+            del self._windows[key]
+
+    def _ensure_user(self, user_id: int, now: float) -> None:
+        if user_id in self._daily:
+            return
+        requests = SlidingWindowCounter(60.0, now)
+        tokens = SlidingWindowCounter(60.0, now)
+        daily = DailyCounter(self._today())
+        if self.warm_start:
+            try:
+                minute_count, minute_tokens, day_count = self._load_user_usage(user_id)
+                requests.current = minute_count
+                tokens.current = minute_tokens
+                daily.count = day_count
+            except Exception as e:
+                print(f"限流计数预热失败: {str(e)}")
+        self._requests[user_id] = requests
+        self._tokens[user_id] = tokens
+        self._daily[user_id] = daily
+
+    @staticmethod
+    def _load_user_usage(user_id: int) -> Tuple[int, int, int]:
+        """从请求日志读取最近一分钟和今天的用量"""
+        now = datetime.now(TIMEZONE)
+        one_minute_ago = now - timedelta(minutes=1)
+        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        db = SessionLocal()
+        try:
+            minute_count, minute_tokens = db.query(
+                func.count(AIRequestLog.id),
+                func.coalesce(func.sum(AIRequestLog.total_tokens), 0)
+            ).filter(
+                AIRequestLog.user_id == user_id,
+                AIRequestLog.created_at > one_minute_ago
+            ).one()
+            day_count = db.query(func.count(AIRequestLog.id)).filter(
+                AIRequestLog.user_id == user_id,
+                AIRequestLog.created_at >= today_start
+            ).scalar()
+            return int(minute_count or 0), int(minute_tokens or 0), int(day_count or 0)
+        finally:
+            db.close()
+
+    def acquire(
+        self,
+        user_id: int,
+        rpm_limit: int,
+        rtm_limit: int,
+        daily_limit: int,
+        user_type: str = "普通用户"
+    ) -> RateLimitResult:
+        """检查 RPM / RTM / 每日额度，全部通过时计入本次请求"""
+        now = time.time()
+        self._tick(now)
+        self._ensure_user(user_id, now)
+        requests = self._requests[user_id]
+        tokens = self._tokens[user_id]
+        daily = self._daily[user_id]
+
+        request_estimate = requests.estimate(now)
+        token_estimate = tokens.estimate(now)
+        day_count = daily.value(self._today())
+
+        if request_estimate >= rpm_limit:
+            wait_seconds = requests.retry_after(now, rpm_limit)
+            return RateLimitResult(
+                False,
+                f"{user_type}每分钟请求次数已达到上限 ({rpm_limit})，请等待 {wait_seconds} 秒后重试",
+                self._headers(rpm_limit, request_estimate, rtm_limit, token_estimate, daily_limit, day_count, wait_seconds)
+            )
+        if rtm_limit and token_estimate >= rtm_limit:
+            wait_seconds = tokens.retry_after(now, rtm_limit)
+            return RateLimitResult(
+                False,
+                f"{user_type}每分钟 token 用量已达到上限 ({rtm_limit})，请等待 {wait_seconds} 秒后重试",
+                self._headers(rpm_limit, request_estimate, rtm_limit, token_estimate, daily_limit, day_count, wait_seconds)
+            )
+        if day_count >= daily_limit:
+            return RateLimitResult(
+                False,
+                f"{user_type}今日请求次数已达到上限 ({daily_limit})",
+                self._headers(rpm_limit, request_estimate, rtm_limit, token_estimate, daily_limit, day_count)
+            )
+
+        requests.add(now)
+        daily.count += 1
+        return RateLimitResult(
+            True,
+            None,
+            self._headers(rpm_limit, request_estimate + 1, rtm_limit, token_estimate, daily_limit, day_count + 1)
+        )
+
+    def record_tokens(self, user_id: int, token_count: int) -> None:
+        """请求完成后计入实际消耗的 token"""
+        if not token_count:
+            return
+        now = time.time()
+        self._ensure_user(user_id, now)
+        self._tokens[user_id].add(now, token_count)
+
+    def hit(
+        self,
+        key: str,
+        user_id: int,
+        limit: int,
+        window_seconds: float,
+        warm_loader: Optional[Callable[[], int]] = None,
+        record: bool = True
+    ) -> Tuple[bool, int]:
+        """
+        通用窗口限流（图像 / 视频生成）
+        :param record: 为 False 时只检查不计数，成功后再调用 record_hit 计入
+        :return: (是否放行, 需要等待的秒数)
+        """
+        now = time.time()
+        self._tick(now)
+        counter = self._window(key, user_id, window_seconds, now, warm_loader)
+        if counter.estimate(now) >= limit:
+            return False, counter.retry_after(now, limit)
+        if record:
+            counter.add(now)
+        return True, 0
+
+    def record_hit(
+        self,
+        key: str,
+        user_id: int,
+        window_seconds: float,
+        warm_loader: Optional[Callable[[], int]] = None
+    ) -> None:
+        """计入一次已完成的操作（与 hit(record=False) 配合使用）"""
+        now = time.time()
+        self._window(key, user_id, window_seconds, now, warm_loader).add(now)
+
+    def _window(
+        self,
+        key: str,
+        user_id: int,
+        window_seconds: float,
+        now: float,
+        warm_loader: Optional[Callable[[], int]]
+    ) -> SlidingWindowCounter:
+        counter_key = (key, user_id)
+        counter = self._windows.get(counter_key)
+        if counter is None or counter.window != window_seconds:
+            counter = SlidingWindowCounter(window_seconds, now)
+            if self.warm_start and warm_loader:
+                try:
+                    counter.current = warm_loader()
+                except Exception as e:
+                    print(f"限流计数预热失败: {str(e)}")
+            self._windows[counter_key] = counter
+        return counter
+
+    @staticmethod
+    def _headers(
+        rpm_limit: int,
+        request_estimate: float,
+        rtm_limit: int,
+        token_estimate: float,
+        daily_limit: int,
+        day_count: int,
+        retry_after: Optional[int] = None
+    ) -> Dict[str, str]:
+        headers = {
+            "X-RateLimit-Limit-Requests": str(rpm_limit),
+            "X-RateLimit-Remaining-Requests": str(max(0, rpm_limit - math.ceil(request_estimate))),
+            "X-RateLimit-Limit-Tokens": str(rtm_limit),
+            "X-RateLimit-Remaining-Tokens": str(max(0, rtm_limit - math.ceil(token_estimate))),
+            "X-RateLimit-Limit-Daily": str(daily_limit),
+            "X-RateLimit-Remaining-Daily": str(max(0, daily_limit - day_count)),
+        }
+        if retry_after:
+            headers["Retry-After"] = str(retry_after)
+        return headers
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,121 @@
+#response_cache.py
+# 精确匹配的回复缓存（按模型开启）：相同的上游模型 + 消息 + 采样参数直接回放已缓存的 SSE 帧，不再请求上游
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from init import *
+
+
+def _normalize_content(content: Any) -> Any:
+    if isinstance(content, str):
+        return content.strip()
+    return content
+
+
+def response_cache_key(upstream_model: str, messages: List[Dict[str, Any]], params: Optional[Dict[str, Any]] = None) -> str:
+    """上游模型名 + 规范化后的消息（只取 role / content，文本去掉首尾空白）+ 采样参数 的 SHA-256"""
+    normalized = [
+        {"role": message.get("role"), "content": _normalize_content(message.get("content"))}
+        for message in messages
+    ]
+    material = json.dumps(
+        {"model": upstream_model, "messages": normalized, "params": params or {}},
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":")
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class CachedResponse:
+    __slots__ = ("data", "upstream_model", "expires_at", "hits")
+
+    def __init__(self, data: bytes, upstream_model: str, expires_at: float):
+        self.data = data  # 完整的上游 SSE 帧（含 usage 和 [DONE]），回放时原样发送
+        self.upstream_model = upstream_model
+        self.expires_at = expires_at
+        self.hits = 0
+
+
+class ResponseCache:
+    """
+    - 有界 LRU：条目数不超过 max_entries，缓存的字节总数不超过 max_bytes，超过时淘汰最久未使用的
+    - 每个条目 ttl 秒后过期，读取时惰性删除
+    - 单个回复超过 max_entry_bytes 时不缓存
+    """
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        max_entry_bytes: int = RESPONSE_CACHE_MAX_ENTRY_BYTES,
+        ttl: float = RESPONSE_CACHE_TTL
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            entry.hits += 1
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, data: bytes, upstream_model: str) -> bool:
+        if not data or len(data) > self.max_entry_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = CachedResponse(data, upstream_model, time.monotonic() + self.ttl)
+            self._bytes += len(data)
+            self.stored += 1
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evicted += 1
+            return True
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.data)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stored": self.stored,
+            "evicted": self.evicted
+        }
+
+
+response_cache = ResponseCache()
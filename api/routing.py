@@ -0,0 +1,332 @@
+#routing.py
+# 模型 -> 渠道路由表：启动后常驻内存，渠道 / 模型 / 绑定变更时整体重建
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from init import *
+from class_model import *
+from balancer import channel_balancer
+from circuit_breaker import circuit_breaker
+
+
+@dataclass(frozen=True)
+class ChannelRoute:
+    """路由表中的渠道快照（脱离数据库会话，可在任意协程中安全读取）"""
+    id: int
+    channel_name: str
+    base_url: str
+    api_key: str
+    weight: float
+    upstream_model: str  # 已应用重定向后实际发送给上游的模型名
+    max_context_tokens: Optional[int] = None  # 渠道的提示词 tokens 上限
+
+
+class AliasSampler:
+    """Walker/Vose 别名法：O(n) 建表，O(1) 按权重抽样"""
+
+    def __init__(self, items: Sequence, weights: Sequence[float]):
+        self.items = list(items)
+        n = len(self.items)
+        weights = [max(float(w or 0), 0.0) for w in weights]
+        total = sum(weights)
+        if total <= 0:
+            # 全部权重为 0 时退化为均匀抽样
+            weights = [1.0] * n
+            total = float(n)
+
+        scaled = [w * n / total for w in weights]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        # 剩余项因浮点误差残留，概率视为 1
+
+    def sample(self):
+        i = random.randrange(len(self.items))
+        return self.items[i] if random.random() < self.prob[i] else self.items[self.alias[i]]
+
+
+def resolve_upstream_model(requested_model: str, redirect_mapping: Optional[dict]) -> str:
+    """应用渠道的模型重定向映射，未配置时使用请求的模型名"""
+    if redirect_mapping and redirect_mapping.get(requested_model):
+        return redirect_mapping[requested_model]
+    return requested_model
+
+
+def _load_json(value: Optional[str], expected_type):
+    if not value:
+        return None
+    try:
+        data = json.loads(value)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    return data if isinstance(data, expected_type) else None
+
+
+class RoutingTable:
+    """一次构建完成的不可变路由表"""
+
+    def __init__(
+        self,
+        by_model_id: Dict[int, AliasSampler],
+        by_model_name: Dict[str, AliasSampler],
+        version: int
+    ):
+        self.by_model_id = by_model_id
+        self.by_model_name = by_model_name
+        self.version = version
+        # 去掉熔断渠道后的抽样器，按熔断状态版本缓存：sampler -> (版本, 抽样器，没有渠道被去掉时为空)
+        self._healthy: Dict[AliasSampler, Tuple[int, Optional[AliasSampler]]] = {}
+
+    def healthy_sampler(self, sampler: AliasSampler) -> Optional[AliasSampler]:
+        """熔断状态变化后第一次使用时重建，之后和完整的抽样器一样 O(1) 抽样"""
+        version = circuit_breaker.version
+        cached = self._healthy.get(sampler)
+        if cached is None or cached[0] != version:
+            healthy = circuit_breaker.healthy_routes(sampler.items)
+            cached = (version, AliasSampler(healthy, [route.weight for route in healthy]) if healthy else None)
+            self._healthy[sampler] = cached
+        return cached[1]
+
+    def model_ids_for_channel(self, channel_id: int) -> List[int]:
+        return [
+            model_id for model_id, sampler in self.by_model_id.items()
+            if any(route.id == channel_id for route in sampler.items)
+        ]
+
+    @classmethod
+    def build(cls, db: Session, version: int) -> "RoutingTable":
+        channels = db.query(Channel).filter(Channel.is_active == True).all()
+        parsed = {}
+        for channel in channels:
+            parsed[channel.id] = (
+                channel,
+                _load_json(channel.models, list) or [],
+                _load_json(channel.redirect_mapping, dict)
+            )
+
+        def make_route(channel_id: int, model_name: str) -> ChannelRoute:
+            channel, models, mapping = parsed[channel_id]
+            return ChannelRoute(
+                id=channel.id,
+                channel_name=channel.channel_name,
+                base_url=channel.base_url,
+                api_key=channel.api_key,
+                weight=channel.weight or 0.0,
+                upstream_model=resolve_upstream_model(model_name, mapping),
+                max_context_tokens=channel.max_context_tokens
+            )
+
+        # 1. 显式绑定：模型 -> 绑定的活跃渠道
+        bound_ids: Dict[int, List[int]] = {}
+        model_names: Dict[int, str] = {}
+        rows = db.query(ModelChannelBinding.model_id, ModelChannelBinding.channel_id, AIModel.name)\
+            .join(AIModel, AIModel.id == ModelChannelBinding.model_id)\
+            .all()
+        for model_id, channel_id, model_name in rows:
+            if channel_id in parsed:
+                bound_ids.setdefault(model_id, []).append(channel_id)
+                model_names[model_id] = model_name
+
+        by_model_id: Dict[int, AliasSampler] = {}
+        by_model_name: Dict[str, AliasSampler] = {}
+        name_routes: Dict[str, List[ChannelRoute]] = {}
+        for model_id, channel_ids in bound_ids.items():
+            name = model_names[model_id]
+            routes = [make_route(cid, name) for cid in dict.fromkeys(channel_ids)]
+            by_model_id[model_id] = AliasSampler(routes, [r.weight for r in routes])
+            # 同名模型可能存在多条记录，按名称查找时合并
+            existing = name_routes.setdefault(name, [])
+            known = {r.id for r in existing}
+            existing.extend(r for r in routes if r.id not in known)
+
+        # 2. 无绑定时回退：渠道支持列表中精确包含该模型名
+        support_routes: Dict[str, List[ChannelRoute]] = {}
+        for channel_id, (channel, models, mapping) in parsed.items():
+            for name in dict.fromkeys(models):
+                if isinstance(name, str):
+                    support_routes.setdefault(name, []).append(make_route(channel_id, name))
+
+        for name, routes in support_routes.items():
+            name_routes.setdefault(name, routes)
+
+        for name, routes in name_routes.items():
+            by_model_name[name] = AliasSampler(routes, [r.weight for r in routes])
+
+        return cls(by_model_id, by_model_name, version)
+
+
+class ChannelAffinity:
+    """
+    会话 -> 渠道 的粘性映射（按 会话 + 模型 记录）
+    - 每次成功连上上游后刷新，ttl 秒内没有新请求则失效，超过 max_entries 时淘汰最久未使用的
+    - 渠道失败、被停用或解绑后映射作废，回退到按权重选择
+    """
+
+    def __init__(self, ttl: float = CHANNEL_AFFINITY_TTL, max_entries: int = CHANNEL_AFFINITY_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[int, str], Tuple[int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.held = 0
+        self.broken = 0
+        self.missed = 0
+
+    def get(self, chat_id: int, model_name: str) -> Optional[int]:
+        key = (chat_id, model_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            return entry[0]
+
+    def remember(self, chat_id: int, model_name: str, channel_id: int) -> None:
+        key = (chat_id, model_name)
+        with self._lock:
+            self._entries[key] = (channel_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def forget(self, chat_id: int, model_name: str) -> None:
+        with self._lock:
+            self._entries.pop((chat_id, model_name), None)
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "held": self.held,
+            "broken": self.broken,
+            "missed": self.missed
+        }
+
+
+class ChannelRouter:
+    """
+    路由表持有者
+    - 读路径只做字典查找和 O(1) 抽样，不访问数据库
+    - invalidate 只递增版本号，下一次选择渠道时重建并整体替换（读者永远看到完整的一张表）
+    """
+
+    def __init__(self):
+        self._table: Optional[RoutingTable] = None
+        self._version = 0
+        self._lock = threading.Lock()
+        self.affinity = ChannelAffinity()
+
+    def invalidate(self) -> None:
+        """渠道 / 模型 / 绑定关系变更后调用"""
+        with self._lock:
+            self._version += 1
+
+    def _current(self) -> RoutingTable:
+        table = self._table
+        if table is not None and table.version == self._version:
+            return table
+        with self._lock:
+            table = self._table
+            version = self._version
+            if table is not None and table.version == version:
+                return table
+            db = SessionLocal()
+            try:
+                table = RoutingTable.build(db, version)
+            finally:
+                db.close()
+            self._table = table
+            print(f"路由表已重建: {len(table.by_model_name)} 个模型, 版本 {version}")
+            return table
+
+    @staticmethod
+    def _pick(table: RoutingTable, sampler: AliasSampler, adaptive: bool = False) -> ChannelRoute:
+        """
+        熔断冷却结束的渠道优先作为探测请求；其余请求跳过熔断中的渠道，
+        adaptive 为真时按实时负载在两个随机候选中选择，否则按配置权重抽样
+        """
+        probe = circuit_breaker.claim_probe(sampler.items)
+        if probe is not None:
+            return probe
+        sampler = table.healthy_sampler(sampler) or sampler
+        return channel_balancer.choose(sampler.items) if adaptive else sampler.sample()
+
+    def select(self, model_name: str, adaptive: bool = False) -> Optional[ChannelRoute]:
+        table = self._current()
+        sampler = table.by_model_name.get(model_name)
+        return self._pick(table, sampler, adaptive) if sampler else None
+
+    def select_for_model(self, model_id: int, model_name: str) -> Optional[ChannelRoute]:
+        table = self._current()
+        sampler = table.by_model_id.get(model_id)
+        if sampler:
+            return self._pick(table, sampler)
+        return self.select(model_name)
+
+    def select_for_chat(
+        self,
+        model_name: str,
+        chat_id: int,
+        adaptive: bool = False
+    ) -> Tuple[Optional[ChannelRoute], Optional[int]]:
+        """
+        优先选择该会话上一轮使用的渠道（渠道仍然可用时），否则按权重选择
+        返回 (渠道, 粘住的渠道 id)，没有粘性记录时后者为 None
+        """
+        pinned = self.affinity.get(chat_id, model_name)
+        if pinned is None:
+            self.affinity.missed += 1
+            return self.select(model_name, adaptive), None
+        sampler = self._current().by_model_name.get(model_name)
+        for route in sampler.items if sampler and circuit_breaker.routable(pinned) else ():
+            if route.id == pinned:
+                self.affinity.held += 1
+                return route, pinned
+        # 渠道已停用、解绑或被熔断
+        self.affinity.broken += 1
+        self.affinity.forget(chat_id, model_name)
+        return self.select(model_name, adaptive), pinned
+
+    def routes(self, model_name: str) -> List[ChannelRoute]:
+        sampler = self._current().by_model_name.get(model_name)
+        return list(sampler.items) if sampler else []
+
+    def model_ids_for_channel(self, channel_id: int) -> List[int]:
+        """绑定了该渠道的模型 id（查内存路由表）"""
+        return self._current().model_ids_for_channel(channel_id)
+
+    def all_routes(self) -> Dict[str, List[ChannelRoute]]:
+        return {name: list(sampler.items) for name, sampler in self._current().by_model_name.items()}
+
+    def failover_routes(self, model_name: str, first: ChannelRoute, limit: int) -> List[ChannelRoute]:
+        """
+        故障转移顺序：first 在前，其余未熔断的渠道按权重做不放回抽样（Efraimidis-Spirakis），最多 limit 个
+        """
+        others = [
+            route for route in self.routes(model_name)
+            if route.id != first.id and circuit_breaker.routable(route.id)
+        ]
+        keyed = []
+        for route in others:
+            weight = max(route.weight, 0.0) or 1e-6
+            keyed.append((random.random() ** (1.0 / weight), route))
+        keyed.sort(key=lambda item: item[0], reverse=True)
+        return ([first] + [route for _, route in keyed])[:max(1, limit)]
+
+
+channel_router = ChannelRouter()
@@ -0,0 +1,32 @@
+#schema.py
+# 已有数据库的结构补齐：create_all 不会给已存在的表加列，这里按模型定义补上缺失的可空列
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import MetaData
+
+
+def add_missing_columns(engine: Engine, metadata: MetaData) -> None:
+    """
+    对比模型定义和数据库中的实际列，逐个执行 ALTER TABLE ... ADD COLUMN
+    只处理可空或带服务端默认值的列，可以重复执行
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    print(f"跳过无法自动添加的非空列: {table.name}.{column.name}")
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+                if column.server_default is not None:
+                    default = column.server_default.arg
+                    ddl += f" DEFAULT {getattr(default, 'text', default)}"
+                connection.execute(text(ddl))
+                print(f"已添加列: {table.name}.{column.name}")
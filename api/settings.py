@@ -11,11 +11,12 @@ async def get_public_system_settings(
     db: Session = Depends(get_db)
 ):
     """获取系统公开设置"""
-    settings = db.query(SystemSettings).first()
+    settings = settings_cache.get()
     if not settings:
         settings = SystemSettings()
         db.add(settings)
         db.commit()
+        settings_cache.invalidate()
         
     return {
         "allowRegistration": settings.allowRegistration,
@@ -47,6 +48,7 @@ async def get_health_check_settings(
         db.add(settings)
         db.commit()
         db.refresh(settings)
+        settings_cache.invalidate()
         
     return {
         "enable_health_check": settings.enable_health_check,
@@ -151,6 +153,7 @@ async def update_invite_settings(
     
     try:
         db.commit()
+        settings_cache.invalidate()
         return {
             "message": "Invite settings updated successfully",
             "settings": settings
@@ -211,7 +214,7 @@ async def get_frontend_settings(db: Session = Depends(get_db)):
     获取前端设置，包括logo、标题、VIP权益说明和使用指南
     这是一个公开的API，不需要认证
     """
-    settings = db.query(SystemSettings).first()
+    settings = settings_cache.get()
     if not settings:
         return {
             "logo": None,
@@ -272,6 +275,7 @@ async def upload_frontend_logo(
         # 更新logo路径
         settings.frontend_logo = f"/uploads/frontend/{file_name}"
         db.commit()
+        settings_cache.invalidate()
 
         return {
             "message": "Logo uploaded successfully",
@@ -308,6 +312,7 @@ async def update_frontend_settings(
 
     try:
         db.commit()
+        settings_cache.invalidate()
         return {
             "message": "Frontend settings updated successfully",
             "settings": {
@@ -341,6 +346,7 @@ async def update_card_purchase_settings(
     
     try:
         db.commit()
+        settings_cache.invalidate()
         return {
             "message": "Card purchase settings updated successfully",
             "url": url,
@@ -371,6 +377,7 @@ async def update_signin_settings(
     
     try:
         db.commit()
+        settings_cache.invalidate()
         return {"message": "Signin settings updated"}
     except Exception as e:
         db.rollback()
@@ -536,6 +543,7 @@ async def toggle_email_whitelist(
     settings.enable_email_whitelist = enabled
     try:
         db.commit()
+        settings_cache.invalidate()
         return {
             "message": f"邮箱白名单功能已{'启用' if enabled else '禁用'}"
         }
@@ -603,6 +611,7 @@ async def update_system_settings(
 
         db.commit()
         db.refresh(settings)
+        settings_cache.invalidate()
         return settings
         
     except Exception as e:
@@ -622,6 +631,7 @@ async def get_system_settings(
         db.add(settings)
         db.commit()
         db.refresh(settings)
+        settings_cache.invalidate()
     
     # 确保 updated_at 有时区信息
     if settings.updated_at and settings.updated_at.tzinfo is None:
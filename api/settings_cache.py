@@ -0,0 +1,71 @@
+#settings_cache.py
+# SystemSettings 进程内快照：只加载一次，设置写入后递增版本号，下次读取时重新加载
+import threading
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+from init import *
+
+
+class SettingsCache:
+    """
+    系统设置缓存
+    - 热路径调用 get() 不访问数据库
+    - 所有写入 SystemSettings 的接口在提交后调用 invalidate()
+    - 多进程部署时另一个进程的修改最多延迟 max_age 秒生效
+    """
+
+    def __init__(self, max_age: float = SETTINGS_CACHE_MAX_AGE):
+        self.max_age = max_age
+        self._snapshot: Optional[SimpleNamespace] = None
+        self._snapshot_version = -1
+        self._loaded_at = 0.0
+        self._version = 0
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._version += 1
+
+    def get(self) -> Optional[SimpleNamespace]:
+        """返回只读的设置快照；数据库中还没有设置记录时返回 None"""
+        snapshot = self._snapshot
+        if (
+            snapshot is not None
+            and self._snapshot_version == self._version
+            and time.monotonic() - self._loaded_at < self.max_age
+        ):
+            return snapshot
+        return self._load()
+
+    def _load(self) -> Optional[SimpleNamespace]:
+        # class_model 中的中间件也依赖本模块，这里延迟导入避免循环引用
+        from class_model import SystemSettings
+
+        version = self._version
+        db = SessionLocal()
+        try:
+            row = db.query(SystemSettings).first()
+            if row is None:
+                return None
+            snapshot = SimpleNamespace(**{
+                column.key: getattr(row, column.key)
+                for column in SystemSettings.__table__.columns
+            })
+        finally:
+            db.close()
+
+        with self._lock:
+            # 加载期间如果发生了新的写入，保留旧版本号，下次读取会再次加载
+            self._snapshot = snapshot
+            self._snapshot_version = version
+            self._loaded_at = time.monotonic()
+        return snapshot
+
+
+settings_cache = SettingsCache()
@@ -0,0 +1,218 @@
+#single_flight.py
+# 相同请求合并（single-flight）：可缓存的请求在进行中时，相同的并发请求共享同一个上游流，
+# 每个请求仍然各自审核、保存和计费，只是从自己的有界缓冲区读取上游数据
+import asyncio
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from init import *
+from routing import ChannelRoute
+
+
+class SingleFlightOverflow(Exception):
+    """订阅者读取太慢，缓冲区已满，被移出合并"""
+
+
+class FlightAbandoned(Exception):
+    """带头的请求在连上上游之前被取消（如客户端断开），等待者应重新加入或自己带头"""
+
+
+class _Failure:
+    __slots__ = ("error",)
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class FlightSubscriber:
+    """一个请求在合并中的位置：独立的有界队列，读取慢不会阻塞其他订阅者"""
+
+    def __init__(self, flight: "UpstreamFlight", buffer_size: int):
+        self.flight = flight
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=buffer_size)
+        self.closed = False
+
+    def push(self, item: Any) -> bool:
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def fail(self, error: BaseException) -> None:
+        """丢弃还没读取的数据，下一次读取时抛出 error"""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(_Failure(error))
+
+    async def wait_ready(self) -> ChannelRoute:
+        """等待带头的请求连上上游，返回实际使用的渠道；上游全部失败时抛出同样的错误"""
+        await self.flight.ready.wait()
+        error = self.flight.error
+        if error is not None:
+            self.close()
+            if not isinstance(error, Exception):
+                raise FlightAbandoned()
+            raise error
+        return self.flight.route
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.flight.unsubscribe(self)
+
+
+class UpstreamFlight:
+    """
+    一个共享的上游流
+    - 带头的请求负责连接上游（含故障转移 / 对冲），成功后 start() 开始向所有订阅者分发原始字节
+    - 已分发的字节保留一份（不超过 max_replay_bytes），迟到的请求先收到这部分再接收后续数据；
+      超过上限后不再接受新的订阅者
+    - 所有订阅者都离开时取消上游读取
+    """
+
+    def __init__(self, registry: "SingleFlightRegistry", key: str):
+        self.registry = registry
+        self.key = key
+        self.subscribers: List[FlightSubscriber] = []
+        self.ready = asyncio.Event()
+        self.route: Optional[ChannelRoute] = None
+        self.error: Optional[BaseException] = None
+        self.history: List[bytes] = []
+        self.history_bytes = 0
+        self.accepting = True
+        self.finished = False
+        self.task: Optional[asyncio.Task] = None
+
+    def subscribe(self) -> FlightSubscriber:
+        subscriber = FlightSubscriber(self, self.registry.buffer_size)
+        if self.history:
+            subscriber.push(b"".join(self.history))
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: FlightSubscriber) -> None:
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+        if not self.subscribers:
+            self._close_joining()
+            if self.task is not None and not self.task.done():
+                self.task.cancel()
+
+    def start(self, route: ChannelRoute, response, first_chunk: Optional[bytes]) -> None:
+        self.route = route
+        self.ready.set()
+        self.task = asyncio.create_task(self._pump(response, first_chunk))
+
+    def fail(self, error: BaseException) -> None:
+        """带头的请求没能连上上游：等待中的订阅者收到同样的错误"""
+        self.error = error
+        self.finished = True
+        self._close_joining()
+        self.ready.set()
+        for subscriber in list(self.subscribers):
+            subscriber.fail(error)
+
+    async def _pump(self, response, first_chunk: Optional[bytes]) -> None:
+        try:
+            if first_chunk:
+                self._dispatch(first_chunk)
+            async for chunk in response:
+                if chunk:
+                    self._dispatch(chunk)
+            self.finished = True
+            self._close_joining()
+            for subscriber in list(self.subscribers):
+                if not subscriber.push(None):
+                    self._overflow(subscriber)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.finished = True
+            self._close_joining()
+            for subscriber in list(self.subscribers):
+                subscriber.fail(e)
+        finally:
+            self._close_joining()
+            try:
+                await response.close()
+            except Exception as close_error:
+                print(f"关闭上游连接失败: {str(close_error)}")
+
+    def _dispatch(self, chunk: bytes) -> None:
+        if self.accepting:
+            self.history.append(chunk)
+            self.history_bytes += len(chunk)
+            if self.history_bytes > self.registry.max_replay_bytes:
+                self._close_joining()
+        for subscriber in list(self.subscribers):
+            if not subscriber.push(chunk):
+                self._overflow(subscriber)
+
+    def _overflow(self, subscriber: FlightSubscriber) -> None:
+        self.registry.overflowed += 1
+        subscriber.fail(SingleFlightOverflow("Subscriber fell behind the shared upstream stream"))
+        subscriber.close()
+
+    def _close_joining(self) -> None:
+        if self.accepting:
+            self.accepting = False
+            self.history = []
+            self.registry._release(self)
+
+
+class SingleFlightRegistry:
+    def __init__(
+        self,
+        buffer_size: int = SINGLE_FLIGHT_SUBSCRIBER_BUFFER,
+        max_replay_bytes: int = SINGLE_FLIGHT_MAX_REPLAY_BYTES
+    ):
+        self.buffer_size = buffer_size
+        self.max_replay_bytes = max_replay_bytes
+        self._flights: Dict[str, UpstreamFlight] = {}
+        self.led = 0
+        self.joined = 0
+        self.overflowed = 0
+
+    def join(self, key: str) -> Tuple[FlightSubscriber, bool]:
+        """
+        返回 (订阅者, 是否带头)
+        有相同请求进行中时加入它；否则登记一个新的合并，调用方成为带头者，
+        之后必须调用 flight.start() 或 flight.fail()
+        """
+        flight = self._flights.get(key)
+        if flight is not None and flight.accepting:
+            self.joined += 1
+            return flight.subscribe(), False
+        flight = UpstreamFlight(self, key)
+        self._flights[key] = flight
+        self.led += 1
+        return flight.subscribe(), True
+
+    def _release(self, flight: UpstreamFlight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight": len(self._flights),
+            "led": self.led,
+            "joined": self.joined,
+            "overflowed": self.overflowed,
+            "buffer_size": self.buffer_size,
+            "max_replay_bytes": self.max_replay_bytes
+        }
+
+
+single_flight = SingleFlightRegistry()
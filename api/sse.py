@@ -0,0 +1,209 @@
+#sse.py
+# 上游 SSE 流的增量解析：网络分片原样转发给客户端，只在完整帧的边界切分，同时提取增量内容和 usage
+import asyncio
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+DONE_PAYLOAD = b"[DONE]"
+
+
+def sse_event(data: Any) -> bytes:
+    """构造一个 SSE 帧，data 为字符串时原样发送，其他类型序列化为 JSON"""
+    if not isinstance(data, str):
+        data = json.dumps(data, ensure_ascii=False)
+    return f"data: {data}\n\n".encode("utf-8")
+
+
+SSE_DONE = sse_event("[DONE]")
+
+
+_FRAME_END = re.compile(rb"\r?\n\r?\n")
+
+
+def _frame_end(data: bytes) -> int:
+    """最后一个完整帧结束的位置（空行之后），没有完整帧时返回 0"""
+    lf = data.rfind(b"\n\n")
+    crlf = data.rfind(b"\n\r\n")
+    return max(lf + 2 if lf >= 0 else 0, crlf + 3 if crlf >= 0 else 0)
+
+
+def frame_payload(frame: bytes) -> Optional[bytes]:
+    """一个完整帧的 data 字段，多行 data 按规范用换行拼接；没有 data 的帧（注释、纯 id）返回 None"""
+    # 常见情况：只有一行 "data: ...\n\n"
+    if frame.startswith(b"data: ") and frame.find(b"\n") == len(frame) - 2:
+        return frame[6:-2]
+    lines = []
+    for line in frame.split(b"\n"):
+        if line.startswith(b"data:"):
+            value = line[5:]
+            if value.endswith(b"\r"):
+                value = value[:-1]
+            lines.append(value[1:] if value.startswith(b" ") else value)
+    if not lines:
+        return None
+    return lines[0] if len(lines) == 1 else b"\n".join(lines)
+
+
+def strip_event_id(frame: bytes) -> bytes:
+    """去掉帧中的 id 字段（续传时由我们加上自己的事件编号，上游的 id 会覆盖它）；没有 id 行时返回原对象"""
+    if not frame.startswith(b"id") and b"\nid" not in frame:
+        return frame
+    lines = frame.split(b"\n")
+    kept = [line for line in lines if not (line.startswith(b"id:") or line.rstrip(b"\r") == b"id")]
+    return frame if len(kept) == len(lines) else b"\n".join(kept)
+
+
+def split_frames(data: bytes) -> List[bytes]:
+    """把以帧边界结尾的字节切分成单独的帧（只有一帧时返回原对象）"""
+    if b"\r" not in data:
+        pieces = data.split(b"\n\n")
+        if len(pieces) == 2:
+            return [data]
+        return [piece + b"\n\n" for piece in pieces[:-1]]
+    frames = []
+    start = 0
+    for match in _FRAME_END.finditer(data):
+        end = match.end()
+        frames.append(data if start == 0 and end == len(data) else data[start:end])
+        start = end
+    return frames
+
+
+class SSEFrameParser:
+    """
+    - feed() 返回 (可以转发的字节, 其中各帧的 data 字段)：转发的字节总是以帧边界结尾，
+      帧被拆到多次读取时，不完整的尾部留到下一次
+    - 网络分片恰好以帧边界结尾时（最常见的情况）返回的就是原对象，不复制
+    - 注释行（: keep-alive）和 event / id 等字段随字节转发，不产生 data
+    """
+
+    def __init__(self):
+        self._pending = b""
+        self.frames = 0
+
+    def complete(self, data: bytes) -> bytes:
+        """拼上次留下的尾部，返回以帧边界结尾的部分"""
+        if self._pending:
+            data = self._pending + data
+            self._pending = b""
+        end = _frame_end(data)
+        if end < len(data):
+            self._pending = data[end:]
+            data = data[:end]
+        return data
+
+    def feed(self, data: bytes) -> Tuple[bytes, List[bytes]]:
+        data = self.complete(data)
+        if not data:
+            return b"", []
+        return data, self._payloads(data)
+
+    def flush(self) -> Tuple[bytes, List[bytes]]:
+        """上游结束时处理没有以空行结尾的最后一帧"""
+        data = self.flush_bytes()
+        return data, self._payloads(data) if data else []
+
+    def flush_bytes(self) -> bytes:
+        data, self._pending = self._pending, b""
+        if not data.strip():
+            return b""
+        return data + b"\n\n"
+
+    def _payloads(self, data: bytes) -> List[bytes]:
+        payloads = []
+        for frame in split_frames(data):
+            self.frames += 1
+            payload = frame_payload(frame)
+            if payload is not None:
+                payloads.append(payload)
+        return payloads
+
+
+class StreamDeltas:
+    """
+    从 OpenAI 格式的 data 字段中提取回复内容、usage 和结束原因
+    回复内容按片段存入列表，需要全文时再拼接，避免长回复反复拼接字符串
+    """
+
+    def __init__(self):
+        self.parts: List[str] = []
+        self.usage: Optional[Dict[str, Any]] = None
+        self.finish_reason: Optional[str] = None
+        self.error: Optional[Any] = None
+        self.done = False
+        self.started = False  # 是否已经收到 token（回复内容、推理内容或工具调用）
+        self.chars = 0
+
+    def delta(self, payload: bytes) -> Optional[str]:
+        """解析一帧，返回其中的增量内容（不追加到 parts）"""
+        if payload == DONE_PAYLOAD:
+            self.done = True
+            return None
+        try:
+            chunk = json.loads(payload)
+        except ValueError:
+            return None
+        if not isinstance(chunk, dict):
+            return None
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        if chunk.get("error"):
+            self.error = chunk["error"]
+        choices = chunk.get("choices")
+        if not choices:
+            return None
+        choice = choices[0]
+        if choice.get("finish_reason"):
+            self.finish_reason = choice["finish_reason"]
+        delta = choice.get("delta")
+        if not delta:
+            return None
+        if delta.get("content") or delta.get("reasoning_content") or delta.get("tool_calls"):
+            self.started = True
+        return delta.get("content") or None
+
+    def append(self, content: str) -> None:
+        self.parts.append(content)
+        self.chars += len(content)
+
+    def text(self) -> str:
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+
+class SSEStreamingResponse(StreamingResponse):
+    """
+    不论服务器声明的 ASGI 版本，都同时监听 http.disconnect
+    客户端断开时立即取消发送并关闭 body 生成器（生成器的 finally 负责中止上游、保存已生成的部分），
+    而不是等到下一次写入失败，期间上游一直在生成
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        stream_task = asyncio.ensure_future(self.stream_response(send))
+        listen_task = asyncio.ensure_future(self.listen_for_disconnect(receive))
+        try:
+            await asyncio.wait({stream_task, listen_task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (stream_task, listen_task):
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(stream_task, listen_task, return_exceptions=True)
+            # 生成器停在 yield 处（取消发生在写入时）也要关闭，已经结束的生成器关闭时什么都不做
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+        if stream_task.cancelled():
+            return
+        error = stream_task.exception()
+        if isinstance(error, OSError):
+            return
+        if error is not None:
+            raise error
+        if self.background is not None:
+            await self.background()
@@ -0,0 +1,194 @@
+#stream_buffer.py
+# 可续传的流式生成：上游读取在后台任务中进行，事件编号后写入有界环形缓冲区，
+# 客户端断线后带 Last-Event-ID 重连即可补发缺失的事件并继续接收，不需要再次请求上游
+import asyncio
+import itertools
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from init import *
+from sse import SSE_DONE, sse_event, strip_event_id
+
+
+class StreamGeneration:
+    """
+    一次流式生成
+    - publish() 去掉上游帧自带的 id 字段，加上 "id: 序号" 后写入环形缓冲区（最多 max_events 帧）
+    - subscribe() 先补发序号大于 last_event_id 的帧，再等待新的帧，直到生成结束；
+      订阅者落后超过缓冲区、缺失的帧已被覆盖时发送 resume_unavailable 错误帧后结束，不返回不完整的回复
+    - 没有任何订阅者超过 disconnect_grace 秒时取消生成任务（中止上游请求）
+    """
+
+    def __init__(self, user_id: int, chat_id: int, max_events: int, disconnect_grace: float):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.disconnect_grace = disconnect_grace
+        self.events: Deque[Tuple[int, bytes]] = deque(maxlen=max_events)
+        self.last_seq = 0
+        self.finished = False
+        self.finished_at: Optional[float] = None
+        self.subscribers = 0
+        self.resumed = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self._abandon_timer: Optional[asyncio.TimerHandle] = None
+
+    def publish(self, frames: List[bytes]) -> None:
+        for frame in frames:
+            self.last_seq += 1
+            self.events.append((self.last_seq, b"id: %d\n" % self.last_seq + strip_event_id(frame)))
+        if frames:
+            self._notify()
+
+    def finish(self) -> None:
+        self.finished = True
+        self.finished_at = time.monotonic()
+        self._cancel_abandon_timer()
+        self._notify()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def can_resume(self, last_event_id: int) -> bool:
+        """last_event_id 之后的帧是否都还在缓冲区中"""
+        if last_event_id > self.last_seq:
+            return False
+        first_seq = self.events[0][0] if self.events else self.last_seq + 1
+        return last_event_id + 1 >= first_seq
+
+    async def subscribe(self, last_event_id: int = 0) -> AsyncIterator[bytes]:
+        self.subscribers += 1
+        self._cancel_abandon_timer()
+        cursor = last_event_id
+        try:
+            while True:
+                if self.events and self.events[-1][0] > cursor:
+                    start = cursor + 1 - self.events[0][0]
+                    if start < 0:
+                        print(f"生成 {self.id} 的订阅者落后超过 {self.events.maxlen} 帧，缺失的帧已被覆盖")
+                        yield sse_event({'error': {'type': 'resume_unavailable', 'message': 'Missed events are no longer buffered'}}) + SSE_DONE
+                        return
+                    batch = [data for _, data in itertools.islice(self.events, start, None)]
+                    cursor = self.events[-1][0]
+                    yield b"".join(batch)
+                    continue
+                if self.finished:
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.finished:
+                self._schedule_abandon()
+
+    def _schedule_abandon(self) -> None:
+        self._cancel_abandon_timer()
+        loop = asyncio.get_running_loop()
+        self._abandon_timer = loop.call_later(self.disconnect_grace, self._abandon)
+
+    def _cancel_abandon_timer(self) -> None:
+        if self._abandon_timer is not None:
+            self._abandon_timer.cancel()
+            self._abandon_timer = None
+
+    def _abandon(self) -> None:
+        self._abandon_timer = None
+        if self.subscribers == 0 and not self.finished and self.task is not None:
+            print(f"生成 {self.id} 的客户端断开超过 {self.disconnect_grace:g} 秒未重连，取消上游生成")
+            self.task.cancel()
+
+
+class StreamRegistry:
+    """
+    进行中和刚结束的流式生成（进程内，多进程部署时续传请求需要落到同一个进程）
+    - 生成结束后保留 retention 秒供重连补发，超过 max_generations 时先淘汰最早结束的
+    """
+
+    def __init__(
+        self,
+        max_events: int = STREAM_RESUME_BUFFER_EVENTS,
+        disconnect_grace: float = STREAM_RESUME_DISCONNECT_GRACE,
+        retention: float = STREAM_RESUME_RETENTION,
+        max_generations: int = STREAM_RESUME_MAX_GENERATIONS
+    ):
+        self.max_events = max_events
+        self.disconnect_grace = disconnect_grace
+        self.retention = retention
+        self.max_generations = max_generations
+        self._generations: "OrderedDict[str, StreamGeneration]" = OrderedDict()
+        self.started = 0
+        self.resumed = 0
+        self.abandoned = 0
+
+    def start(
+        self,
+        user_id: int,
+        chat_id: int,
+        produce: Callable[[StreamGeneration], Awaitable[None]]
+    ) -> StreamGeneration:
+        """登记一次生成并在后台任务中运行 produce(generation)，结束后自动 finish"""
+        self._evict()
+        generation = StreamGeneration(user_id, chat_id, self.max_events, self.disconnect_grace)
+        self._generations[generation.id] = generation
+        self.started += 1
+
+        async def run():
+            try:
+                await produce(generation)
+            except asyncio.CancelledError:
+                self.abandoned += 1
+            finally:
+                generation.finish()
+                asyncio.get_running_loop().call_later(self.retention, self._drop, generation.id)
+
+        generation.task = asyncio.create_task(run())
+        return generation
+
+    def get(self, generation_id: str) -> Optional[StreamGeneration]:
+        return self._generations.get(generation_id)
+
+    def resume(self, generation: StreamGeneration, last_event_id: int) -> AsyncIterator[bytes]:
+        self.resumed += 1
+        generation.resumed += 1
+        return generation.subscribe(last_event_id)
+
+    def _drop(self, generation_id: str) -> None:
+        generation = self._generations.get(generation_id)
+        if generation is not None and generation.finished:
+            del self._generations[generation_id]
+
+    def _evict(self) -> None:
+        if len(self._generations) < self.max_generations:
+            return
+        for generation_id, generation in list(self._generations.items()):
+            if generation.finished:
+                del self._generations[generation_id]
+                if len(self._generations) < self.max_generations:
+                    return
+
+    async def shutdown(self) -> None:
+        """应用关闭时取消进行中的生成，各自保存已生成的部分"""
+        tasks = [g.task for g in self._generations.values() if g.task is not None and not g.task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._generations.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "generations": len(self._generations),
+            "active": sum(1 for g in self._generations.values() if not g.finished),
+            "started": self.started,
+            "resumed": self.resumed,
+            "abandoned": self.abandoned,
+            "max_events": self.max_events,
+            "disconnect_grace": self.disconnect_grace,
+            "retention": self.retention
+        }
+
+
+stream_registry = StreamRegistry()
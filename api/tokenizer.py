@@ -0,0 +1,166 @@
+#tokenizer.py
+# tokens 计算：编码器按模型缓存，消息列表批量编码，长文本放到常驻线程池里编码，避免阻塞事件循环
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import tiktoken
+
+from init import *
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """
+    不编码的近似估算，用于只需要量级的预检查
+    按 UTF-8 字节数推算非 ASCII 字符数：中日韩字符约 1 token/字，其余约 4 字符/token
+    """
+    if not text:
+        return 0
+    chars = len(text)
+    wide = (len(text.encode("utf-8")) - chars) // 2
+    return wide + (chars - wide + 3) // 4
+
+
+class Tokenizer:
+    """
+    - 模型名 -> 编码名 解析一次后缓存；tiktoken 不认识的模型名按前缀回退表解析，最后使用默认编码
+    - 同一编码只加载一次；加载失败（如离线环境无法下载词表）时在重试间隔内改用近似估算
+    - 使用 encode_ordinary，用户文本里出现 <|endoftext|> 之类的特殊标记也不会报错
+    - tiktoken 编码时会释放 GIL，长文本放到独立线程池中编码不会阻塞事件循环
+    """
+
+    def __init__(
+        self,
+        default_encoding: str = TOKENIZER_DEFAULT_ENCODING,
+        fallbacks: Optional[Dict[str, str]] = None,
+        offload_chars: int = TOKENIZER_OFFLOAD_CHARS,
+        workers: int = TOKENIZER_WORKERS,
+        retry_interval: float = TOKENIZER_RETRY_INTERVAL
+    ):
+        self.default_encoding = default_encoding
+        fallback_map = TOKENIZER_ENCODING_FALLBACKS if fallbacks is None else fallbacks
+        self._fallbacks = sorted(fallback_map.items(), key=lambda item: len(item[0]), reverse=True)
+        self.offload_chars = offload_chars
+        self.workers = workers
+        self.retry_interval = retry_interval
+        self._encoding_names: Dict[str, str] = {}
+        self._encodings: Dict[str, tiktoken.Encoding] = {}
+        self._unavailable: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.estimated = 0
+        self.offloaded = 0
+
+    def encoding_name(self, model: Optional[str]) -> str:
+        model = model or ""
+        name = self._encoding_names.get(model)
+        if name is not None:
+            return name
+        # 市场 / 私有模型的 "@xxx/模型名" 只看后半部分
+        base_model = model.split("/", 1)[1] if model.startswith("@") and "/" in model else model
+        try:
+            name = tiktoken.encoding_name_for_model(base_model)
+        except KeyError:
+            lowered = base_model.lower()
+            name = next(
+                (encoding for prefix, encoding in self._fallbacks if lowered.startswith(prefix)),
+                self.default_encoding
+            )
+        self._encoding_names[model] = name
+        return name
+
+    def encoding(self, model: Optional[str]) -> Optional[tiktoken.Encoding]:
+        """返回模型对应的编码器；编码器暂不可用时返回 None"""
+        name = self.encoding_name(model)
+        encoding = self._encodings.get(name)
+        if encoding is not None:
+            return encoding
+        failed_at = self._unavailable.get(name)
+        if failed_at is not None and time.monotonic() - failed_at < self.retry_interval:
+            return None
+        with self._lock:
+            encoding = self._encodings.get(name)
+            if encoding is not None:
+                return encoding
+            try:
+                encoding = tiktoken.get_encoding(name)
+            except Exception as e:
+                self._unavailable[name] = time.monotonic()
+                print(f"加载编码器 {name} 失败，暂时使用近似估算: {str(e)}")
+                return None
+            self._encodings[name] = encoding
+            self._unavailable.pop(name, None)
+            return encoding
+
+    def count(self, text: Optional[str], model: Optional[str] = None) -> int:
+        if not text:
+            return 0
+        encoding = self.encoding(model)
+        if encoding is None:
+            self.estimated += 1
+            return estimate_tokens(text)
+        return len(encoding.encode_ordinary(text))
+
+    def count_batch(self, texts: List[str], model: Optional[str] = None) -> List[int]:
+        """
+        在当前线程中逐段编码多段文本（编码器只解析一次）
+        不使用 encode_ordinary_batch：它每次调用都会新建并销毁线程池，并行交给 count_batch_async
+        """
+        if not texts:
+            return []
+        encoding = self.encoding(model)
+        if encoding is None:
+            self.estimated += len(texts)
+            return [estimate_tokens(text) for text in texts]
+        encode = encoding.encode_ordinary
+        return [len(encode(text)) if text else 0 for text in texts]
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tokenizer")
+        return self._executor
+
+    async def count_async(self, text: Optional[str], model: Optional[str] = None) -> int:
+        """短文本直接编码，超过 offload_chars 的放到线程池"""
+        if not text or len(text) < self.offload_chars:
+            return self.count(text, model)
+        self.offloaded += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), self.count, text, model)
+
+    async def count_batch_async(self, texts: List[str], model: Optional[str] = None) -> List[int]:
+        """总长度超过 offload_chars 时按线程池大小分组，各组在常驻线程池中并行编码"""
+        if sum(len(text) for text in texts) < self.offload_chars:
+            return self.count_batch(texts, model)
+        self.offloaded += 1
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        size = -(-len(texts) // self.workers)
+        groups = [texts[start:start + size] for start in range(0, len(texts), size)]
+        results = await asyncio.gather(*[
+            loop.run_in_executor(executor, self.count_batch, group, model) for group in groups
+        ])
+        return [count for group_counts in results for count in group_counts]
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self) -> Dict:
+        return {
+            "encodings": sorted(self._encodings),
+            "unavailable": sorted(self._unavailable),
+            "models": len(self._encoding_names),
+            "estimated": self.estimated,
+            "offloaded": self.offloaded,
+            "offload_chars": self.offload_chars,
+            "workers": self.workers
+        }
+
+
+tokenizer = Tokenizer()
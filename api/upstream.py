@@ -0,0 +1,192 @@
+#upstream.py
+# 上游 API 连接池注册表：按 base_url 复用 httpx.AsyncClient，避免每次请求重新握手
+import asyncio
+import importlib.util
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI
+
+from init import *
+
+
+class UpstreamStream:
+    """上游流式响应的原始字节（已解压），close() 把连接归还连接池"""
+
+    def __init__(self, response: httpx.Response):
+        self.response = response
+        self._iterator = response.aiter_bytes()
+        self.on_close = None  # 连接关闭时调用一次（如负载均衡的进行中请求计数）
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        return await self._iterator.__anext__()
+
+    async def close(self) -> None:
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close()
+        await self.response.aclose()
+
+
+class UpstreamClientRegistry:
+    """
+    应用生命周期内的上游连接池
+    - 每个 base_url（渠道 / 市场模型 / 私有模型）对应一个长连接池
+    - 渠道编辑时调用 invalidate 重建，旧连接池在宽限期后关闭，不影响进行中的流
+    - 应用关闭时调用 close_all 释放所有连接
+    """
+
+    def __init__(
+        self,
+        max_connections: int = UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections: int = UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = UPSTREAM_KEEPALIVE_EXPIRY,
+        connect_timeout: float = UPSTREAM_CONNECT_TIMEOUT,
+        read_timeout: float = UPSTREAM_READ_TIMEOUT,
+        http2: bool = UPSTREAM_HTTP2,
+        max_pools: int = UPSTREAM_MAX_POOLS,
+        retire_grace: float = UPSTREAM_RETIRE_GRACE
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        # 只有安装了 h2 才启用 HTTP/2，否则回退到 HTTP/1.1
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        self.max_pools = max_pools
+        self.retire_grace = retire_grace
+        self._clients: "OrderedDict[str, httpx.AsyncClient]" = OrderedDict()
+        self._openai_clients: "OrderedDict[Tuple[str, str], AsyncOpenAI]" = OrderedDict()
+        self._retired: List[httpx.AsyncClient] = []
+
+    @staticmethod
+    def _normalize(base_url: str) -> str:
+        return (base_url or "").strip().rstrip("/")
+
+    def get_client(self, base_url: str) -> httpx.AsyncClient:
+        """获取 base_url 对应的共享连接池"""
+        key = self._normalize(base_url)
+        client = self._clients.get(key)
+        if client is not None and not client.is_closed:
+            self._clients.move_to_end(key)
+            return client
+
+        self._drop_openai_clients(key)
+        client = httpx.AsyncClient(
+            limits=self.limits,
+            timeout=self.timeout,
+            http2=self.http2
+        )
+        self._clients[key] = client
+        if len(self._clients) > self.max_pools:
+            old_key, old_client = self._clients.popitem(last=False)
+            self._drop_openai_clients(old_key)
+            self._retire(old_client)
+        return client
+
+    def get_openai_client(self, base_url: str, api_key: str) -> AsyncOpenAI:
+        """获取复用连接池的 AsyncOpenAI 客户端（不要对其调用 close）"""
+        key = self._normalize(base_url)
+        http_client = self.get_client(key)
+        cache_key = (key, api_key or "")
+        client = self._openai_clients.get(cache_key)
+        if client is None:
+            client = AsyncOpenAI(
+                base_url=f"{key}/v1",
+                api_key=api_key,
+                http_client=http_client
+            )
+            self._openai_clients[cache_key] = client
+            if len(self._openai_clients) > self.max_pools * 4:
+                self._openai_clients.popitem(last=False)
+        else:
+            self._openai_clients.move_to_end(cache_key)
+        return client
+
+    async def open_chat_stream(self, base_url: str, api_key: str, payload: Dict) -> UpstreamStream:
+        """
+        直接发送流式 chat/completions 请求，返回原始 SSE 字节流，不经过 SDK 逐块解析
+        上游返回错误状态码时读取响应体后抛出 httpx.HTTPStatusError（error.response 可取状态码和详情）
+        """
+        key = self._normalize(base_url)
+        client = self.get_client(key)
+        request = client.build_request(
+            "POST",
+            f"{key}/v1/chat/completions",
+            json=payload,
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Accept": "text/event-stream"
+            }
+        )
+        response = await client.send(request, stream=True)
+        if response.status_code >= 400:
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+            response.raise_for_status()
+        return UpstreamStream(response)
+
+    def _drop_openai_clients(self, key: str) -> None:
+        for cache_key in [k for k in self._openai_clients if k[0] == key]:
+            del self._openai_clients[cache_key]
+
+    def _retire(self, client: httpx.AsyncClient) -> None:
+        """延迟关闭旧连接池，让进行中的请求自然结束"""
+        self._retired.append(client)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        loop.call_later(
+            self.retire_grace,
+            lambda: asyncio.ensure_future(self._close_retired(client))
+        )
+
+    async def _close_retired(self, client: httpx.AsyncClient) -> None:
+        if client in self._retired:
+            self._retired.remove(client)
+        if not client.is_closed:
+            await client.aclose()
+
+    def invalidate(self, *base_urls: Optional[str]) -> None:
+        """渠道配置变更后重建对应的连接池"""
+        for base_url in base_urls:
+            if not base_url:
+                continue
+            key = self._normalize(base_url)
+            self._drop_openai_clients(key)
+            client = self._clients.pop(key, None)
+            if client is not None:
+                print(f"重建上游连接池: {key}")
+                self._retire(client)
+
+    def stats(self) -> Dict:
+        return {
+            "http2": self.http2,
+            "pools": list(self._clients.keys()),
+            "retired": len(self._retired)
+        }
+
+    async def close_all(self) -> None:
+        """应用关闭时释放所有连接"""
+        clients = list(self._clients.values()) + self._retired
+        self._clients.clear()
+        self._openai_clients.clear()
+        self._retired = []
+        for client in clients:
+            try:
+                if not client.is_closed:
+                    await client.aclose()
+            except Exception as e:
+                print(f"关闭上游连接池失败: {str(e)}")
+
+
+upstream_clients = UpstreamClientRegistry()
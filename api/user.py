@@ -329,7 +329,7 @@ async def login_for_access_token(
         )
     
     # 检查系统是否允许登录
-    settings = db.query(SystemSettings).first()
+    settings = settings_cache.get()
     if settings and not settings.allowLogin and user.role != UserRole.ADMIN:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -404,7 +404,7 @@ async def login_for_access_token(
     # 生成访问令牌
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.username}, 
+        data={"sub": user.username, "uid": user.id}, 
         expires_delta=access_token_expires
     )
     
@@ -525,7 +525,7 @@ async def linuxdo_callback(
 
         # 4. 生成访问令牌
         access_token = create_access_token(
-            data={"sub": db_user.username},
+            data={"sub": db_user.username, "uid": db_user.id},
             expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         )
 
@@ -665,7 +665,7 @@ async def github_callback(
             
         # 4. 生成访问令牌
         access_token = create_access_token(
-            data={"sub": db_user.username},
+            data={"sub": db_user.username, "uid": db_user.id},
             expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         )
 
@@ -1156,13 +1156,11 @@ async def get_current_user_info(
     db: Session = Depends(get_db)
 ):
     """获取当前登录用户的详细信息"""
-    # 从数据库获取最新的用户信息
-    user = db.query(User).filter(User.id == current_user.id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    # get_current_user 返回的用户在任何修改后都会从缓存失效，无需再次查询
+    user = current_user
     
     # 从 SystemSettings 获取签到配置
-    settings = db.query(SystemSettings).first()
+    settings = settings_cache.get()
     signin_enabled = settings.signin_enabled if settings else False
     signin_reward_type = settings.signin_reward_type if settings else "coin"
     signin_reward_amount = settings.signin_reward_amount if settings else 0
@@ -1430,7 +1428,7 @@ async def user_signin(
     current_user: User = Depends(get_current_user)
 ):
     # 检查签到设置
-    settings = db.query(SystemSettings).first()
+    settings = settings_cache.get()
     if not settings or not settings.signin_enabled:
         raise HTTPException(status_code=400, detail="Signin is disabled")
         
@@ -0,0 +1,125 @@
+#user_cache.py
+# 已认证用户的短 TTL 缓存：按 id 缓存用户字段，命中时直接挂到当前会话，不再查询数据库
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession, make_transient_to_detached
+
+from init import *
+from class_model import *
+from principal import Principal
+
+
+class UserCache:
+    """
+    - 有界 LRU + TTL，TTL 兜底多进程部署下其他进程的修改
+    - User 行在本进程内被更新 / 删除（封禁、VIP、金币、角色等）时立即失效
+    - get() 返回已合并到调用方会话中的 User，可以像查询结果一样修改和提交
+    """
+
+    def __init__(self, max_entries: int = USER_CACHE_MAX_ENTRIES, ttl: float = USER_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, Tuple[float, Dict]]" = OrderedDict()
+        self._ids_by_username: Dict[str, int] = {}
+        self._columns = [column.key for column in User.__table__.columns]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, user_id: Optional[int]) -> None:
+        if user_id is None:
+            return
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self._ids_by_username.pop(entry[1].get("username"), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._ids_by_username.clear()
+
+    def _lookup(self, user_id: int) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, values = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return values
+
+    def _store(self, user: User) -> None:
+        values = {key: getattr(user, key) for key in self._columns}
+        with self._lock:
+            self._entries[user.id] = (time.monotonic() + self.ttl, values)
+            self._entries.move_to_end(user.id)
+            self._ids_by_username[user.username] = user.id
+            while len(self._entries) > self.max_entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._ids_by_username.pop(evicted.get("username"), None)
+
+    def _attach(self, db: Session, values: Dict) -> User:
+        user = User()
+        for key, value in values.items():
+            setattr(user, key, value)
+        # 重置属性历史，视为刚从数据库加载的干净对象
+        make_transient_to_detached(user)
+        return db.merge(user, load=False)
+
+    def get(self, db: Session, principal: Principal) -> Optional[User]:
+        user_id = principal.user_id
+        if user_id is None:
+            user_id = self._ids_by_username.get(principal.username)
+
+        if user_id is not None:
+            values = self._lookup(user_id)
+            if values is not None and values.get("username") == principal.username:
+                self.hits += 1
+                return self._attach(db, values)
+
+        self.misses += 1
+        query = db.query(User)
+        if principal.user_id is not None:
+            user = query.filter(User.id == principal.user_id).first()
+        else:
+            user = query.filter(User.username == principal.username).first()
+        # 用户名已变更的令牌视为无效
+        if user is None or user.username != principal.username:
+            return None
+        self._store(user)
+        return user
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+user_cache = UserCache()
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_cached_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
+    # 提交后再失效一次，避免提交前被并发请求以旧值重新缓存
+    session = OrmSession.object_session(target)
+    if session is not None:
+        session.info.setdefault("changed_user_ids", set()).add(target.id)
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _invalidate_committed_users(session):
+    for user_id in session.info.pop("changed_user_ids", ()):
+        user_cache.invalidate(user_id)